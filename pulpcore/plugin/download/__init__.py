@@ -1,4 +1,6 @@
 from .base import BaseDownloader, DownloadResult  # noqa
+from .cache import DownloadCache  # noqa
 from .factory import DownloaderFactory  # noqa
 from .file import FileDownloader  # noqa
 from .http import http_giveup, HttpDownloader  # noqa
+from .limiter import AdaptiveConcurrencyLimiter, PrioritySemaphore  # noqa
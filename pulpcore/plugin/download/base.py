@@ -1,13 +1,22 @@
 import asyncio
-from collections import namedtuple
+from collections import defaultdict, namedtuple
+from contextlib import contextmanager
+import ctypes
+import ctypes.util
 import hashlib
+import io
 import logging
 import os
 import tempfile
 
+from django.conf import settings
+
 from pulpcore.app.models import Artifact
+from pulpcore.app.models.storage import get_artifact_path
 from pulpcore.exceptions import DigestValidationError, SizeValidationError
 
+from .limiter import AdaptiveConcurrencyLimiter, PrioritySemaphore
+
 
 log = logging.getLogger(__name__)
 
@@ -25,6 +34,102 @@ Args:
 """
 
 
+MIN_CHUNK_SIZE = 65536  # 64 kilobytes
+MAX_CHUNK_SIZE = 1048576  # 1 megabyte
+MIN_PREALLOCATE_SIZE = 8388608  # 8 megabytes
+
+try:
+    # The fallocate(2) system call fails where the filesystem doesn't support it, unlike
+    # posix_fallocate(3) which falls back to writing every block.
+    _fallocate = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True).fallocate
+    _fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_longlong, ctypes.c_longlong]
+except (OSError, AttributeError):
+    _fallocate = None
+
+
+def chunk_size(size=None):
+    """
+    Return the size of the chunks to read a file of `size` bytes in.
+
+    This is the smallest power of two holding `size` bytes, but at least `MIN_CHUNK_SIZE` and at
+    most `MAX_CHUNK_SIZE`. Small files don't need a large buffer and large files are read in as few
+    chunks as memory allows.
+
+    Args:
+        size (int): The size of the file, or None if unknown.
+
+    Returns:
+        int: The chunk size.
+    """
+    if not size:
+        return MAX_CHUNK_SIZE
+    chunk = MIN_CHUNK_SIZE
+    while chunk < size and chunk < MAX_CHUNK_SIZE:
+        chunk *= 2
+    return chunk
+
+
+class _BufferPool:
+    """
+    A pool of reusable `bytearray` buffers, grouped by size.
+
+    Args:
+        max_free (int): The number of unused buffers of one size the pool keeps.
+    """
+
+    def __init__(self, max_free=64):
+        self.max_free = max_free
+        self._free = defaultdict(list)
+
+    @contextmanager
+    def buffer(self, size):
+        """
+        A context manager providing a buffer of `size` bytes, which is returned to the pool after.
+
+        Args:
+            size (int): The size of the buffer.
+
+        Yields:
+            bytearray: The buffer.
+        """
+        free = self._free[size]
+        buffer = free.pop() if free else bytearray(size)
+        try:
+            yield buffer
+        finally:
+            if len(free) < self.max_free:
+                free.append(buffer)
+
+
+_buffer_pool = _BufferPool()
+
+
+def _staging_directory():
+    """
+    Return the directory in the Artifact storage that downloads are written to before validation.
+    """
+    return os.path.join(settings.MEDIA_ROOT, 'artifact', '.staging')
+
+
+class _SemaphoreSlot:
+    """
+    Holds a slot of the `semaphore` of a downloader, acquired with the downloader's `priority`.
+    """
+
+    def __init__(self, downloader):
+        self._semaphore = downloader.semaphore
+        self._priority = downloader.priority
+
+    async def __aenter__(self):
+        if isinstance(self._semaphore, PrioritySemaphore):
+            await self._semaphore.acquire(priority=self._priority)
+        else:
+            await self._semaphore.acquire()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self._semaphore.release()
+
+
 class BaseDownloader:
     """
     The base class of all downloaders, providing digest calculation, validation, and file handling.
@@ -54,17 +159,46 @@ class BaseDownloader:
     data written to the file-like object is quiesced to disk before the file-like object has
     `close()` called on it.
 
+    If ``expected_size`` is set, the download is aborted with a
+    :class:`~pulpcore.exceptions.SizeValidationError` as soon as more data is handled than
+    expected. Random files of at least ``MIN_PREALLOCATE_SIZE`` bytes are preallocated with
+    `fallocate` to reduce fragmentation, where the platform and filesystem support it.
+
+    With ``spool_size`` set, downloads are kept in memory until they exceed ``spool_size`` bytes,
+    and only written to the random file once they are complete and validated. The random file is
+    not synced to disk with `fsync` in this mode. Instead, the
+    :class:`~pulpcore.plugin.stages.ArtifactSaver` syncs the filesystem once for each batch of
+    Artifacts it saves. This makes many small downloads much cheaper. Downloaders used outside of
+    the Stages API should only use it if they don't need the file to survive a crash.
+
+    With ``artifact_storage`` set, the random file is created in a staging directory inside the
+    Artifact storage instead of the current working directory. Once the download is validated, it
+    is moved to its content-addressed location in the Artifact storage with an atomic rename, and
+    ``path`` points there. Saving it as an :class:`~pulpcore.plugin.models.Artifact` then doesn't
+    copy it again, even if the working directory is on another filesystem. A file already present
+    at that location is kept.
+
     Attributes:
         url (str): The url to download.
         expected_digests (dict): Keyed on the algorithm name provided by hashlib and stores the
             value of the expected digest. e.g. {'md5': '912ec803b2ce49e4a541068d495ab570'}
         expected_size (int): The number of bytes the download is expected to have.
         path (str): The full path to the file containing the downloaded data if no
-            ``custom_file_object`` option was specified, otherwise None.
+            ``custom_file_object`` option was specified, otherwise None. For a download kept in
+            memory, it is None until the download is finished.
+        spool_size (int): The number of bytes a download may have to be kept in memory.
+        artifact_storage (bool): Whether the file is downloaded into the Artifact storage.
     """
 
+    # Whether the random file is preallocated when the downloader is created.
+    _preallocate_on_create = True
+
+    #: Whether the download goes ahead of the ones waiting without priority if `semaphore` is a
+    #: :class:`~pulpcore.plugin.download.PrioritySemaphore`.
+    priority = False
+
     def __init__(self, url, custom_file_object=None, expected_digests=None, expected_size=None,
-                 semaphore=None):
+                 semaphore=None, spool_size=None, artifact_storage=False):
         """
         Create a BaseDownloader object. This is expected to be called by all subclasses.
 
@@ -77,17 +211,34 @@ class BaseDownloader:
                 value of the expected digest. e.g. {'md5': '912ec803b2ce49e4a541068d495ab570'}
             expected_size (int): The number of bytes the download is expected to have.
             semaphore (asyncio.Semaphore): A semaphore the downloader must acquire before running.
-                Useful for limiting the number of outstanding downloaders in various ways.
+                Useful for limiting the number of outstanding downloaders in various ways. This can
+                also be a :class:`~pulpcore.plugin.download.PrioritySemaphore`, which is acquired
+                with the downloader's `priority`, or an
+                :class:`~pulpcore.plugin.download.AdaptiveConcurrencyLimiter`, which is also
+                informed about the outcome of the download.
+            spool_size (int): If set, downloads of up to this many bytes are kept in memory and
+                the downloaded file is not synced to disk. Defaults to None.
+            artifact_storage (bool): If True, the file is downloaded into the Artifact storage and
+                moved to its final location once validated. Ignored with a
+                ``custom_file_object``. Defaults to False.
         """
         self.url = url
+        self.expected_digests = expected_digests
+        self.expected_size = expected_size
+        self.spool_size = spool_size
+        self.artifact_storage = artifact_storage and not custom_file_object
+        self._spooled = bool(spool_size and not custom_file_object and
+                             (not expected_size or expected_size <= spool_size))
+        self.path = None
         if custom_file_object:
             self._writer = custom_file_object
-            self.path = None
+        elif self._spooled:
+            self._writer = io.BytesIO()
         else:
-            self._writer = tempfile.NamedTemporaryFile(dir=os.getcwd(), delete=False)
+            self._writer = self._temporary_file()
             self.path = self._writer.name
-        self.expected_digests = expected_digests
-        self.expected_size = expected_size
+        if self._preallocate_on_create:
+            self._preallocate()
         if semaphore:
             self.semaphore = semaphore
         else:
@@ -104,11 +255,23 @@ class BaseDownloader:
         the concatenation of all the arguments: m.handle_data(a); m.handle_data(b) is equivalent to
         m.handle_data(a+b).
 
+        The builtin downloaders may pass a `memoryview` of a reused buffer, which is only valid
+        until this coroutine returns. Subclasses overriding this method must copy the data if they
+        need it afterwards.
+
         Args:
-            data (bytes): The data to be handled by the downloader.
+            data (bytes or memoryview): The data to be handled by the downloader.
+
+        Raises:
+            :class:`~pulpcore.exceptions.SizeValidationError`: When the data handled so far exceeds
+                the ``expected_size``.
         """
+        if self.expected_size and self._size + len(data) > self.expected_size:
+            raise SizeValidationError()
         self._writer.write(data)
         self._record_size_and_digests_for_data(data)
+        if self._spooled and self._size > self.spool_size:
+            self._spill()
 
     async def finalize(self):
         """
@@ -125,11 +288,85 @@ class BaseDownloader:
                 doesn't match the size of the data passed to
                 :meth:`~pulpcore.plugin.download.BaseDownloader.handle_data`.
         """
+        if self._spooled:
+            # Don't write invalid data to disk at all.
+            self.validate_digests()
+            self.validate_size()
+            self._spill()
         self._writer.flush()
-        os.fsync(self._writer.fileno())
+        if not self.spool_size:
+            os.fsync(self._writer.fileno())
+        self._writer.close()
+        self._complete()
+
+    def _complete(self):
+        """
+        Validate the data of the closed file and move it into the Artifact storage if requested.
+
+        Raises:
+            :class:`~pulpcore.exceptions.DigestValidationError`: When the digests don't match.
+            :class:`~pulpcore.exceptions.SizeValidationError`: When the size doesn't match.
+        """
+        try:
+            self.validate_digests()
+            self.validate_size()
+        except Exception:
+            self._discard()
+            raise
+        if self.artifact_storage:
+            self._store()
+
+    def _temporary_file(self):
+        """
+        Create the random file to write to.
+
+        Returns:
+            A :func:`tempfile.NamedTemporaryFile` which is not deleted when closed.
+        """
+        directory = os.getcwd()
+        if self.artifact_storage:
+            directory = _staging_directory()
+            os.makedirs(directory, exist_ok=True)
+        return tempfile.NamedTemporaryFile(dir=directory, delete=False)
+
+    def _store(self):
+        """
+        Move the validated file from the staging directory to its location in the Artifact storage.
+        """
+        destination = os.path.join(settings.MEDIA_ROOT,
+                                   get_artifact_path(self._digests['sha256'].hexdigest()))
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        try:
+            # Unlike a rename, linking doesn't replace a file which may be in use already.
+            os.link(self.path, destination)
+        except FileExistsError:
+            pass
+        os.unlink(self.path)
+        self.path = destination
+
+    def _discard(self):
+        """
+        Remove the file of a failed download from the Artifact storage staging directory.
+
+        Files in the working directory are left alone, they are removed with it.
+        """
+        if not self.path or os.path.dirname(self.path) != _staging_directory():
+            return
         self._writer.close()
-        self.validate_digests()
-        self.validate_size()
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+    def _spill(self):
+        """
+        Move the data kept in memory to the random file, which is used for all further data.
+        """
+        writer = self._temporary_file()
+        writer.write(self._writer.getbuffer())
+        self._writer = writer
+        self.path = writer.name
+        self._spooled = False
 
     def fetch(self):
         """
@@ -144,12 +381,60 @@ class BaseDownloader:
         done, _ = asyncio.get_event_loop().run_until_complete(asyncio.wait([self.run()]))
         return done.pop().result()
 
+    def _reset(self):
+        """
+        Discard all data handled so far, so the download can start over.
+
+        Returns:
+            bool: False if the data could not be discarded because the file object is closed or
+                not seekable, True otherwise.
+        """
+        if self._size:
+            try:
+                seekable = self._writer.seekable()
+            except (AttributeError, ValueError):
+                seekable = False
+            if not seekable:
+                return False
+            self._writer.seek(0)
+            self._writer.truncate()
+            self._preallocate()
+        self._digests = {n: hashlib.new(n) for n in Artifact.DIGEST_FIELDS}
+        self._size = 0
+        return True
+
+    def _buffer(self, size=None):
+        """
+        Return a context manager providing a pooled buffer to read data into.
+
+        Args:
+            size (int): The number of bytes to be read. Defaults to ``expected_size``.
+
+        Returns:
+            A context manager yielding a `bytearray` sized by
+            :func:`~pulpcore.plugin.download.base.chunk_size`.
+        """
+        return _buffer_pool.buffer(chunk_size(size or self.expected_size))
+
+    def _preallocate(self):
+        """
+        Allocate ``expected_size`` bytes for the random file the downloader writes to.
+
+        This is a no-op for a ``custom_file_object``, if the size is unknown or smaller than
+        ``MIN_PREALLOCATE_SIZE``, or if the platform or filesystem doesn't support `fallocate`.
+        """
+        if not self.path or not self.expected_size or self.expected_size < MIN_PREALLOCATE_SIZE:
+            return
+        if _fallocate is not None:
+            # Errors, e.g. EOPNOTSUPP, are ignored.
+            _fallocate(self._writer.fileno(), 0, 0, self.expected_size)
+
     def _record_size_and_digests_for_data(self, data):
         """
         Record the size and digest for an available chunk of data.
 
         Args:
-            data (bytes): The data to have its size and digest values recorded.
+            data (bytes or memoryview): The data to have its size and digest values recorded.
         """
         for algorithm in self._digests.values():
             algorithm.update(data)
@@ -198,8 +483,10 @@ class BaseDownloader:
         Run the downloader with concurrency restriction.
 
         This method acquires `self.semaphore` before calling the actual download implementation
-        contained in `_run()`. This ensures that the semaphore stays acquired even as the `backoff`
-        decorator on `_run()`, handles backoff-and-retry logic.
+        contained in `_run()` and releases it afterwards. Subclasses implementing retry logic
+        should retry this method rather than `_run()`, so the semaphore is not held while waiting
+        to retry. A :class:`~pulpcore.plugin.download.PrioritySemaphore` is acquired with
+        `self.priority`.
 
         Args:
             extra_data (dict): Extra data passed to the downloader.
@@ -208,8 +495,11 @@ class BaseDownloader:
             :class:`~pulpcore.plugin.download.DownloadResult` from `_run()`.
 
         """
-        async with self.semaphore:
-            return await self._run(extra_data=extra_data)
+        async with _SemaphoreSlot(self):
+            result = await self._run(extra_data=extra_data)
+            if isinstance(self.semaphore, AdaptiveConcurrencyLimiter):
+                self.semaphore.record_success(self._size)
+            return result
 
     async def _run(self, extra_data=None):
         """
@@ -0,0 +1,425 @@
+import asyncio
+import errno
+import fcntl
+from gettext import gettext as _
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+
+from multidict import CIMultiDict
+
+from pulpcore.app.models import Artifact
+from pulpcore.exceptions import DigestValidationError, SizeValidationError
+
+from .base import DownloadResult, chunk_size
+from .file import _link
+
+
+log = logging.getLogger(__name__)
+
+#: The share of `max_size` the cache is reduced to by an eviction, so it isn't repeated on each add.
+LOW_WATER_MARK = 0.9
+
+
+def _link_or_copy(source, destination):
+    """
+    Make `destination` a reflink or hardlink of `source`, or a copy if that's not possible.
+
+    Args:
+        source (str): The path of an existing file.
+        destination (str): The path of the file to create. It must not exist.
+    """
+    if not _link(source, destination, hardlink=True):
+        shutil.copyfile(source, destination)
+
+
+def _try_lock(fd):
+    """
+    Try to get an exclusive `flock` on `fd` without blocking.
+
+    Returns:
+        bool: True if the lock was acquired, False if another file description holds it.
+    """
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError as exc:
+        if exc.errno not in (errno.EAGAIN, errno.EACCES):
+            raise
+        return False
+    return True
+
+
+class _KeyLock:
+    """
+    An exclusive lock on a cache key, acquired without blocking the event loop.
+
+    The lock is an `flock` on the lock file at `path`. Eviction removes lock files while holding
+    them, so a lock acquired on a file which was removed or replaced in the meantime is dropped
+    and acquired again on the current file.
+    """
+
+    def __init__(self, path, poll_interval):
+        self.path = path
+        self.poll_interval = poll_interval
+        self._fd = None
+
+    async def __aenter__(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        while True:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                locked = _try_lock(fd)
+                if locked and self._is_current(fd):
+                    self._fd = fd
+                    return self
+            except BaseException:
+                os.close(fd)
+                raise
+            os.close(fd)
+            if not locked:
+                await asyncio.sleep(self.poll_interval)
+
+    async def __aexit__(self, exc_type, exc, tb):
+        os.close(self._fd)  # releases the lock
+        self._fd = None
+
+    def _is_current(self, fd):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return False
+        current = os.fstat(fd)
+        return (stat.st_dev, stat.st_ino) == (current.st_dev, current.st_ino)
+
+
+class DownloadCache:
+    """
+    A content-addressed cache of downloaded files on the local disk.
+
+    The cache lets downloads with ``expected_digests`` reuse files downloaded before, by any
+    remote or task on the same host sharing the cache `directory`. Entries are keyed by the
+    strongest expected digest. A file is only added to the cache after its digests were validated,
+    and it is validated again when it is taken from the cache.
+
+    Each key is protected by an exclusive `flock` while it is looked up and downloaded. Of any
+    number of concurrent downloads of the same file, in this or other processes, only the first
+    downloads it. The others wait for it and take the file from the cache.
+
+    Files are reflinked or hardlinked into and out of the cache if the filesystems allow it, and
+    copied otherwise. The size of the cache is kept in a file in the cache `directory`, which all
+    processes update under an `flock` when they add a file. Once the cache holds more than
+    `max_size` bytes, the least recently used files are removed until it holds at most
+    `LOW_WATER_MARK` of `max_size`, so the cache directory is only walked once in a while. Files
+    locked by a download are kept, so the cache holds at most `max_size` bytes plus the files in
+    use by downloads and the files being added at the moment.
+
+    The cache is used by the :class:`~pulpcore.plugin.download.HttpDownloader` when passed as its
+    ``cache``, e.g. by the :class:`~pulpcore.plugin.download.DownloaderFactory`::
+
+        >>> cache = DownloadCache('/var/cache/pulp/downloads', max_size=100 * 2 ** 30)
+        >>> factory = DownloaderFactory(remote, cache=cache)
+
+    Downloads without ``expected_digests`` use the cache for conditional requests instead. If the
+    response to a previous download of the url had an `ETag` or `Last-Modified` header, the request
+    is sent with `If-None-Match` or `If-Modified-Since`, and a `304 Not Modified` response is
+    answered with the cached file and headers. These entries are kept per `scope`, e.g. a remote,
+    as the response may depend on its credentials.
+
+    Downloads without their own file, i.e. with a ``custom_file_object`` or kept in memory because
+    of ``spool_size``, don't use the cache.
+
+    Args:
+        directory (str): The directory to keep the files in. It is created if needed.
+        max_size (int): The number of bytes the cache may hold.
+        poll_interval (float): The number of seconds between attempts to get a lock held by
+            another download. Defaults to 0.1.
+    """
+
+    def __init__(self, directory, max_size, poll_interval=0.1):
+        self.directory = os.path.abspath(directory)
+        self.max_size = max_size
+        self.poll_interval = poll_interval
+        os.makedirs(self.directory, exist_ok=True)
+
+    @staticmethod
+    def key(expected_digests):
+        """
+        Return the cache key for a download with the `expected_digests`.
+
+        Args:
+            expected_digests (dict): Keyed on the algorithm name and storing the digest value.
+
+        Returns:
+            str: The key, or None if no digest is expected.
+        """
+        for name in Artifact.DIGEST_FIELDS:
+            value = (expected_digests or {}).get(name)
+            if value:
+                return '{name}-{value}'.format(name=name, value=value.lower())
+        return None
+
+    def _path(self, key):
+        return os.path.join(self.directory, key.rpartition('-')[2][:2], key)
+
+    def _response_path(self, scope, url):
+        name = hashlib.sha256(url.encode()).hexdigest()
+        return os.path.join(self.directory, 'responses', str(scope), name[:2], name)
+
+    def load_response(self, scope, url):
+        """
+        Return the headers of the cached response for `url`.
+
+        Args:
+            scope (str): The scope of the response, e.g. the pk of a remote.
+            url (str): The url.
+
+        Returns:
+            multidict.CIMultiDict: The headers of the cached response, or None if there is none.
+        """
+        try:
+            with open(self._response_path(scope, url) + '.json') as file:
+                return CIMultiDict(json.load(file))
+        except (FileNotFoundError, ValueError, TypeError):
+            return None
+
+    def retrieve_response(self, scope, url, downloader):
+        """
+        Place the cached response body for `url` at the path of `downloader`.
+
+        This blocks, it should be run in an executor.
+
+        Args:
+            scope (str): The scope of the response, e.g. the pk of a remote.
+            url (str): The url.
+            downloader (:class:`~pulpcore.plugin.download.BaseDownloader`): The downloader.
+
+        Returns:
+            bool: True if the body was in the cache, False otherwise.
+        """
+        return self._retrieve(self._response_path(scope, url), downloader)
+
+    def store_response(self, scope, url, source, headers):
+        """
+        Add a response for `url` to the cache if it can be validated with a conditional request.
+
+        This blocks, it should be run in an executor.
+
+        Args:
+            scope (str): The scope of the response, e.g. the pk of a remote.
+            url (str): The url.
+            source (str): The path of the file containing the response body.
+            headers (dict): The response headers. Their names are case-insensitive.
+        """
+        headers = CIMultiDict(headers)
+        if 'no-store' in headers.get('Cache-Control', ''):
+            return
+        if not headers.get('ETag') and not headers.get('Last-Modified'):
+            return
+        path = self._response_path(scope, url)
+        self._add(path, source)
+        fd, temporary = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.')
+        with os.fdopen(fd, 'w') as file:
+            json.dump(list(headers.items()), file)
+        os.replace(temporary, path + '.json')
+
+    async def run(self, downloader, download):
+        """
+        Provide the file expected by `downloader` from the cache or by running `download`.
+
+        Args:
+            downloader (:class:`~pulpcore.plugin.download.BaseDownloader`): The downloader.
+            download (callable): A function returning a coroutine which downloads the file into the
+                ``path`` of `downloader` and returns a
+                :class:`~pulpcore.plugin.download.DownloadResult`.
+
+        Returns:
+            :class:`~pulpcore.plugin.download.DownloadResult`
+        """
+        key = self.key(downloader.expected_digests)
+        if key is None or not downloader.path:
+            return await download()
+        loop = asyncio.get_event_loop()
+        async with self._locked(key):
+            if await loop.run_in_executor(None, self._retrieve, self._path(key), downloader):
+                log.debug(_('Took %(url)s from the download cache.'), {'url': downloader.url})
+                downloader._complete()
+                return DownloadResult(url=downloader.url, path=downloader.path, headers=None,
+                                      artifact_attributes=downloader.artifact_attributes)
+            result = await download()
+            await loop.run_in_executor(None, self._add, self._path(key), result.path)
+        return result
+
+    def _locked(self, key):
+        """
+        Return an asynchronous context manager holding an exclusive lock on `key`.
+        """
+        return _KeyLock(self._path(key) + '.lock', self.poll_interval)
+
+    def _retrieve(self, path, downloader):
+        """
+        Place the cached file at `path` at the path of `downloader` and compute its digests.
+
+        A cached file which doesn't match the expected digests or size is removed from the cache.
+        This runs in a worker thread.
+
+        Returns:
+            bool: True if a valid file was in the cache, False otherwise.
+        """
+        fd, retrieved = tempfile.mkstemp(dir=os.path.dirname(downloader.path))
+        os.close(fd)
+        os.unlink(retrieved)
+        try:
+            _link_or_copy(path, retrieved)
+        except FileNotFoundError:
+            return False
+        try:
+            os.utime(path)  # mark it as recently used
+        except FileNotFoundError:
+            pass
+        with open(retrieved, 'rb') as file:
+            buffer = bytearray(chunk_size(os.fstat(file.fileno()).st_size))
+            view = memoryview(buffer)
+            while True:
+                size = file.readinto(buffer)
+                if not size:
+                    break
+                downloader._record_size_and_digests_for_data(view[:size])
+        try:
+            downloader.validate_digests()
+            downloader.validate_size()
+        except (DigestValidationError, SizeValidationError):
+            log.warning(_('Removing corrupted file %(path)s from the download cache.'),
+                        {'path': path})
+            for invalid in (path, retrieved):
+                try:
+                    os.unlink(invalid)
+                except FileNotFoundError:
+                    pass
+            downloader._reset()
+            return False
+        downloader._writer.close()
+        os.replace(retrieved, downloader.path)
+        return True
+
+    def _add(self, path, source):
+        """
+        Add the file at `source` to the cache at `path` and evict files if the cache is too large.
+
+        This runs in a worker thread.
+        """
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, inserted = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.')
+        os.close(fd)
+        os.unlink(inserted)
+        _link_or_copy(source, inserted)
+        try:
+            replaced = os.stat(path).st_size
+        except FileNotFoundError:
+            replaced = 0
+        os.replace(inserted, path)
+        added = os.stat(path).st_size - replaced
+        size = self._update_size(lambda size: None if size is None else size + added)
+        if size is None or size > self.max_size:
+            self._evict()
+
+    def _update_size(self, update):
+        """
+        Update the size of the cache kept in the cache directory for all processes using it.
+
+        Args:
+            update (callable): Called with the current size, or None if it isn't known yet, and
+                returning the new size, or None to keep it unknown.
+
+        Returns:
+            int: The new size, or None if it isn't known.
+        """
+        fd = os.open(os.path.join(self.directory, '.size'), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                size = int(os.read(fd, 32))
+            except ValueError:
+                size = None
+            size = update(size)
+            if size is not None:
+                os.lseek(fd, 0, os.SEEK_SET)
+                os.ftruncate(fd, 0)
+                os.write(fd, str(size).encode())
+            return size
+        finally:
+            os.close(fd)  # releases the lock
+
+    def _evict(self):
+        """
+        Remove the least recently used files until the cache holds at most `LOW_WATER_MARK` of
+        `max_size` bytes, along with the lock files of the removed and of missing files.
+
+        Only one process evicts at a time, the others skip it. The files other processes add while
+        the directory is walked are counted even if the walk finds them too, so the size may be
+        overestimated until the next eviction, but not underestimated.
+        """
+        fd = os.open(os.path.join(self.directory, '.evict.lock'), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if not _try_lock(fd):
+                return
+            # Start counting what other processes add while the directory is walked.
+            before = self._update_size(lambda size: 0 if size is None else size)
+            entries = []
+            locks = set()
+            for directory, subdirectories, files in os.walk(self.directory):
+                for name in files:
+                    if name.startswith('.'):
+                        continue
+                    path = os.path.join(directory, name)
+                    if name.endswith('.lock'):
+                        locks.add(path[:-len('.lock')])
+                        continue
+                    try:
+                        stat = os.stat(path, follow_symlinks=False)
+                    except FileNotFoundError:
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, path))
+            total = sum(size for mtime, size, path in entries)
+            entries.sort()
+            for mtime, size, path in entries:
+                if total <= self.max_size * LOW_WATER_MARK:
+                    break
+                if self._remove(path):
+                    total -= size
+                    log.debug(_('Evicted %(path)s from the download cache.'), {'path': path})
+            for path in locks.difference(path for mtime, size, path in entries):
+                self._remove(path)
+            self._update_size(lambda size: total if size is None else total + size - before)
+        finally:
+            os.close(fd)
+
+    @staticmethod
+    def _remove(path):
+        """
+        Remove the cached file at `path` and its lock file, unless a download holds the lock.
+
+        Downloads waiting for the lock notice the removed lock file and lock a new one.
+
+        Returns:
+            bool: True if the file was removed, False if it is in use.
+        """
+        lock = path + '.lock'
+        try:
+            fd = os.open(lock, os.O_RDWR)
+        except FileNotFoundError:
+            fd = None  # cached responses are not locked
+        try:
+            if fd is not None and not _try_lock(fd):
+                return False
+            for removed in (path, lock) if fd is not None else (path,):
+                try:
+                    os.unlink(removed)
+                except FileNotFoundError:
+                    pass
+            return True
+        finally:
+            if fd is not None:
+                os.close(fd)
@@ -1,4 +1,3 @@
-import asyncio
 import atexit
 import copy
 from gettext import gettext as _
@@ -9,6 +8,7 @@ import aiohttp
 
 from .http import HttpDownloader
 from .file import FileDownloader
+from .limiter import AdaptiveConcurrencyLimiter, PrioritySemaphore
 
 
 PROTOCOL_MAP = {
@@ -45,9 +45,25 @@ class DownloaderFactory:
     Also for http and https urls, even though HTTP 1.1 is used, the TCP connection is setup and
     closed with each request. This is done for compatibility reasons due to various issues related
     to session continuation implementation in various servers.
+
+    By default, at most `download_concurrency` downloads of the remote run at the same time. With
+    ``adaptive_concurrency`` enabled, the `download_concurrency` is only the starting point and an
+    :class:`~pulpcore.plugin.download.AdaptiveConcurrencyLimiter` raises or lowers the number of
+    parallel downloads depending on the throughput, latency, and HTTP 429 or 5XX responses of the
+    server. The limit never exceeds the connection limit of the `aiohttp` session. The current value
+    is available as :attr:`concurrency`.
+
+    With ``spool_size`` set, the downloaders keep small downloads in memory and don't sync them to
+    disk, and with ``artifact_storage`` set, they download directly into the Artifact storage, see
+    :class:`~pulpcore.plugin.download.BaseDownloader`.
+
+    With a ``cache``, http and https downloads with expected digests share the files of the
+    :class:`~pulpcore.plugin.download.DownloadCache`, and other downloads are sent as conditional
+    requests if the remote downloaded the url before.
     """
 
-    def __init__(self, remote, downloader_overrides=None):
+    def __init__(self, remote, downloader_overrides=None, adaptive_concurrency=False,
+                 spool_size=None, artifact_storage=False, cache=None):
         """
         Args:
             remote (:class:`~pulpcore.plugin.models.Remote`): The remote used to populate
@@ -55,8 +71,18 @@ class DownloaderFactory:
             downloader_overrides (dict): Keyed on a scheme name, e.g. 'https' or 'ftp' and the value
                 is the downloader class to be used for that scheme, e.g.
                 {'https': MyCustomDownloader}. These override the default values.
+            adaptive_concurrency (bool): If True, the number of parallel downloads adapts to the
+                server, starting at the remote's `download_concurrency`. Defaults to False.
+            spool_size (int): The ``spool_size`` passed to all downloaders. Defaults to None.
+            artifact_storage (bool): The ``artifact_storage`` passed to all downloaders. Defaults
+                to False.
+            cache (:class:`~pulpcore.plugin.download.DownloadCache`): The cache passed to http and
+                https downloaders. Defaults to None.
         """
         self._remote = remote
+        self._cache = cache
+        self._spool_size = spool_size
+        self._artifact_storage = artifact_storage
         self._download_class_map = copy.copy(PROTOCOL_MAP)
         if downloader_overrides:
             for protocol, download_class in downloader_overrides.items():  # overlay the overrides
@@ -64,9 +90,27 @@ class DownloaderFactory:
         self._handler_map = {'https': self._http_or_https, 'http': self._http_or_https,
                              'file': self._generic}
         self._session = self._make_aiohttp_session_from_remote()
-        self._semaphore = asyncio.Semaphore(value=remote.download_concurrency)
+        if adaptive_concurrency:
+            self._semaphore = AdaptiveConcurrencyLimiter(
+                remote.download_concurrency,
+                max_value=self._session.connector.limit or None
+            )
+        else:
+            self._semaphore = PrioritySemaphore(remote.download_concurrency)
         atexit.register(self._session.close)
 
+    @property
+    def concurrency(self):
+        """
+        The number of downloads currently allowed to run in parallel.
+
+        This is the remote's `download_concurrency` unless ``adaptive_concurrency`` is enabled, in
+        which case it changes over time.
+        """
+        if isinstance(self._semaphore, AdaptiveConcurrencyLimiter):
+            return self._semaphore.limit
+        return self._remote.download_concurrency
+
     def _make_aiohttp_session_from_remote(self):
         """
         Build a :class:`aiohttp.ClientSession` from the remote's settings and timing settings.
@@ -128,6 +172,10 @@ class DownloaderFactory:
             is configured with the remote settings.
         """
         kwargs['semaphore'] = self._semaphore
+        if self._spool_size:
+            kwargs.setdefault('spool_size', self._spool_size)
+        if self._artifact_storage:
+            kwargs.setdefault('artifact_storage', self._artifact_storage)
         scheme = urlparse(url).scheme.lower()
         try:
             builder = self._handler_map[scheme]
@@ -153,6 +201,9 @@ class DownloaderFactory:
             is configured with the remote settings.
         """
         options = {'session': self._session}
+        if self._cache:
+            options['cache'] = self._cache
+            options['cache_scope'] = str(self._remote.pk)
         if self._remote.proxy_url:
             options['proxy'] = self._remote.proxy_url
 
@@ -1,10 +1,62 @@
+import asyncio
+import errno
+import fcntl
+import mmap
 import os
 
 from urllib.parse import urlparse
 
 import aiofiles
 
-from .base import BaseDownloader, DownloadResult
+from pulpcore.exceptions import SizeValidationError
+
+from .base import BaseDownloader, DownloadResult, MAX_CHUNK_SIZE
+
+
+FICLONE = 0x40049409  # from linux/fs.h
+
+#: The errors meaning a file can't be reflinked or hardlinked, but can still be copied.
+LINK_ERRNOS = (errno.EXDEV, errno.EPERM, errno.EACCES, errno.EMLINK, errno.ENOTTY,
+               errno.EOPNOTSUPP, errno.EINVAL, errno.ENOSYS)
+
+
+def _link(source, destination, hardlink=False):
+    """
+    Make `destination` share the data of `source` without copying it.
+
+    A reflink (a copy-on-write clone, e.g. on btrfs or XFS) is made, because the clone is
+    independent of the source afterwards. Only with `hardlink`, where reflinks are not supported,
+    `destination` is made a hardlink of `source` instead. A hardlink shares the inode with the
+    source, so later changes to either file change both, which is only safe for files nobody
+    modifies.
+
+    Args:
+        source (str): The path of an existing file.
+        destination (str): The path of the file to create. It must not exist.
+        hardlink (bool): Whether to fall back to a hardlink. Defaults to False.
+
+    Returns:
+        bool: True if `destination` was created, False if `source` and `destination` don't share a
+            filesystem or it supports neither reflinks nor, with `hardlink`, hardlinks.
+    """
+    with open(source, 'rb') as src, open(destination, 'xb') as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            os.fsync(dst.fileno())
+            return True
+        except OSError as exc:
+            if exc.errno not in LINK_ERRNOS:
+                raise
+    os.unlink(destination)
+    if not hardlink:
+        return False
+    try:
+        os.link(source, destination)
+    except OSError as exc:
+        if exc.errno not in LINK_ERRNOS:
+            raise
+        return False
+    return True
 
 
 class FileDownloader(BaseDownloader):
@@ -15,21 +67,38 @@ class FileDownloader(BaseDownloader):
     file as an Artifact. It writes a new file to the disk and the return path is included in the
     :class:`~pulpcore.plugin.download.DownloadResult`.
 
+    If no ``custom_file_object`` is given and the file is on the same filesystem as the current
+    working directory, the new file is a reflink of the original one instead of a copy. Where
+    reflinks are not supported, it is a hardlink if ``hardlink`` is set. A hardlink shares the inode
+    with the original file, so it is only safe if the original file is never modified in place,
+    which is why it is opt-in. The file is then only read once, through `mmap` in a worker
+    thread, to compute its digests, and saving it as an Artifact moves the link into the Artifact
+    storage without copying any data. Files on other filesystems, e.g. NFS, are copied in a single
+    pass which also computes the digests.
+
     This downloader has all of the attributes of
     :class:`~pulpcore.plugin.download.BaseDownloader`
     """
 
-    def __init__(self, url, **kwargs):
+    # The random file is usually replaced by a link, it is only preallocated for copying.
+    _preallocate_on_create = False
+
+    def __init__(self, url, hardlink=False, **kwargs):
         """
         Download files from a url that starts with `file://`
 
         Args:
             url (str): The url to the file. This is expected to begin with `file://`
+            hardlink (bool): Whether to hardlink the file where it can't be reflinked. Defaults to
+                False.
             kwargs (dict): This accepts the parameters of
-                :class:`~pulpcore.plugin.download.BaseDownloader`.
+                :class:`~pulpcore.plugin.download.BaseDownloader`. The ``spool_size`` is ignored,
+                as local files are linked or copied directly.
         """
+        kwargs.pop('spool_size', None)
         p = urlparse(url)
         self._path = os.path.abspath(os.path.join(p.netloc, p.path))
+        self.hardlink = hardlink
         super().__init__(url, **kwargs)
 
     async def _run(self, extra_data=None):
@@ -42,12 +111,59 @@ class FileDownloader(BaseDownloader):
         Args:
             extra_data (dict): Extra data passed to the downloader.
         """
+        if self.path:
+            try:
+                linked = await asyncio.get_event_loop().run_in_executor(None, self._link_and_hash)
+            except Exception:
+                self._discard()
+                raise
+            if linked:
+                self._complete()
+                return DownloadResult(path=self.path, artifact_attributes=self.artifact_attributes,
+                                      url=self.url, headers=None)
         async with aiofiles.open(self._path, 'rb') as f_handle:
-            while True:
-                chunk = await f_handle.read(1048576)  # 1 megabyte
-                if not chunk:
-                    await self.finalize()
-                    break  # the reading is done
-                await self.handle_data(chunk)
-            return DownloadResult(path=self._path, artifact_attributes=self.artifact_attributes,
-                                  url=self.url, headers=None)
+            with self._buffer(os.fstat(f_handle.fileno()).st_size) as buffer:
+                view = memoryview(buffer)
+                while True:
+                    size = await f_handle.readinto(buffer)
+                    if not size:
+                        await self.finalize()
+                        break  # the reading is done
+                    await self.handle_data(view[:size])
+            return DownloadResult(path=self.path or self._path,
+                                  artifact_attributes=self.artifact_attributes, url=self.url,
+                                  headers=None)
+
+    def _link_and_hash(self):
+        """
+        Replace the random file with a link to the original file and compute its digests.
+
+        This runs in a worker thread.
+
+        Returns:
+            bool: True if the file was linked and hashed, False if it has to be copied instead.
+
+        Raises:
+            :class:`~pulpcore.exceptions.SizeValidationError`: When the size of the file doesn't
+                match the ``expected_size``.
+        """
+        size = os.stat(self._path).st_size
+        if self.expected_size and size != self.expected_size:
+            raise SizeValidationError()
+        self._writer.close()
+        os.unlink(self.path)
+        if not _link(self._path, self.path, hardlink=self.hardlink):
+            self._writer = open(self.path, 'xb')
+            self._preallocate()
+            return False
+        if size:
+            with open(self.path, 'rb') as file, \
+                    mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                view = memoryview(mapped)
+                try:
+                    for start in range(0, size, MAX_CHUNK_SIZE):
+                        self._record_size_and_digests_for_data(
+                            view[start:start + MAX_CHUNK_SIZE])
+                finally:
+                    view.release()
+        return True
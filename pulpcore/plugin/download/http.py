@@ -1,9 +1,18 @@
+import asyncio
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from gettext import gettext as _
 import logging
+import os
 
 import aiohttp
 import backoff
+from multidict import CIMultiDict
 
-from .base import BaseDownloader, DownloadResult
+from pulpcore.exceptions import SizeValidationError
+
+from .base import BaseDownloader, DownloadResult, _SemaphoreSlot, chunk_size
+from .limiter import AdaptiveConcurrencyLimiter
 
 
 log = logging.getLogger(__name__)
@@ -12,11 +21,27 @@ log = logging.getLogger(__name__)
 logging.getLogger('backoff').addHandler(logging.StreamHandler())
 
 
+#: The number of attempts made before the last exception is raised.
+MAX_TRIES = 10
+
+#: The longest delay, in seconds, accepted from a `Retry-After` header.
+MAX_RETRY_AFTER = 600
+
+#: The exceptions that cause a download to be retried unless :func:`http_giveup` says otherwise.
+RETRY_EXCEPTIONS = (
+    aiohttp.ClientResponseError,
+    aiohttp.ClientConnectionError,  # includes connection resets and socket read timeouts
+    aiohttp.ClientPayloadError,
+    asyncio.TimeoutError,
+)
+
+
 def http_giveup(exc):
     """
     Inspect a raised exception and determine if we should give up.
 
-    Do not give up when the status code is one of the following:
+    Do not give up on connection errors, truncated responses, timeouts, or when the status code is
+    one of the following:
 
         429 - Too Many Requests
         502 - Bad Gateway
@@ -24,12 +49,50 @@ def http_giveup(exc):
         504 - Gateway Timeout
 
     Args:
-        exc (aiohttp.ClientResponseException): The exception to inspect
+        exc (Exception): The exception to inspect
 
     Returns:
         True if the download should give up, False otherwise
     """
-    return exc.code not in [429, 502, 503, 504]
+    if isinstance(exc, aiohttp.ClientResponseError):
+        return exc.status not in [429, 502, 503, 504]
+    return False
+
+
+class _RangeNotSupported(Exception):
+    """
+    Raised when the server answers a range request with the whole file.
+    """
+    pass
+
+
+def _retry_after(exc):
+    """
+    Return the delay requested by the `Retry-After` header of a 429 or 503 response.
+
+    Args:
+        exc (Exception): The exception raised by the download attempt.
+
+    Returns:
+        The number of seconds to wait, capped at `MAX_RETRY_AFTER`, or None if the server did not
+        ask for a specific delay.
+    """
+    if not isinstance(exc, aiohttp.ClientResponseError) or exc.status not in [429, 503]:
+        return None
+    value = (getattr(exc, 'headers', None) or {}).get('Retry-After')
+    if not value:
+        return None
+    try:
+        delay = int(value)
+    except ValueError:
+        try:
+            date = parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+        if date.tzinfo is None:
+            date = date.replace(tzinfo=timezone.utc)
+        delay = (date - datetime.now(timezone.utc)).total_seconds()
+    return min(max(delay, 0), MAX_RETRY_AFTER)
 
 
 class HttpDownloader(BaseDownloader):
@@ -90,9 +153,35 @@ class HttpDownloader(BaseDownloader):
         >>>     except Exception as error:
         >>>         pass  # fatal exceptions are raised by result()
 
-    The HTTPDownloaders contain automatic retry logic if the server responds with HTTP 429 response.
-    The coroutine will automatically retry 10 times with exponential backoff before allowing a
-    final exception to be raised.
+    The HTTPDownloaders contain automatic retry logic if the server responds with HTTP 429 or some
+    5XX responses, if the connection is reset, or if it times out. The coroutine will automatically
+    retry 10 times with exponential backoff and jitter before allowing a final exception to be
+    raised. A `Retry-After` header sent with a 429 or 503 response sets the delay instead. The
+    downloader does not hold its `semaphore` while it waits to retry.
+
+    If a download fails after some data was received and the server advertised `Accept-Ranges:
+    bytes` along with a strong `ETag` or a `Last-Modified` header, the retry resumes the download.
+    The partial data and the digests computed so far are kept and only the missing bytes are
+    requested with a `Range` header. The `If-Range` header makes sure the server sends the whole
+    file again if it changed in the meantime, in which case the download starts over.
+
+    Large files can be downloaded in segments. If ``segment_threshold`` is set and the
+    ``expected_size`` is at least that large, the file is split into ``segment_count`` byte ranges
+    which are downloaded in parallel, each holding its own slot of the `semaphore`, and written
+    into a preallocated file. The digests are computed over the assembled file afterwards. If the
+    server does not honour range requests, the file is downloaded as a single stream. Segmented
+    downloads are only used when the downloader writes to its own file, i.e. without a
+    ``custom_file_object`` or a ``headers_ready_callback``.
+
+    With a ``cache``, downloads with ``expected_digests`` are taken from the
+    :class:`~pulpcore.plugin.download.DownloadCache` if possible and added to it otherwise. Other
+    downloads, e.g. of repository metadata, are sent as conditional requests if a previous response
+    for the url within the ``cache_scope`` is cached. If the server answers with `304 Not
+    Modified`, the cached file is used and the headers of the cached response are returned.
+
+    If the `semaphore` is an :class:`~pulpcore.plugin.download.AdaptiveConcurrencyLimiter`, the
+    downloader reports the latency of every response to it, and HTTP 429 and 5XX responses as
+    congestion.
 
     Attributes:
         session (aiohttp.ClientSession): The session to be used by the downloader.
@@ -104,13 +193,20 @@ class HttpDownloader(BaseDownloader):
             as its argument. The callback will be called when the response headers are
             available. The dictionary passed has the header names as the keys and header values
             as its values. e.g. `{'Transfer-Encoding': 'chunked'}`. This can also be None.
+        segment_threshold (int): The ``expected_size`` in bytes from which on the file is
+            downloaded in segments, or None to never download in segments.
+        segment_count (int): The number of segments a large file is downloaded in.
+        cache (:class:`~pulpcore.plugin.download.DownloadCache`): The cache for downloaded files or
+            None.
+        cache_scope (str): The scope of the cached responses, e.g. the pk of the remote.
 
     This downloader also has all of the attributes of
     :class:`~pulpcore.plugin.download.BaseDownloader`
     """
 
     def __init__(self, url, session=None, auth=None, proxy=None, proxy_auth=None,
-                 headers_ready_callback=None, **kwargs):
+                 headers_ready_callback=None, segment_threshold=None, segment_count=4, cache=None,
+                 cache_scope=None, **kwargs):
         """
         Args:
             url (str): The url to download.
@@ -124,6 +220,15 @@ class HttpDownloader(BaseDownloader):
                 as its argument. The callback will be called when the response headers are
                 available. The dictionary passed has the header names as the keys and header values
                 as its values. e.g. `{'Transfer-Encoding': 'chunked'}`
+            segment_threshold (int): The ``expected_size`` in bytes from which on the file is
+                downloaded in ``segment_count`` parallel segments. (optional) If not specified,
+                files are always downloaded as a single stream.
+            segment_count (int): The number of segments a large file is downloaded in. Defaults
+                to 4.
+            cache (:class:`~pulpcore.plugin.download.DownloadCache`): A cache to take files from
+                and add downloaded files to. (optional)
+            cache_scope (str): The scope of the responses in the ``cache``. Responses are only
+                reused within the same scope. (optional)
             kwargs (dict): This accepts the parameters of
                 :class:`~pulpcore.plugin.download.BaseDownloader`.
         """
@@ -139,6 +244,14 @@ class HttpDownloader(BaseDownloader):
         self.proxy = proxy
         self.proxy_auth = proxy_auth
         self.headers_ready_callback = headers_ready_callback
+        self.segment_threshold = segment_threshold
+        self.segment_count = segment_count
+        self.cache = cache
+        self.cache_scope = cache_scope
+        self._cached_headers = None
+        self._not_modified = False
+        self._resume_validator = None
+        self._response_headers = None
         super().__init__(url, **kwargs)
 
     async def _handle_response(self, response):
@@ -152,26 +265,271 @@ class HttpDownloader(BaseDownloader):
              DownloadResult: Contains information about the result. See the DownloadResult docs for
                  more information.
         """
-        if self.headers_ready_callback:
-            await self.headers_ready_callback(response.headers)
+        if self._size:
+            # The response resumes a previous one, which already announced the headers.
+            headers = self._response_headers
+        else:
+            headers = response.headers
+            if self.headers_ready_callback:
+                await self.headers_ready_callback(response.headers)
         while True:
-            chunk = await response.content.read(1048576)  # 1 megabyte
+            # readany() returns whatever aiohttp has buffered, joined into one bytes object if
+            # more than one chunk arrived, without waiting for a fixed amount of data.
+            chunk = await response.content.readany()
             if not chunk:
                 await self.finalize()
                 break  # the download is done
             await self.handle_data(chunk)
         return DownloadResult(path=self.path, artifact_attributes=self.artifact_attributes,
-                              url=self.url, headers=response.headers)
+                              url=self.url, headers=headers)
+
+    def _can_resume(self):
+        """
+        Determine whether a failed download can be resumed instead of started over.
+
+        Returns:
+            bool: True if data was received, the server supports range requests for the url, and
+                the file object can be rewound in case the server sends the whole file anyway.
+        """
+        if not self._size or not self._resume_validator:
+            return False
+        try:
+            return self._writer.seekable()
+        except (AttributeError, ValueError):
+            return False
+
+    def _can_restart(self):
+        """
+        Determine whether a failed download can start over from the first byte.
+
+        Data handed to a ``headers_ready_callback`` consumer or to an overridden
+        :meth:`~pulpcore.plugin.download.BaseDownloader.handle_data`, e.g. streamed to a client,
+        can't be taken back, so such downloads are only retried by resuming them.
+
+        Returns:
+            bool: True if no data was handled yet, or only by the downloader itself.
+        """
+        if not self._size:
+            return True
+        return not self.headers_ready_callback and \
+            type(self).handle_data is BaseDownloader.handle_data
+
+    def _check_resumed(self, response):
+        """
+        Prepare the downloader for the data of a response, which may continue a partial download.
+
+        A full response to a resumed request means the file changed on the server, so the partial
+        data is discarded. For a full response, the headers needed to resume it later are recorded.
+
+        Args:
+            response (aiohttp.ClientResponse): The response about to be handled.
+
+        Raises:
+            aiohttp.ClientPayloadError: If a partial response does not continue where the partial
+                download ended. The partial data is discarded, so a retry starts over. Also if the
+                download can't start over, see :meth:`_can_restart`, and the server sent a full
+                response.
+        """
+        if self._size:
+            content_range = response.headers.get('Content-Range', '')
+            if response.status == 206 and content_range.startswith('bytes {}-'.format(self._size)):
+                log.info(_('Resuming download of %(url)s at byte %(size)d.'),
+                         {'url': self.url, 'size': self._size})
+                return
+            if not self._can_restart():
+                self._resume_validator = None
+                msg = _('{url} could not be resumed and the data received was handed out already.')
+                raise aiohttp.ClientPayloadError(msg.format(url=self.url))
+            self._reset()
+            if response.status == 206:
+                self._resume_validator = None
+                msg = _('Unexpected Content-Range {range} for {url}.')
+                raise aiohttp.ClientPayloadError(msg.format(range=content_range, url=self.url))
+        self._response_headers = response.headers
+        self._resume_validator = None
+        if 'bytes' not in response.headers.get('Accept-Ranges', ''):
+            return
+        if response.headers.get('Content-Encoding', 'identity') != 'identity':
+            # The received (decoded) size does not match offsets in the encoded representation.
+            return
+        etag = response.headers.get('ETag')
+        if etag and not etag.startswith('W/'):
+            self._resume_validator = etag
+        else:
+            self._resume_validator = response.headers.get('Last-Modified')
+
+    def _check_content_length(self, response):
+        """
+        Abort the download before receiving the body if the response announces the wrong size.
+
+        For a full response the `Content-Length` header is checked, for a resumed one the complete
+        length in its `Content-Range` header. Responses with a `Content-Encoding` are not checked
+        because the headers refer to the encoded data.
+
+        Args:
+            response (aiohttp.ClientResponse): The response about to be handled.
+
+        Raises:
+            :class:`~pulpcore.exceptions.SizeValidationError`: When the announced size doesn't
+                match ``expected_size``.
+        """
+        if not self.expected_size:
+            return
+        if response.headers.get('Content-Encoding', 'identity') != 'identity':
+            return
+        if response.status == 206:
+            length = response.headers.get('Content-Range', '').rpartition('/')[2]
+        else:
+            length = response.headers.get('Content-Length', '')
+        if length.isdigit() and int(length) != self.expected_size:
+            raise SizeValidationError()
+
+    def _record_response(self, response, latency):
+        """
+        Report the response status and latency to an adaptive semaphore.
+
+        Args:
+            response (aiohttp.ClientResponse): The response to report.
+            latency (float): The number of seconds it took for the response headers to arrive.
+        """
+        if not isinstance(self.semaphore, AdaptiveConcurrencyLimiter):
+            return
+        if response.status == 429 or response.status >= 500:
+            self.semaphore.record_congestion()
+        else:
+            self.semaphore.record_latency(latency)
+
+    async def run(self, extra_data=None):
+        """
+        Run the downloader with concurrency restriction and retry logic.
+
+        Each attempt acquires `self.semaphore` through
+        :meth:`~pulpcore.plugin.download.BaseDownloader.run` and releases it when the attempt
+        fails, so slots are only held by requests on the wire and not by downloads waiting to
+        retry. Attempts failing with HTTP 429 and some 5XX errors, connection errors, or timeouts
+        are retried with exponential backoff and full jitter, or after the delay given by a
+        `Retry-After` header. After 10 attempts the final exception is raised.
+
+        Large files are downloaded in segments if ``segment_threshold`` is set, and files may be
+        taken from the ``cache``, see :class:`~pulpcore.plugin.download.HttpDownloader`.
+
+        Args:
+            extra_data (dict): Extra data passed to the downloader.
+
+        Returns:
+            :class:`~pulpcore.plugin.download.DownloadResult` from `_run()`.
+        """
+        if not self.cache:
+            return await self._download(extra_data)
+        try:
+            if self.expected_digests or not self.path:
+                return await self.cache.run(self, lambda: self._download(extra_data))
+            return await self._download_conditionally(extra_data)
+        finally:
+            if self._close_session_on_finalize and not self.session.closed:
+                await self.session.close()
+
+    async def _download_conditionally(self, extra_data=None):
+        """
+        Download the file, reusing the cached response if the server reports it unmodified.
+
+        Args:
+            extra_data (dict): Extra data passed to the downloader.
+
+        Returns:
+            :class:`~pulpcore.plugin.download.DownloadResult` from `_run()`.
+        """
+        loop = asyncio.get_event_loop()
+        self._cached_headers = await loop.run_in_executor(
+            None, self.cache.load_response, self.cache_scope, self.url)
+        result = await self._download(extra_data)
+        if not self._not_modified:
+            await loop.run_in_executor(None, self.cache.store_response, self.cache_scope,
+                                       self.url, result.path, result.headers)
+        return result
+
+    async def _handle_not_modified(self):
+        """
+        Handle a `304 Not Modified` response by using the cached response.
+
+        Returns:
+             DownloadResult: The result with the cached file and headers.
+
+        Raises:
+            aiohttp.ClientPayloadError: If the cached file was removed in the meantime. The retry
+                is not conditional.
+        """
+        headers = CIMultiDict(self._cached_headers)
+        retrieved = await asyncio.get_event_loop().run_in_executor(
+            None, self.cache.retrieve_response, self.cache_scope, self.url, self)
+        if not retrieved:
+            self._cached_headers = None
+            raise aiohttp.ClientPayloadError(_('The cached response was removed.'))
+        self._not_modified = True
+        if self.headers_ready_callback:
+            await self.headers_ready_callback(headers)
+        self._complete()
+        return DownloadResult(path=self.path, artifact_attributes=self.artifact_attributes,
+                              url=self.url, headers=headers)
+
+    async def _download(self, extra_data=None):
+        """
+        Download the file, in segments or as a single stream, retrying failed attempts.
+
+        Args:
+            extra_data (dict): Extra data passed to the downloader.
+
+        Returns:
+            :class:`~pulpcore.plugin.download.DownloadResult` from `_run()`.
+        """
+        if self._use_segments():
+            try:
+                return await self._run_segments()
+            except _RangeNotSupported:
+                log.info(_('%(url)s does not support range requests, downloading it as a single '
+                           'stream.'), {'url': self.url})
+                os.ftruncate(self._writer.fileno(), 0)
+                self._preallocate()
+
+        def prepare_retry():
+            return self._can_resume() or (self._can_restart() and self._reset())
+
+        return await self._retry(lambda: super(HttpDownloader, self).run(extra_data=extra_data),
+                                 prepare_retry)
+
+    async def _retry(self, attempt, prepare_retry):
+        """
+        Run `attempt` until it succeeds, retrying with backoff on retryable errors.
+
+        Args:
+            attempt (callable): A function returning a new coroutine for each attempt.
+            prepare_retry (callable): A function called after a failed attempt. It returns False
+                if the attempt cannot be retried.
+
+        Returns:
+            The result of the successful attempt.
+        """
+        tries = 0
+        while True:
+            tries += 1
+            try:
+                return await attempt()
+            except RETRY_EXCEPTIONS as exc:
+                if tries >= MAX_TRIES or http_giveup(exc) or not prepare_retry():
+                    raise
+                delay = _retry_after(exc)
+                if delay is None:
+                    delay = backoff.full_jitter(2 ** (tries - 1))
+                log.info(_('Retrying download of %(url)s in %(delay).1f seconds after: %(exc)r'),
+                         {'url': self.url, 'delay': delay, 'exc': exc})
+            await asyncio.sleep(delay)
 
-    @backoff.on_exception(backoff.expo, aiohttp.ClientResponseError,
-                          max_tries=10, giveup=http_giveup)
     async def _run(self, extra_data=None):
         """
         Download, validate, and compute digests on the `url`. This is a coroutine.
 
-        This method is decorated with a backoff-and-retry behavior to retry HTTP 429 and
-        some 5XX errors. It retries with exponential backoff 10 times before allowing
-        a final exception to be raised.
+        This method makes a single attempt. Retrying is handled by
+        :meth:`~pulpcore.plugin.download.HttpDownloader.run`.
 
         This method provides the same return object type and documented in
         :meth:`~pulpcore.plugin.download.BaseDownloader._run`.
@@ -179,10 +537,146 @@ class HttpDownloader(BaseDownloader):
         Args:
             extra_data (dict): Extra data passed by the downloader.
         """
-        async with self.session.get(self.url) as response:
+        headers = {}
+        if self._size:
+            headers['Range'] = 'bytes={}-'.format(self._size)
+            headers['If-Range'] = self._resume_validator
+        elif self._cached_headers:
+            if self._cached_headers.get('ETag'):
+                headers['If-None-Match'] = self._cached_headers['ETag']
+            if self._cached_headers.get('Last-Modified'):
+                headers['If-Modified-Since'] = self._cached_headers['Last-Modified']
+        loop = asyncio.get_event_loop()
+        start = loop.time()
+        async with self.session.get(self.url, headers=headers) as response:
+            self._record_response(response, loop.time() - start)
             response.raise_for_status()
-            to_return = await self._handle_response(response)
+            if response.status == 304 and self._cached_headers:
+                to_return = await self._handle_not_modified()
+            else:
+                self._check_resumed(response)
+                self._check_content_length(response)
+                to_return = await self._handle_response(response)
             await response.release()
         if self._close_session_on_finalize:
             await self.session.close()
         return to_return
+
+    def _use_segments(self):
+        """
+        Determine whether the file should be downloaded in segments.
+
+        Returns:
+            bool: True if the file is large enough and the downloader writes to its own file.
+        """
+        return bool(
+            self.segment_threshold and self.segment_count > 1 and self.path and
+            not self.headers_ready_callback and not self._cached_headers and self.expected_size and
+            self.expected_size >= self.segment_threshold
+        )
+
+    async def _run_segments(self):
+        """
+        Download the file in ``segment_count`` parallel segments, then compute its digests.
+
+        Returns:
+            :class:`~pulpcore.plugin.download.DownloadResult`
+
+        Raises:
+            _RangeNotSupported: If the server does not honour range requests. Nothing was handled
+                in this case and the file can be downloaded as a single stream.
+        """
+        size = self.expected_size
+        length = -(-size // self.segment_count)  # round up
+        fileno = self._writer.fileno()
+        headers = {}
+        tasks = [
+            asyncio.ensure_future(self._download_segment(fileno, start, min(start + length, size),
+                                                         headers))
+            for start in range(0, size, length)
+        ]
+        try:
+            done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+        finally:
+            for task in tasks:
+                task.cancel()
+        if pending:
+            await asyncio.wait(pending)
+        exceptions = [task.exception() for task in done if task.exception()]
+        for exc in exceptions:
+            if isinstance(exc, _RangeNotSupported):
+                raise exc
+        if exceptions:
+            raise exceptions[0]
+
+        def hash_file():
+            # This runs in another thread, so the buffer is not taken from the pool.
+            buffer = bytearray(chunk_size(self.expected_size))
+            view = memoryview(buffer)
+            with open(self.path, 'rb') as file:
+                while True:
+                    size = file.readinto(buffer)
+                    if not size:
+                        break
+                    self._record_size_and_digests_for_data(view[:size])
+
+        await asyncio.get_event_loop().run_in_executor(None, hash_file)
+        await self.finalize()
+        if self._close_session_on_finalize:
+            await self.session.close()
+        return DownloadResult(path=self.path, artifact_attributes=self.artifact_attributes,
+                              url=self.url, headers=headers)
+
+    async def _download_segment(self, fileno, start, end, headers):
+        """
+        Download the bytes from `start` up to, but excluding, `end` into the file at `fileno`.
+
+        Each attempt holds a slot of the `semaphore`. A retried attempt continues where the failed
+        one stopped.
+
+        Args:
+            fileno (int): The file descriptor of the preallocated file to write into.
+            start (int): The offset of the first byte of the segment.
+            end (int): The offset after the last byte of the segment.
+            headers (dict): Updated with the response headers of the first segment.
+
+        Raises:
+            _RangeNotSupported: If the server answers with the whole file.
+            :class:`~pulpcore.exceptions.SizeValidationError`: If the size of the file on the
+                server differs from ``expected_size``.
+        """
+        position = start
+
+        async def attempt():
+            nonlocal position
+            loop = asyncio.get_event_loop()
+            async with _SemaphoreSlot(self):
+                request_start = loop.time()
+                range_header = {'Range': 'bytes={}-{}'.format(position, end - 1)}
+                async with self.session.get(self.url, headers=range_header) as response:
+                    self._record_response(response, loop.time() - request_start)
+                    response.raise_for_status()
+                    if response.status != 206:
+                        raise _RangeNotSupported()
+                    total = response.headers.get('Content-Range', '').rpartition('/')[2]
+                    if total.isdigit() and int(total) != self.expected_size:
+                        raise SizeValidationError()
+                    if start == 0:
+                        headers.update(response.headers)
+                    segment_start = position
+                    while True:
+                        chunk = await response.content.readany()
+                        if not chunk:
+                            break
+                        if position + len(chunk) > end:
+                            raise aiohttp.ClientPayloadError(
+                                _('Received more data than requested.'))
+                        os.pwrite(fileno, chunk, position)
+                        position += len(chunk)
+                    await response.release()
+                if position != end:
+                    raise aiohttp.ClientPayloadError(_('Received less data than requested.'))
+                if isinstance(self.semaphore, AdaptiveConcurrencyLimiter):
+                    self.semaphore.record_success(position - segment_start)
+
+        await self._retry(attempt, lambda: True)
@@ -0,0 +1,263 @@
+import asyncio
+from collections import deque
+from gettext import gettext as _
+import logging
+
+
+log = logging.getLogger(__name__)
+
+
+class PrioritySemaphore:
+    """
+    A replacement for :class:`asyncio.Semaphore` which lets some coroutines go ahead of others.
+
+    Coroutines acquiring it with `priority` are woken up before all coroutines waiting without
+    it, and coroutines without `priority` don't take a free slot while one with `priority` waits.
+    Otherwise the waiters are woken up in the order they arrived.
+
+    It is used by the :class:`~pulpcore.plugin.download.DownloaderFactory`, so the downloads other
+    stages wait for aren't queued behind the bulk of a sync, see the ``priority`` of
+    :class:`~pulpcore.plugin.download.BaseDownloader`::
+
+        >>> semaphore = PrioritySemaphore(10)
+        >>> await semaphore.acquire(priority=True)
+        >>> try:
+        >>>     ...
+        >>> finally:
+        >>>     semaphore.release()
+
+    Args:
+        value (int): The number of coroutines allowed to hold the semaphore at the same time.
+    """
+
+    def __init__(self, value=1):
+        if value < 1:
+            raise ValueError(_('The limit must be at least 1.'))
+        self._limit = value
+        self._loop = asyncio.get_event_loop()
+        self._waiters = deque()
+        self._priority_waiters = deque()
+        self._in_flight = 0
+
+    @property
+    def limit(self):
+        """
+        The number of coroutines currently allowed to hold the semaphore at the same time.
+        """
+        return self._limit
+
+    @property
+    def in_flight(self):
+        """
+        The number of coroutines currently holding the semaphore.
+        """
+        return self._in_flight
+
+    def locked(self):
+        """
+        Returns True if the semaphore cannot be acquired immediately.
+        """
+        return self._in_flight >= self._limit
+
+    async def acquire(self, priority=False):
+        """
+        Acquire the semaphore, waiting until the number of holders is below the limit.
+
+        Args:
+            priority (bool): Whether to go ahead of the coroutines waiting without `priority`.
+                Defaults to False.
+
+        Returns:
+            True
+        """
+        waiters = self._priority_waiters if priority else self._waiters
+        while self._in_flight >= self._limit or (self._priority_waiters and not priority):
+            waiter = self._loop.create_future()
+            waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                # We might have been woken up for a free slot, pass it on.
+                self._wake_up()
+                raise
+            finally:
+                waiters.remove(waiter)
+        self._in_flight += 1
+        if priority:
+            # Waiters without priority were held back for this one, let them take what is left.
+            self._wake_up()
+        return True
+
+    def release(self):
+        """
+        Release the semaphore, waking up waiting coroutines if slots are available.
+        """
+        self._in_flight -= 1
+        self._wake_up()
+
+    async def __aenter__(self):
+        await self.acquire()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.release()
+
+    def _wake_up(self):
+        free = self._limit - self._in_flight
+        for waiters in (self._priority_waiters, self._waiters):
+            for waiter in waiters:
+                if free <= 0:
+                    return
+                if not waiter.done():
+                    waiter.set_result(None)
+                    free -= 1
+
+
+class AdaptiveConcurrencyLimiter(PrioritySemaphore):
+    """
+    A replacement for :class:`asyncio.Semaphore` whose limit adapts to how the server is coping.
+
+    The limit follows an additive-increase/multiplicative-decrease (AIMD) scheme:
+
+    * Completed downloads are grouped into rounds of `limit` downloads. When a round ends, its
+      throughput (bytes per second) is compared with the previous round. If it improved and the
+      round actually used all available slots, the limit is raised by `increase`.
+
+    * Congestion signals cut the limit to `limit * decrease_factor`. Congestion is either reported
+      explicitly with :meth:`record_congestion`, e.g. for an HTTP 429 or 5XX response, or detected
+      by :meth:`record_latency` when a response takes more than `latency_factor` times the average
+      response latency. After a cut, further signals are ignored until all requests started under
+      the previous limit are released, so one burst of errors only cuts the limit once.
+
+    The limit never leaves the range between `min_value` and `max_value`. The current limit is
+    available as :attr:`limit` for monitoring and every change is logged.
+
+    The limiter is a :class:`~pulpcore.plugin.download.PrioritySemaphore`, and can be used
+    everywhere an :class:`asyncio.Semaphore` is accepted, e.g. as the `semaphore` of a
+    :class:`~pulpcore.plugin.download.BaseDownloader`::
+
+        >>> limiter = AdaptiveConcurrencyLimiter(10)
+        >>> async with limiter:
+        >>>     ...  # at most `limiter.limit` coroutines run this block at the same time
+
+    Args:
+        value (int): The initial limit.
+        min_value (int): The lowest the limit can go. Defaults to 1.
+        max_value (int): The highest the limit can go. Defaults to None, which means unbounded.
+        increase (int): The amount the limit is raised by after an improving round. Defaults to 1.
+        decrease_factor (float): The factor the limit is multiplied by on congestion. Defaults to
+            0.5.
+        latency_factor (float): How many times the average latency a response may take before it
+            is considered congestion. Defaults to 3.0.
+    """
+
+    def __init__(self, value, min_value=1, max_value=None, increase=1, decrease_factor=0.5,
+                 latency_factor=3.0):
+        if value < 1:
+            raise ValueError(_('The initial limit must be at least 1.'))
+        self.min_value = min_value
+        self.max_value = max_value
+        self.increase = increase
+        self.decrease_factor = decrease_factor
+        self.latency_factor = latency_factor
+        super().__init__(self._clamp(value))
+        self._cooldown = 0
+        self._latency = None
+        self._throughput = None
+        self._start_round()
+
+    async def acquire(self, priority=False):
+        """
+        Acquire the limiter, waiting until the number of holders is below the current limit.
+
+        Args:
+            priority (bool): Whether to go ahead of the coroutines waiting without `priority`.
+                Defaults to False.
+
+        Returns:
+            True
+        """
+        if self.locked():
+            self._round_saturated = True
+        await super().acquire(priority)
+        if self._in_flight >= self._limit:
+            self._round_saturated = True
+        return True
+
+    def release(self):
+        """
+        Release the limiter, waking up waiting coroutines if slots are available.
+        """
+        if self._cooldown:
+            self._cooldown -= 1
+        super().release()
+
+    def record_success(self, size):
+        """
+        Record a successfully completed download.
+
+        Args:
+            size (int): The number of bytes downloaded.
+        """
+        self._round_bytes += size
+        self._round_count += 1
+        if self._round_count < self._limit:
+            return
+        elapsed = max(self._loop.time() - self._round_start, 1e-6)
+        throughput = self._round_bytes / elapsed
+        improved = self._throughput is None or throughput > self._throughput
+        if improved and self._round_saturated and not self._cooldown:
+            self._set_limit(self._limit + self.increase, _('throughput improved'))
+        self._throughput = throughput
+        self._start_round()
+
+    def record_latency(self, latency):
+        """
+        Record the latency of a response and cut the limit if it is a spike.
+
+        Args:
+            latency (float): The number of seconds until the response headers arrived.
+        """
+        if self._latency is None:
+            self._latency = latency
+            return
+        if latency > self._latency * self.latency_factor:
+            self._decrease(_('latency spike'))
+        # exponentially weighted moving average
+        self._latency = 0.9 * self._latency + 0.1 * latency
+
+    def record_congestion(self):
+        """
+        Record that the server signaled congestion, e.g. with an HTTP 429 or 5XX response.
+        """
+        self._decrease(_('server congestion'))
+
+    def _decrease(self, reason):
+        if self._cooldown:
+            return
+        self._set_limit(int(self._limit * self.decrease_factor), reason)
+        # The requests started under the old limit are still in flight and will probably report
+        # congestion too. Ignore them.
+        self._cooldown = self._in_flight
+        self._throughput = None
+        self._start_round()
+
+    def _set_limit(self, value, reason):
+        value = self._clamp(value)
+        if value == self._limit:
+            return
+        log.debug(_('Download concurrency changed from %(old)d to %(new)d: %(reason)s.'),
+                  {'old': self._limit, 'new': value, 'reason': reason})
+        self._limit = value
+        self._wake_up()
+
+    def _clamp(self, value):
+        value = max(value, self.min_value, 1)
+        if self.max_value:
+            value = min(value, self.max_value)
+        return value
+
+    def _start_round(self):
+        self._round_start = self._loop.time()
+        self._round_bytes = 0
+        self._round_count = 0
+        self._round_saturated = False
@@ -2,15 +2,27 @@ from .api import create_pipeline, EndStage, Stage  # noqa
 from .artifact_stages import (  # noqa
     ArtifactDownloader,
     ArtifactSaver,
+    ArtifactUpserter,
     QueryExistingArtifacts,
     RemoteArtifactSaver,
 )
 from .association_stages import (  # noqa
     ContentAssociation,
     ContentUnassociation,
-    RemoveDuplicates
+    RemoveDuplicates,
+    SkipExistingContent,
+)
+from .content_stages import (  # noqa
+    ContentSaver,
+    ContentUpserter,
+    DeduplicateContent,
+    QueryExistingContents,
+    ResolveContentFutures,
 )
-from .content_stages import ContentSaver, QueryExistingContents, ResolveContentFutures  # noqa
 from .declarative_version import DeclarativeVersion  # noqa
+from .digest_filter import DigestFilter  # noqa
+from .filesystem_stages import FileSystemImporter  # noqa
+from .lookup_cache import LookupCache  # noqa
 from .models import DeclarativeArtifact, DeclarativeContent  # noqa
 from .profiler import ProfilingQueue, create_profile_db_and_connection  # noqa
+from .upsert import bulk_upsert, upsert_supported  # noqa
@@ -1,9 +1,12 @@
 import asyncio
+import collections
+from concurrent.futures import ThreadPoolExecutor
 import logging
 
 from gettext import gettext as _
 
 from django.conf import settings
+from django.db import connection
 
 from .profiler import ProfilingQueue
 
@@ -21,6 +24,7 @@ class Stage:
     def __init__(self):
         self._in_q = None
         self._out_q = None
+        self._executor = None
 
     def _connect(self, in_q, out_q):
         """
@@ -144,6 +148,64 @@ class Stage:
                 batch = []
                 no_block = False
 
+    async def _handle_batches(self, handle, prefetch=False, minsize=50):
+        """
+        Call the coroutine function `handle` for each batch from :meth:`batches`.
+
+        `handle` is called with the batch and the task handling the previous batch, or None. It is
+        expected to query the db with :meth:`_evaluate`, and to await the previous task before
+        putting the items of its batch, so they stay in order.
+
+        With `prefetch`, the next batch is collected and handled while the previous one is still
+        being handled, e.g. waiting for a full `self._out_q`, and its queries are run in a thread.
+        This hides the db latency behind the downstream back-pressure. At most two batches are
+        handled at a time.
+
+        The worker thread has a db connection of its own, which is closed when the stage is done.
+        Its queries run outside of any transaction of the calling thread, so they don't see
+        objects saved by an uncommitted transaction, e.g. an ``atomic()`` block around the
+        pipeline.
+
+        Args:
+            handle (callable): A coroutine function taking a batch and the previous task.
+            prefetch (bool): Whether to overlap the handling of consecutive batches.
+            minsize (int): The minimum batch size, see :meth:`batches`.
+        """
+        if not prefetch:
+            async for batch in self.batches(minsize):
+                await handle(batch, None)
+            return
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        tasks = collections.deque()
+        try:
+            async for batch in self.batches(minsize):
+                tasks.append(asyncio.ensure_future(handle(batch, tasks[-1] if tasks else None)))
+                while len(tasks) > 1:
+                    await tasks.popleft()
+            while tasks:
+                await tasks.popleft()
+        finally:
+            for task in tasks:
+                task.cancel()
+            # The db connection of the thread is not closed by the request cycle.
+            self._executor.submit(connection.close)
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    async def _evaluate(self, queryset):
+        """
+        Return the list of objects of `queryset`, queried in a thread when prefetching.
+
+        Args:
+            queryset (:class:`django.db.models.query.QuerySet`): The queryset to evaluate.
+
+        Returns:
+            list: The objects of the queryset.
+        """
+        if self._executor is None:
+            return list(queryset)
+        return await asyncio.get_event_loop().run_in_executor(self._executor, list, queryset)
+
     async def put(self, item):
         """
         Coroutine to pass items to the next stage.
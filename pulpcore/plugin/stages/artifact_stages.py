@@ -1,15 +1,62 @@
 import asyncio
+import collections
+import ctypes
+import ctypes.util
 from gettext import gettext as _
 import logging
+import os
 
+from django.conf import settings
+from django.db import IntegrityError, connection
 from django.db.models import Q, Prefetch, prefetch_related_objects
 
 from pulpcore.plugin.models import Artifact, ContentArtifact, ProgressBar, RemoteArtifact
 
 from .api import Stage
+from .upsert import bulk_upsert, upsert_supported
 
 log = logging.getLogger(__name__)
 
+try:
+    _syncfs = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True).syncfs
+except (OSError, AttributeError):
+    _syncfs = None
+
+
+def _sync_files(paths):
+    """
+    Flush the files at `paths` to disk.
+
+    This uses one `syncfs` call per filesystem where available, and `fsync` on each file otherwise
+    or if `syncfs` fails.
+
+    Args:
+        paths (iterable): Paths of files.
+    """
+    paths_by_device = collections.defaultdict(list)
+    for path in paths:
+        # Files already in the Artifact storage are named relative to it.
+        path = os.path.join(settings.MEDIA_ROOT, path)
+        paths_by_device[os.stat(path).st_dev].append(path)
+    for paths in paths_by_device.values():
+        if _syncfs is not None:
+            fd = os.open(os.path.dirname(paths[0]), os.O_RDONLY)
+            try:
+                if _syncfs(fd) == 0:
+                    continue
+                error = ctypes.get_errno()
+            finally:
+                os.close(fd)
+            log.warning(_('Could not sync the filesystem of %(path)s: %(error)s. Syncing its '
+                          'files one by one instead.'),
+                        {'path': paths[0], 'error': os.strerror(error)})
+        for path in paths:
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
 
 class QueryExistingArtifacts(Stage):
     """
@@ -32,8 +79,32 @@ class QueryExistingArtifacts(Stage):
 
     This stage drains all available items from `self._in_q` and batches everything into one large
     call to the db for efficiency.
+
+    With `query_deferred` cleared, :class:`~pulpcore.plugin.stages.DeclarativeArtifact` objects
+    with `deferred_download` set are not looked up, which saves most of the queries when syncing
+    with a deferred download policy. Their content is then not related to matching
+    :class:`~pulpcore.plugin.models.Artifact` objects already in Pulp, but to the remote only.
+
+    Args:
+        query_deferred (bool): Whether to look up artifacts with `deferred_download` set.
+            Defaults to True.
+        cache (:class:`~pulpcore.plugin.stages.LookupCache`): A cache of saved Artifacts to
+            consult before querying the db, and to fill with the Artifacts found. Optional.
+        digest_filter (:class:`~pulpcore.plugin.stages.DigestFilter`): A filter of the digests of
+            existing Artifacts. Artifacts with a `sha256` not in the filter are not queried. It is
+            built when the stage starts, unless it was built before, in a thread with a db
+            connection of its own, so it only sees committed Artifacts. Optional.
+        prefetch (bool): Whether to query for the next batch in a thread while the previous one is
+            passed on. Defaults to False.
     """
 
+    def __init__(self, query_deferred=True, cache=None, digest_filter=None, prefetch=False):
+        super().__init__()
+        self.query_deferred = query_deferred
+        self.cache = cache
+        self.digest_filter = digest_filter
+        self.prefetch = prefetch
+
     async def run(self):
         """
         The coroutine for this stage.
@@ -41,24 +112,75 @@ class QueryExistingArtifacts(Stage):
         Returns:
             The coroutine for this stage.
         """
-        async for batch in self.batches():
-            all_artifacts_q = Q(_created=None)
-            for d_content in batch:
-                for d_artifact in d_content.d_artifacts:
-                    one_artifact_q = d_artifact.artifact.q()
-                    if one_artifact_q:
-                        all_artifacts_q |= one_artifact_q
-
-            for artifact in Artifact.objects.filter(all_artifacts_q):
-                for d_content in batch:
-                    for d_artifact in d_content.d_artifacts:
-                        for digest_name in artifact.DIGEST_FIELDS:
-                            digest_value = getattr(d_artifact.artifact, digest_name)
-                            if digest_value and digest_value == getattr(artifact, digest_name):
-                                d_artifact.artifact = artifact
-                                break
-            for d_content in batch:
-                await self.put(d_content)
+        if self.digest_filter and not self.digest_filter.built:
+            await self._build_digest_filter()
+        await self._handle_batches(self._handle_batch, self.prefetch)
+        if self.digest_filter:
+            log.info(_('The artifact digest filter reported %(positives)d possibly existing '
+                       'artifacts, %(false_positives)d of which did not exist.'),
+                     {'positives': self.digest_filter.positives,
+                      'false_positives': self.digest_filter.false_positives})
+
+    async def _build_digest_filter(self):
+        """
+        Build `self.digest_filter` in a thread, so streaming the digests doesn't block the loop.
+        """
+        def build():
+            try:
+                self.digest_filter.build()
+            finally:
+                # The db connection of the thread is not closed by the request cycle.
+                connection.close()
+
+        await asyncio.get_event_loop().run_in_executor(None, build)
+
+    async def _handle_batch(self, batch, previous):
+        """
+        Replace the artifacts of a batch with existing ones and pass the batch on.
+
+        Args:
+            batch (list): The :class:`~pulpcore.plugin.stages.DeclarativeContent` objects.
+            previous (:class:`asyncio.Task`): The task handling the previous batch, or None.
+        """
+        all_artifacts_q = Q(_created=None)
+        queried = []
+        for d_content in batch:
+            for d_artifact in d_content.d_artifacts:
+                if d_artifact.deferred_download and not self.query_deferred:
+                    continue
+                if self.cache and d_artifact.artifact._state.adding:
+                    cached = self.cache.get_artifact(d_artifact.artifact)
+                    if cached is not None:
+                        d_artifact.artifact = cached
+                        continue
+                if self.digest_filter and d_artifact.artifact._state.adding and \
+                        d_artifact.artifact.sha256:
+                    if d_artifact.artifact.sha256 not in self.digest_filter:
+                        continue
+                    self.digest_filter.positives += 1
+                one_artifact_q = d_artifact.artifact.q()
+                if one_artifact_q:
+                    all_artifacts_q |= one_artifact_q
+                    queried.append(d_artifact)
+
+        if queried:
+            for artifact in await self._evaluate(Artifact.objects.filter(all_artifacts_q)):
+                if self.cache:
+                    self.cache.add_artifact(artifact)
+                for d_artifact in queried:
+                    for digest_name in artifact.DIGEST_FIELDS:
+                        digest_value = getattr(d_artifact.artifact, digest_name)
+                        if digest_value and digest_value == getattr(artifact, digest_name):
+                            d_artifact.artifact = artifact
+                            break
+            if self.digest_filter:
+                self.digest_filter.false_positives += sum(
+                    1 for d_artifact in queried
+                    if d_artifact.artifact._state.adding and d_artifact.artifact.sha256)
+        if previous is not None:
+            await previous
+        for d_content in batch:
+            await self.put(d_content)
 
 
 class ArtifactDownloader(Stage):
@@ -79,19 +201,47 @@ class ArtifactDownloader(Stage):
     downloads completed. Since it's a stream the total count isn't known until it's finished.
 
     This stage drains all available items from `self._in_q` and starts as many downloaders as
-    possible (up to `download_concurrency` set on a Remote)
+    possible (up to `download_concurrency` set on a Remote). Content units with nothing to download,
+    e.g. with saved or deferred artifacts only, are passed on right away without taking a slot.
+
+    The downloads can be scheduled by the known `size` of the
+    :class:`~pulpcore.plugin.models.Artifact` objects. With `max_bytes_in_flight`, a content unit
+    is only started if the sizes of the downloads in progress and of its own downloads add up to at
+    most that many bytes, which bounds the disk space used by unfinished downloads. A unit whose
+    downloads are larger than the limit on their own is started once nothing else is in flight.
+    With `large_size`, units with at least that many bytes to download are alternated with smaller
+    ones, so a few large files don't take every slot while many small ones wait, and the large ones
+    don't all end up at the end of the sync. Downloads of unknown size count as 0 bytes.
+
+    Content units other stages wait for, i.e. with a `future` or with `does_batch` cleared, e.g.
+    the metadata a first stage needs to discover more content, take a priority lane. They are
+    started as soon as they are received, ahead of waiting units, and don't count against
+    `max_concurrent_content`. Their downloads also go ahead of the others waiting for the
+    remote's :class:`~pulpcore.plugin.download.PrioritySemaphore`. With `lookahead`, up to that
+    many units are received while all slots are taken, so units needing priority are found behind
+    units waiting for a slot.
 
     Args:
         max_concurrent_content (int): The maximum number of
             :class:`~pulpcore.plugin.stages.DeclarativeContent` instances to handle simultaneously.
             Default is 200.
+        max_bytes_in_flight (int): The maximum number of bytes downloaded simultaneously. Defaults
+            to None, meaning no limit.
+        large_size (int): The number of bytes from which a content unit counts as large and is
+            interleaved with smaller ones. Defaults to None, meaning units are started in the order
+            they arrive.
+        lookahead (int): The number of content units to receive ahead of free slots. Defaults to 0.
         args: unused positional arguments passed along to :class:`~pulpcore.plugin.stages.Stage`.
         kwargs: unused keyword arguments passed along to :class:`~pulpcore.plugin.stages.Stage`.
     """
 
-    def __init__(self, max_concurrent_content=200, *args, **kwargs):
+    def __init__(self, max_concurrent_content=200, max_bytes_in_flight=None, large_size=None,
+                 lookahead=0, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.max_concurrent_content = max_concurrent_content
+        self.lookahead = lookahead
+        self.max_bytes_in_flight = max_bytes_in_flight
+        self.large_size = large_size
 
     async def run(self):
         """
@@ -106,16 +256,77 @@ class ArtifactDownloader(Stage):
             pending.add(task)
             return task
 
+        def _start(d_content, size):
+            nonlocal bytes_in_flight
+            task = _add_to_pending(self._handle_content_unit(d_content))
+            sizes[task] = size
+            bytes_in_flight += size
+            return task
+
+        def _start_waiting():
+            nonlocal last_large
+            while (waiting or waiting_large) and \
+                    len(sizes) - len(priority) < self.max_concurrent_content:
+                if last_large or not waiting_large:
+                    queues = (waiting, waiting_large)
+                else:
+                    queues = (waiting_large, waiting)
+                for queue in queues:
+                    if queue and self._fits(queue[0][1], bytes_in_flight):
+                        _start(*queue.popleft())
+                        last_large = queue is waiting_large
+                        break
+                else:
+                    return
+
         #: (set): The set of unfinished tasks.  Contains the content
         #    handler tasks and may contain `content_get_task`.
         pending = set()
 
+        #: (dict): The number of bytes downloaded by each content handler task.
+        sizes = {}
+        bytes_in_flight = 0
+
+        #: (set): The content handler tasks of the priority lane.
+        priority = set()
+
+        #: (deque): Content units and their sizes not started yet, in the order they arrived.
+        #    Large units are kept in `waiting_large` if `large_size` is set.
+        waiting = collections.deque()
+        waiting_large = collections.deque()
+        last_large = False
+
         content_iterator = self.items()
 
         #: (:class:`asyncio.Task`): The task that gets new content from `self._in_q`.
         #    Set to None if stage is shutdown.
         content_get_task = _add_to_pending(content_iterator.__anext__())
 
+        def _receive(d_content):
+            if not any(self._needs_download(d_artifact) for d_artifact in d_content.d_artifacts):
+                passing.append(d_content)
+                return
+            size = self._download_size(d_content)
+            if self._has_priority(d_content):
+                priority.add(_start(d_content, size))
+            elif self.large_size is not None and size >= self.large_size:
+                waiting_large.append((d_content, size))
+            else:
+                waiting.append((d_content, size))
+
+        def _has_room():
+            return len(pending) - len(priority) + len(waiting) + len(waiting_large) < \
+                self.max_concurrent_content + self.lookahead
+
+        async def _dispatch():
+            _start_waiting()
+            for d_content in passing:
+                await self.put(d_content)
+            passing.clear()
+
+        #: (list): Content units with nothing to download, passed on without a task.
+        passing = []
+
         with ProgressBar(message='Downloading Artifacts') as pb:
             try:
                 while pending:
@@ -123,33 +334,82 @@ class ArtifactDownloader(Stage):
                     for task in done:
                         if task is content_get_task:
                             try:
-                                _add_to_pending(self._handle_content_unit(task.result()))
+                                _receive(task.result())
                             except StopAsyncIteration:
                                 # previous stage is finished and we retrieved all
                                 # content instances: shutdown
                                 content_get_task = None
                         else:
+                            bytes_in_flight -= sizes.pop(task)
+                            priority.discard(task)
                             pb.done += task.result()  # download_count
                             pb.save()
 
-                    if content_get_task and content_get_task not in pending:  # not yet shutdown
-                        if len(pending) < self.max_concurrent_content:
+                    while content_get_task and content_get_task not in pending:  # not yet shutdown
+                        await _dispatch()
+                        if not _has_room():
+                            break
+                        # Take what is available right away, to pass on units without downloads
+                        # in bulk instead of waiting for each of them.
+                        try:
+                            d_content = self._in_q.get_nowait()
+                        except asyncio.QueueEmpty:
                             content_get_task = _add_to_pending(content_iterator.__anext__())
+                        else:
+                            if d_content is None:
+                                content_get_task = None
+                            else:
+                                _receive(d_content)
+                    await _dispatch()
             except asyncio.CancelledError:
                 # asyncio.wait does not cancel its tasks when cancelled, we need to do this
                 for future in pending:
                     future.cancel()
                 raise
 
+    def _fits(self, size, bytes_in_flight):
+        """
+        Whether a content unit downloading `size` bytes may start next to `bytes_in_flight` bytes.
+        """
+        if self.max_bytes_in_flight is None or not size or not bytes_in_flight:
+            return True
+        return bytes_in_flight + size <= self.max_bytes_in_flight
+
+    def _download_size(self, d_content):
+        """
+        Return the number of bytes to download for a content unit, as far as they are known.
+
+        Returns:
+            int: The sum of the sizes of the artifacts to download, or 0 if the sizes are not used
+                for scheduling.
+        """
+        if self.max_bytes_in_flight is None and self.large_size is None:
+            return 0
+        return sum(d_artifact.artifact.size or 0 for d_artifact in d_content.d_artifacts
+                   if self._needs_download(d_artifact))
+
+    @staticmethod
+    def _has_priority(d_content):
+        """
+        Whether other stages wait for a content unit, so its downloads should go first.
+        """
+        return d_content.future is not None or not d_content.does_batch
+
+    @staticmethod
+    def _needs_download(d_artifact):
+        return (d_artifact.artifact._state.adding and not d_artifact.deferred_download and
+                not d_artifact.artifact.file)
+
     async def _handle_content_unit(self, d_content):
         """Handle one content unit.
 
         Returns:
             The number of downloads
         """
+        priority = self._has_priority(d_content)
         downloaders_for_content = [
-            d_artifact.download() for d_artifact in d_content.d_artifacts
-            if d_artifact.artifact._state.adding and not d_artifact.deferred_download
+            d_artifact.download(priority=priority) for d_artifact in d_content.d_artifacts
+            if self._needs_download(d_artifact)
         ]
         if downloaders_for_content:
             await asyncio.gather(*downloaders_for_content)
@@ -166,14 +426,27 @@ class ArtifactSaver(Stage):
     :class:`~pulpcore.plugin.stages.DeclarativeArtifact` object stores one
     :class:`~pulpcore.plugin.models.Artifact`.
 
-    Any unsaved :class:`~pulpcore.plugin.models.Artifact` objects are saved. Each
+    Any unsaved :class:`~pulpcore.plugin.models.Artifact` objects are saved. Before a batch is
+    saved, the filesystems of its files which are not synced yet, e.g. those of downloaders using
+    ``spool_size``, are synced to disk at once. Other files were synced by their downloaders. Each
     :class:`~pulpcore.plugin.stages.DeclarativeContent` is sent to `self._out_q` after all of its
     :class:`~pulpcore.plugin.stages.DeclarativeArtifact` objects have been handled.
 
     This stage drains all available items from `self._in_q` and batches everything into one large
     call to the db for efficiency.
+
+    Args:
+        cache (:class:`~pulpcore.plugin.stages.LookupCache`): A cache to add the saved Artifacts
+            to. Optional.
+        digest_filter (:class:`~pulpcore.plugin.stages.DigestFilter`): A filter to add the digests
+            of the saved Artifacts to, so later content units sharing them find them. Optional.
     """
 
+    def __init__(self, cache=None, digest_filter=None):
+        super().__init__()
+        self.cache = cache
+        self.digest_filter = digest_filter
+
     async def run(self):
         """
         The coroutine for this stage.
@@ -189,14 +462,68 @@ class ArtifactSaver(Stage):
                         d_artifact.artifact.file = str(d_artifact.artifact.file)
                         da_to_save.append(d_artifact)
 
+            unsynced = [d_artifact.artifact.file.name for d_artifact in da_to_save
+                        if not d_artifact.synced]
+            if unsynced:
+                await asyncio.get_event_loop().run_in_executor(None, _sync_files, unsynced)
             if da_to_save:
-                for d_artifact, artifact in zip(da_to_save, Artifact.objects.bulk_get_or_create(
-                        d_artifact.artifact for d_artifact in da_to_save)):
+                for d_artifact, artifact in zip(da_to_save, self._save_artifacts(
+                        [d_artifact.artifact for d_artifact in da_to_save])):
                     d_artifact.artifact = artifact
+                    if self.cache:
+                        self.cache.add_artifact(artifact)
+                    if self.digest_filter:
+                        self.digest_filter.add(artifact.sha256)
 
             for d_content in batch:
                 await self.put(d_content)
 
+    def _save_artifacts(self, artifacts):
+        """
+        Save the unsaved Artifacts, or get the existing ones with the same digests.
+
+        Args:
+            artifacts (list): The unsaved :class:`~pulpcore.plugin.models.Artifact` objects.
+
+        Returns:
+            list: The saved Artifacts, in the same order.
+        """
+        return Artifact.objects.bulk_get_or_create(artifacts)
+
+
+class ArtifactUpserter(ArtifactSaver):
+    """
+    An :class:`~pulpcore.plugin.stages.ArtifactSaver` inserting each batch of Artifacts with
+    :func:`~pulpcore.plugin.stages.bulk_upsert`.
+
+    Artifacts which exist already are matched by `sha256` and returned by the same statement,
+    instead of falling back to saving the Artifacts one by one as soon as one of them exists.
+    If the statement fails because of a concurrent insert, the batch is saved like
+    :class:`~pulpcore.plugin.stages.ArtifactSaver` does.
+
+    This requires a database backend for which
+    :func:`~pulpcore.plugin.stages.upsert_supported` is True.
+
+    Args:
+        cache (:class:`~pulpcore.plugin.stages.LookupCache`): A cache to add the saved Artifacts
+            to. Optional.
+        digest_filter (:class:`~pulpcore.plugin.stages.DigestFilter`): A filter to add the digests
+            of the saved Artifacts to, so later content units sharing them find them. Optional.
+        copy (bool): Whether to stream the Artifacts into the db with ``COPY``, see
+            :func:`~pulpcore.plugin.stages.bulk_upsert`. Defaults to False.
+    """
+
+    def __init__(self, cache=None, digest_filter=None, copy=False):
+        super().__init__(cache=cache, digest_filter=digest_filter)
+        self.copy = copy
+
+    def _save_artifacts(self, artifacts):
+        try:
+            return [artifact for artifact, created in bulk_upsert(Artifact, artifacts,
+                                                                  ('sha256',), copy=self.copy)]
+        except IntegrityError:
+            return super()._save_artifacts(artifacts)
+
 
 class RemoteArtifactSaver(Stage):
     """
@@ -204,8 +531,17 @@ class RemoteArtifactSaver(Stage):
 
     An :class:`~pulpcore.plugin.models.RemoteArtifact` object is saved for each
     :class:`~pulpcore.plugin.stages.DeclarativeArtifact`.
+
+    Args:
+        copy (bool): Whether to stream the RemoteArtifacts into the db with ``COPY`` where the
+            database backend supports it, see :func:`~pulpcore.plugin.stages.bulk_upsert`.
+            Defaults to False.
     """
 
+    def __init__(self, copy=False):
+        super().__init__()
+        self.copy = copy
+
     async def run(self):
         """
         The coroutine for this stage.
@@ -213,11 +549,23 @@ class RemoteArtifactSaver(Stage):
         Returns:
             The coroutine for this stage.
         """
+        copy = self.copy and upsert_supported()
         async for batch in self.batches():
-            RemoteArtifact.objects.bulk_get_or_create(self._needed_remote_artifacts(batch))
+            remote_artifacts = self._needed_remote_artifacts(batch)
+            if copy:
+                self._copy_remote_artifacts(remote_artifacts)
+            else:
+                RemoteArtifact.objects.bulk_get_or_create(remote_artifacts)
             for d_content in batch:
                 await self.put(d_content)
 
+    @staticmethod
+    def _copy_remote_artifacts(remote_artifacts):
+        try:
+            bulk_upsert(RemoteArtifact, remote_artifacts, ('content_artifact', 'remote'), copy=True)
+        except IntegrityError:
+            RemoteArtifact.objects.bulk_get_or_create(remote_artifacts)
+
     def _needed_remote_artifacts(self, batch):
         """
         Build a list of only :class:`~pulpcore.plugin.models.RemoteArtifact` that need
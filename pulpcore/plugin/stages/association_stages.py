@@ -1,3 +1,7 @@
+import json
+import time
+
+from django.db import connection
 from django.db.models import Q
 
 from pulpcore.plugin.models import Content, ProgressBar
@@ -13,19 +17,40 @@ class ContentAssociation(Stage):
     compute the units already associated but not received from `self._in_q`. These units are passed
     via `self._out_q` to the next stage as a :class:`django.db.models.query.QuerySet`.
 
+    The units to associate are buffered across batches, and added to `new_version` once
+    `chunk_size` of them are buffered, or `flush_interval` seconds after the first one was
+    buffered, whichever comes first. The units to unassociate are passed on in chunks of
+    `chunk_size` too, with the number of units of each chunk as its `known_count` attribute.
+
+    Stages before this one which query the content of `new_version`, like
+    :class:`~pulpcore.plugin.stages.RemoveDuplicates`, would miss the buffered units. Use a
+    `flush_interval` of 0 with them, which adds the units of each batch as it arrives.
+
     This stage creates a ProgressBar named 'Associating Content' that counts the number of units
     associated. Since it's a stream the total count isn't known until it's finished.
 
     Args:
         new_version (:class:`~pulpcore.plugin.models.RepositoryVersion`): The repo version this
             stage associates content with.
+        skipped_content (set): The primary keys of content units already associated with
+            `new_version` which earlier stages, e.g.
+            :class:`~pulpcore.plugin.stages.SkipExistingContent`, didn't pass on. They are treated
+            as received. The set may be filled while the pipeline runs. Optional.
+        chunk_size (int): The number of units to associate, or to pass on for unassociation, at
+            once. Defaults to 10000.
+        flush_interval (float): The number of seconds after which buffered units are associated,
+            even if there are fewer than `chunk_size`. Defaults to 10.
         args: unused positional arguments passed along to :class:`~pulpcore.plugin.stages.Stage`.
         kwargs: unused keyword arguments passed along to :class:`~pulpcore.plugin.stages.Stage`.
     """
 
-    def __init__(self, new_version, *args, **kwargs):
+    def __init__(self, new_version, skipped_content=None, chunk_size=10000, flush_interval=10,
+                 *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.new_version = new_version
+        self.skipped_content = skipped_content if skipped_content is not None else set()
+        self.chunk_size = chunk_size
+        self.flush_interval = flush_interval
 
     async def run(self):
         """
@@ -36,27 +61,144 @@ class ContentAssociation(Stage):
         """
         with ProgressBar(message='Associating Content') as pb:
             to_delete = set(self.new_version.content.values_list('pk', flat=True))
+            to_add = set()
+            deadline = None
             async for batch in self.batches():
-                to_add = set()
                 for d_content in batch:
                     try:
                         to_delete.remove(d_content.content.pk)
                     except KeyError:
                         to_add.add(d_content.content.pk)
 
-                if to_add:
-                    self.new_version.add_content(Content.objects.filter(pk__in=to_add))
-                    pb.done = pb.done + len(to_add)
-                    pb.save()
+                if to_add and deadline is None:
+                    deadline = time.monotonic() + self.flush_interval
+                if len(to_add) >= self.chunk_size or (to_add and time.monotonic() >= deadline):
+                    self._add_content(to_add, pb)
+                    to_add = set()
+                    deadline = None
+            if to_add:
+                self._add_content(to_add, pb)
+
+            to_delete = list(to_delete - self.skipped_content)
+            for i in range(0, len(to_delete), self.chunk_size):
+                chunk = to_delete[i:i + self.chunk_size]
+                queryset_to_unassociate = Content.objects.filter(pk__in=chunk)
+                # All of them are in the version, so ContentUnassociation needn't count them.
+                queryset_to_unassociate.known_count = len(chunk)
+                await self.put(queryset_to_unassociate)
+
+    def _add_content(self, pks, pb):
+        self.new_version.add_content(Content.objects.filter(pk__in=pks))
+        pb.done = pb.done + len(pks)
+        pb.save()
+
+
+class SkipExistingContent(Stage):
+    """
+    A Stages API stage that keeps content units already in `new_version` out of the pipeline.
+
+    On a resync, most content units are usually in the repository version already. This stage
+    recognizes them by their natural key and doesn't pass them on, so the artifact and content
+    stages don't look them up, download, or save anything for them. Instead, their primary keys are
+    added to `skipped_content`, which is given to the
+    :class:`~pulpcore.plugin.stages.ContentAssociation` stage to treat them as received.
 
-            if to_delete:
-                await self.put(Content.objects.filter(pk__in=to_delete))
+    The natural keys and primary keys of the content of `new_version` are loaded for each content
+    type when its first unit arrives. The values are compared as they are written to the db, so
+    e.g. a uuid given as a string matches the uuid loaded. Content units with a `future` are passed
+    on, since another stage waits for the saved unit.
+
+    Skipped units are not handled by the artifact stages or the
+    :class:`~pulpcore.plugin.stages.RemoteArtifactSaver`. If the remote, its download policy, or
+    the url of a unit changed since it was synced, no
+    :class:`~pulpcore.plugin.models.RemoteArtifact` is recorded for the new remote or url, and
+    the artifacts of units synced with a deferred download policy are not downloaded by an
+    immediate sync. Don't use this stage for syncs which should pick up such changes.
+
+    This stage is expected to be added by the
+    :class:`~pulpcore.plugin.stages.DeclarativeVersion`, right after the first stage.
+
+    Args:
+        new_version (:class:`~pulpcore.plugin.models.RepositoryVersion`): The repo version being
+            created, containing the content of the version it's based on.
+        args: unused positional arguments passed along to :class:`~pulpcore.plugin.stages.Stage`.
+        kwargs: unused keyword arguments passed along to :class:`~pulpcore.plugin.stages.Stage`.
+
+    Attributes:
+        skipped_content (set): The primary keys of the content units not passed on.
+    """
+
+    def __init__(self, new_version, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.new_version = new_version
+        self.skipped_content = set()
+        self._index = {}
+
+    async def run(self):
+        """
+        The coroutine for this stage.
+
+        Returns:
+            The coroutine for this stage.
+        """
+        async for d_content in self.items():
+            if d_content.future is None and d_content.content._state.adding:
+                pk = self._existing_pk(d_content.content)
+                if pk is not None:
+                    self.skipped_content.add(pk)
+                    continue
+            await self.put(d_content)
+
+    def _existing_pk(self, content):
+        """
+        Return the primary key of the unit in `new_version` with the natural key of `content`.
+        """
+        model_type = type(content)
+        fields = [model_type._meta.get_field(name) for name in model_type.natural_key_fields()]
+        if not fields:
+            return None
+        try:
+            index = self._index[model_type]
+        except KeyError:
+            index = self._index[model_type] = self._load_index(model_type, fields)
+        return index.get(_natural_key(fields, [getattr(content, field.attname)
+                                               for field in fields]))
+
+    def _load_index(self, model_type, fields):
+        """
+        Load the natural keys and primary keys of the units of `model_type` in `new_version`.
+        """
+        index = {}
+        units = model_type.objects.filter(pk__in=self.new_version.content)
+        for values in units.values_list('pk', *(field.attname for field in fields)).iterator():
+            index[_natural_key(fields, values[1:])] = values[0]
+        return index
+
+
+def _natural_key(fields, values):
+    """
+    Return a hashable key of the `values` of the `fields` as they are written to the db.
+    """
+    key = []
+    for field, value in zip(fields, values):
+        value = field.get_db_prep_value(value, connection)
+        value = getattr(value, 'adapted', value)  # e.g. the Json adapter of psycopg2
+        if isinstance(value, (dict, list)):
+            value = json.dumps(value, sort_keys=True, default=str)
+        elif isinstance(value, memoryview):
+            value = value.tobytes()
+        key.append(value)
+    return tuple(key)
 
 
 class ContentUnassociation(Stage):
     """
     A Stages API stage that unassociates content units from `new_version`.
 
+    The number of units unassociated is taken from the `known_count` attribute of the received
+    :class:`django.db.models.query.QuerySet`, set by the
+    :class:`~pulpcore.plugin.stages.ContentAssociation`, or counted with a query if it's missing.
+
     This stage creates a ProgressBar named 'Un-Associating Content' that counts the number of units
     un-associated. Since it's a stream the total count isn't known until it's finished.
 
@@ -81,7 +223,10 @@ class ContentUnassociation(Stage):
         with ProgressBar(message='Un-Associating Content') as pb:
             async for queryset_to_unassociate in self.items():
                 self.new_version.remove_content(queryset_to_unassociate)
-                pb.done = pb.done + queryset_to_unassociate.count()
+                count = getattr(queryset_to_unassociate, 'known_count', None)
+                if count is None:
+                    count = queryset_to_unassociate.count()
+                pb.done = pb.done + count
                 pb.save()
 
                 await self.put(queryset_to_unassociate)
@@ -1,4 +1,4 @@
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 
 from django.db import IntegrityError, transaction
 from django.db.models import Q
@@ -6,6 +6,7 @@ from django.db.models import Q
 from pulpcore.plugin.models import ContentArtifact
 
 from .api import Stage
+from .upsert import bulk_upsert
 
 
 class QueryExistingContents(Stage):
@@ -27,8 +28,19 @@ class QueryExistingContents(Stage):
 
     This stage drains all available items from `self._in_q` and batches everything into one large
     call to the db for efficiency.
+
+    Args:
+        cache (:class:`~pulpcore.plugin.stages.LookupCache`): A cache of saved Content units to
+            consult before querying the db, and to fill with the Content units found. Optional.
+        prefetch (bool): Whether to query for the next batch in a thread while the previous one is
+            passed on. Defaults to False.
     """
 
+    def __init__(self, cache=None, prefetch=False):
+        super().__init__()
+        self.cache = cache
+        self.prefetch = prefetch
+
     async def run(self):
         """
         The coroutine for this stage.
@@ -36,29 +48,49 @@ class QueryExistingContents(Stage):
         Returns:
             The coroutine for this stage.
         """
-        async for batch in self.batches():
-            content_q_by_type = defaultdict(lambda: Q(_created=None))
-            for d_content in batch:
-                model_type = type(d_content.content)
-                unit_q = d_content.content.q()
-                content_q_by_type[model_type] = content_q_by_type[model_type] | unit_q
-
-            for model_type in content_q_by_type.keys():
-                for result in model_type.objects.filter(content_q_by_type[model_type]):
-                    for d_content in batch:
-                        if type(d_content.content) is not model_type:
-                            continue
-                        not_same_unit = False
-                        for field in result.natural_key_fields():
-                            in_memory_digest_value = getattr(d_content.content, field)
-                            if in_memory_digest_value != getattr(result, field):
-                                not_same_unit = True
-                                break
-                        if not_same_unit:
-                            continue
-                        d_content.content = result
-            for d_content in batch:
-                await self.put(d_content)
+        await self._handle_batches(self._handle_batch, self.prefetch)
+
+    async def _handle_batch(self, batch, previous):
+        """
+        Replace the content of a batch with existing content and pass the batch on.
+
+        Args:
+            batch (list): The :class:`~pulpcore.plugin.stages.DeclarativeContent` objects.
+            previous (:class:`asyncio.Task`): The task handling the previous batch, or None.
+        """
+        content_q_by_type = defaultdict(lambda: Q(_created=None))
+        for d_content in batch:
+            if self.cache and d_content.content._state.adding:
+                cached = self.cache.get_content(d_content.content)
+                if cached is not None:
+                    d_content.content = cached
+                    continue
+            model_type = type(d_content.content)
+            unit_q = d_content.content.q()
+            content_q_by_type[model_type] = content_q_by_type[model_type] | unit_q
+
+        for model_type in content_q_by_type.keys():
+            results = await self._evaluate(
+                model_type.objects.filter(content_q_by_type[model_type]))
+            for result in results:
+                if self.cache:
+                    self.cache.add_content(result)
+                for d_content in batch:
+                    if type(d_content.content) is not model_type:
+                        continue
+                    not_same_unit = False
+                    for field in result.natural_key_fields():
+                        in_memory_digest_value = getattr(d_content.content, field)
+                        if in_memory_digest_value != getattr(result, field):
+                            not_same_unit = True
+                            break
+                    if not_same_unit:
+                        continue
+                    d_content.content = result
+        if previous is not None:
+            await previous
+        for d_content in batch:
+            await self.put(d_content)
 
 
 class ContentSaver(Stage):
@@ -78,8 +110,16 @@ class ContentSaver(Stage):
 
     This stage drains all available items from `self._in_q` and batches everything into one large
     call to the db for efficiency.
+
+    Args:
+        cache (:class:`~pulpcore.plugin.stages.LookupCache`): A cache to add the saved Content units
+            to. Optional.
     """
 
+    def __init__(self, cache=None):
+        super().__init__()
+        self.cache = cache
+
     async def run(self):
         """
         The coroutine for this stage.
@@ -88,38 +128,66 @@ class ContentSaver(Stage):
             The coroutine for this stage.
         """
         async for batch in self.batches():
-            content_artifact_bulk = []
             with transaction.atomic():
                 await self._pre_save(batch)
-                for d_content in batch:
-                    # Are we saving to the database for the first time?
-                    content_already_saved = not d_content.content._state.adding
-                    if not content_already_saved:
-                        try:
-                            with transaction.atomic():
-                                d_content.content.save()
-                        except IntegrityError:
-                            d_content.content = \
-                                d_content.content.__class__.objects.get(
-                                    d_content.content.q())
-                            continue
-                        for d_artifact in d_content.d_artifacts:
-                            if not d_artifact.artifact._state.adding:
-                                artifact = d_artifact.artifact
-                            else:
-                                # set to None for lazy synced artifacts
-                                artifact = None
-                            content_artifact = ContentArtifact(
-                                content=d_content.content,
-                                artifact=artifact,
-                                relative_path=d_artifact.relative_path
-                            )
-                            content_artifact_bulk.append(content_artifact)
-                ContentArtifact.objects.bulk_get_or_create(content_artifact_bulk)
+                self._save_batch(batch)
                 await self._post_save(batch)
+            if self.cache:
+                for d_content in batch:
+                    self.cache.add_content(d_content.content)
             for declarative_content in batch:
                 await self.put(declarative_content)
 
+    def _save_batch(self, batch):
+        """
+        Save the unsaved Content units of a batch and their ContentArtifacts.
+
+        Content units which turn out to exist already replace the unsaved ones.
+
+        Args:
+            batch (list of :class:`~pulpcore.plugin.stages.DeclarativeContent`): The batch of
+                :class:`~pulpcore.plugin.stages.DeclarativeContent` objects to be saved.
+        """
+        content_artifact_bulk = []
+        for d_content in batch:
+            # Are we saving to the database for the first time?
+            content_already_saved = not d_content.content._state.adding
+            if not content_already_saved:
+                try:
+                    with transaction.atomic():
+                        d_content.content.save()
+                except IntegrityError:
+                    d_content.content = \
+                        d_content.content.__class__.objects.get(
+                            d_content.content.q())
+                    continue
+                content_artifact_bulk.extend(self._content_artifacts(d_content))
+        self._save_content_artifacts(content_artifact_bulk)
+
+    def _save_content_artifacts(self, content_artifacts):
+        """
+        Save the unsaved ContentArtifacts, unless they exist already.
+
+        Args:
+            content_artifacts (list): The unsaved :class:`~pulpcore.plugin.models.ContentArtifact`
+                objects.
+        """
+        ContentArtifact.objects.bulk_get_or_create(content_artifacts)
+
+    @staticmethod
+    def _content_artifacts(d_content):
+        for d_artifact in d_content.d_artifacts:
+            if not d_artifact.artifact._state.adding:
+                artifact = d_artifact.artifact
+            else:
+                # set to None for lazy synced artifacts
+                artifact = None
+            yield ContentArtifact(
+                content=d_content.content,
+                artifact=artifact,
+                relative_path=d_artifact.relative_path
+            )
+
     async def _pre_save(self, batch):
         """
         A hook plugin-writers can override to save related objects prior to content unit saving.
@@ -147,6 +215,170 @@ class ContentSaver(Stage):
         pass
 
 
+class ContentUpserter(ContentSaver):
+    """
+    A Stages API stage replacing :class:`~pulpcore.plugin.stages.QueryExistingContents` and
+    :class:`~pulpcore.plugin.stages.ContentSaver` with one statement per content type and batch.
+
+    The unsaved :attr:`DeclarativeContent.content` objects of a batch are inserted with
+    :func:`~pulpcore.plugin.stages.bulk_upsert`, which matches them with the existing
+    Content units by their natural key and returns those in the same statement. Existing Content
+    units replace their unsaved counterparts, and
+    :class:`~pulpcore.plugin.models.ContentArtifact` objects are saved for the new ones.
+
+    Like ``bulk_create()``, this doesn't call ``save()`` on the Content units. Content types
+    without natural key fields, and batches failing because of a concurrent insert, are saved like
+    :class:`~pulpcore.plugin.stages.ContentSaver` does.
+
+    The :meth:`~pulpcore.plugin.stages.ContentSaver._pre_save` and
+    :meth:`~pulpcore.plugin.stages.ContentSaver._post_save` hooks are run as for
+    :class:`~pulpcore.plugin.stages.ContentSaver`. This requires a database backend for which
+    :func:`~pulpcore.plugin.stages.upsert_supported` is True.
+
+    With `copy`, the Content units and their ContentArtifacts are streamed into the db with
+    ``COPY``, which is faster for the large batches of initial syncs.
+
+    Args:
+        cache (:class:`~pulpcore.plugin.stages.LookupCache`): A cache of saved Content units to
+            consult before querying the db, and to fill with the saved Content units. Optional.
+        copy (bool): Whether to stream the objects into the db with ``COPY``, see
+            :func:`~pulpcore.plugin.stages.bulk_upsert`. Defaults to False.
+    """
+
+    def __init__(self, cache=None, copy=False):
+        super().__init__(cache=cache)
+        self.copy = copy
+
+    def _save_batch(self, batch):
+        d_contents_by_type = defaultdict(list)
+        for d_content in batch:
+            if not d_content.content._state.adding:
+                continue
+            if self.cache:
+                cached = self.cache.get_content(d_content.content)
+                if cached is not None:
+                    d_content.content = cached
+                    continue
+            d_contents_by_type[type(d_content.content)].append(d_content)
+
+        content_artifact_bulk = []
+        for model_type, d_contents in d_contents_by_type.items():
+            if not model_type.natural_key_fields():
+                super()._save_batch(d_contents)
+                continue
+            for d_content in d_contents:
+                if not d_content.content._type:
+                    d_content.content._type = '{app_label}.{type}'.format(
+                        app_label=model_type._meta.app_label, type=model_type.TYPE)
+            try:
+                results = bulk_upsert(model_type, [d_content.content for d_content in d_contents],
+                                      model_type.natural_key_fields(), copy=self.copy)
+            except IntegrityError:
+                super()._save_batch(d_contents)
+                continue
+            for d_content, (content, created) in zip(d_contents, results):
+                d_content.content = content
+                if created:
+                    content_artifact_bulk.extend(self._content_artifacts(d_content))
+        self._save_content_artifacts(content_artifact_bulk)
+
+    def _save_content_artifacts(self, content_artifacts):
+        if not self.copy:
+            return super()._save_content_artifacts(content_artifacts)
+        try:
+            bulk_upsert(ContentArtifact, content_artifacts, ('content', 'relative_path'),
+                        copy=True)
+        except IntegrityError:
+            super()._save_content_artifacts(content_artifacts)
+
+
+class DeduplicateContent(Stage):
+    """
+    A Stages API stage that drops repeated :class:`~pulpcore.plugin.stages.DeclarativeContent`
+    objects.
+
+    Upstream metadata often lists the same content unit several times. This stage passes on only
+    the first :class:`~pulpcore.plugin.stages.DeclarativeContent` with a given model and natural
+    key, so the other copies are neither looked up nor saved, and don't race the first one in the
+    :class:`~pulpcore.plugin.stages.ContentSaver`.
+
+    A copy is only dropped if each of its :class:`~pulpcore.plugin.stages.DeclarativeArtifact`
+    objects has the `relative_path`, `url` and `remote` of one of the first one. Otherwise it is
+    passed on, so the :class:`~pulpcore.plugin.stages.RemoteArtifactSaver` records its urls. The
+    first one may have moved on already, so its artifacts can't be extended instead.
+
+    The `future` of a dropped copy is resolved with the content of the first one. If the first one
+    was passed on without a `future`, a copy with a `future` is passed on too, since the first one
+    may have been resolved already.
+
+    The stage remembers the `max_size` most recently seen units. A copy of a unit seen longer ago
+    is passed on, and the following stages find the saved unit.
+
+    This stage is added by the :class:`~pulpcore.plugin.stages.DeclarativeVersion` with
+    `deduplicate_content`, near the front of the pipeline.
+
+    Args:
+        max_size (int): The maximum number of units to remember. Defaults to 10000.
+        args: unused positional arguments passed along to :class:`~pulpcore.plugin.stages.Stage`.
+        kwargs: unused keyword arguments passed along to :class:`~pulpcore.plugin.stages.Stage`.
+    """
+
+    def __init__(self, max_size=10000, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.max_size = max_size
+
+    async def run(self):
+        """
+        The coroutine for this stage.
+
+        Returns:
+            The coroutine for this stage.
+        """
+        #: (OrderedDict): The future of the first DeclarativeContent, or None, and the keys of its
+        #: artifacts, by model and natural key, least recently seen first.
+        seen = OrderedDict()
+        async for d_content in self.items():
+            try:
+                key = (type(d_content.content), d_content.content.natural_key())
+                artifacts = frozenset((d_artifact.relative_path, d_artifact.url, d_artifact.remote)
+                                      for d_artifact in d_content.d_artifacts)
+                first = seen.get(key)
+            except TypeError:
+                # e.g. a natural key containing an unsaved related object
+                await self.put(d_content)
+                continue
+            if first is None:
+                seen[key] = (d_content.future, artifacts)
+                if len(seen) > self.max_size:
+                    seen.popitem(last=False)
+                await self.put(d_content)
+                continue
+            seen.move_to_end(key)
+            first_future, first_artifacts = first
+            if not artifacts <= first_artifacts:
+                await self.put(d_content)
+            elif d_content.future is None:
+                continue
+            elif first_future is not None:
+                first_future.add_done_callback(self._resolver(d_content.future))
+            else:
+                await self.put(d_content)
+
+    @staticmethod
+    def _resolver(future):
+        """
+        Return a callback resolving `future` like the future it is added to.
+        """
+        def resolve(first_future):
+            if future.done():
+                return
+            if first_future.cancelled():
+                future.cancel()
+            else:
+                future.set_result(first_future.result())
+        return resolve
+
+
 class ResolveContentFutures(Stage):
     """
     This stage resolves the futures in :class:`~pulpcore.plugin.stages.DeclarativeContent`.
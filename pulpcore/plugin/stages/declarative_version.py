@@ -7,16 +7,32 @@ from .api import create_pipeline, EndStage
 from .artifact_stages import (
     ArtifactDownloader,
     ArtifactSaver,
+    ArtifactUpserter,
     QueryExistingArtifacts,
     RemoteArtifactSaver,
 )
-from .association_stages import ContentAssociation, ContentUnassociation, RemoveDuplicates
-from .content_stages import ContentSaver, QueryExistingContents, ResolveContentFutures
+from .association_stages import (
+    ContentAssociation,
+    ContentUnassociation,
+    RemoveDuplicates,
+    SkipExistingContent,
+)
+from .content_stages import (
+    ContentSaver,
+    ContentUpserter,
+    DeduplicateContent,
+    QueryExistingContents,
+    ResolveContentFutures,
+)
+from .lookup_cache import LookupCache
+from .upsert import upsert_supported
 
 
 class DeclarativeVersion:
 
-    def __init__(self, first_stage, repository, mirror=False, remove_duplicates=None):
+    def __init__(self, first_stage, repository, mirror=False, remove_duplicates=None,
+                 query_deferred_artifacts=True, digest_filter=None, skip_existing_content=False,
+                 upsert=False, copy=False, deduplicate_content=False, prefetch=False):
         """
         A pipeline that creates a new :class:`~pulpcore.plugin.models.RepositoryVersion` from a
         stream of :class:`~pulpcore.plugin.stages.DeclarativeContent` objects.
@@ -30,30 +46,42 @@ class DeclarativeVersion:
         1. Create the new :class:`~pulpcore.plugin.models.RepositoryVersion`
         2. Use the provided `first_stage` to construct
            :class:`~pulpcore.plugin.stages.DeclarativeContent`
-        3. Query existing artifacts to determine which are already local to Pulp with
+        3. Drop repeated :class:`~pulpcore.plugin.stages.DeclarativeContent` with
+           :class:`~pulpcore.plugin.stages.DeduplicateContent` (only when
+           deduplicate_content=True)
+        4. Keep content units already in the repository version out of the following stages with
+           :class:`~pulpcore.plugin.stages.SkipExistingContent` (only when
+           skip_existing_content=True)
+        5. Query existing artifacts to determine which are already local to Pulp with
            :class:`~pulpcore.plugin.stages.QueryExistingArtifacts`
-        4. Download any undownloaded :class:`~pulpcore.plugin.models.Artifact` objects with
+        6. Download any undownloaded :class:`~pulpcore.plugin.models.Artifact` objects with
            :class:`~pulpcore.plugin.stages.ArtifactDownloader`
-        5. Save the newly downloaded :class:`~pulpcore.plugin.models.Artifact` objects with
+        7. Save the newly downloaded :class:`~pulpcore.plugin.models.Artifact` objects with
            :class:`~pulpcore.plugin.stages.ArtifactSaver`
-        6. Query for Content units already present in Pulp with
+        8. Query for Content units already present in Pulp with
            :class:`~pulpcore.plugin.stages.QueryExistingContents`
-        7. Save new Content units not yet present in Pulp with
+        9. Save new Content units not yet present in Pulp with
            :class:`~pulpcore.plugin.stages.ContentSaver`
-        8. Attach :class:`~pulpcore.plugin.models.RemoteArtifact` to the
-           :class:`~pulpcore.plugin.models.Content` via
-           :class:`~pulpcore.plugin.stages.RemoteArtifactSaver`
-        9. Resolve the attached :class:`~asyncio.Future` of
-           :class:`~pulpcore.plugin.stages.DeclarativeContent` with
-           :class:`~pulpcore.plugin.stages.ResolveContentFutures`
-        10. Remove duplicate content in the repository version if `remove_duplicates` is given by
+        10. Attach :class:`~pulpcore.plugin.models.RemoteArtifact` to the
+            :class:`~pulpcore.plugin.models.Content` via
+            :class:`~pulpcore.plugin.stages.RemoteArtifactSaver`
+        11. Resolve the attached :class:`~asyncio.Future` of
+            :class:`~pulpcore.plugin.stages.DeclarativeContent` with
+            :class:`~pulpcore.plugin.stages.ResolveContentFutures`
+        12. Remove duplicate content in the repository version if `remove_duplicates` is given by
             :class:`~pulpcore.plugin.stages.RemoveDuplicates`
-        11. Associate all content units with the new
+        13. Associate all content units with the new
             :class:`~pulpcore.plugin.models.RepositoryVersion` with
             :class:`~pulpcore.plugin.stages.ContentAssociation`
-        12. Unassociate any content units not declared in the stream (only when mirror=True)
+        14. Unassociate any content units not declared in the stream (only when mirror=True)
             with :class:`~pulpcore.plugin.stages.ContentUnassociation`
 
+        With `upsert` on a database backend supporting it, the Artifacts are saved with
+        :class:`~pulpcore.plugin.stages.ArtifactUpserter` in step 7, and steps 8 and 9 are done
+        by :class:`~pulpcore.plugin.stages.ContentUpserter` in one statement per batch. With `copy`,
+        these stages and :class:`~pulpcore.plugin.stages.RemoteArtifactSaver` stream the rows into
+        the db with ``COPY``.
+
         To do this, the plugin writer should subclass the
         :class:`~pulpcore.plugin.stages.Stage` class and define its
         :meth:`run()` interface which returns a coroutine. This coroutine should
@@ -114,13 +142,50 @@ class DeclarativeVersion:
                 removed from the new version, making room for the new objects passing through the
                 pipeline. Each dict should have 2 keys, `model`, which is a subclass of
                 :class:`pulpcore.plugin.models.Content` and `field_names` which is a list of
-                strings corresponding to fields on the provided model.
+                strings corresponding to fields on the provided model. The content units are then
+                associated with the new version batch by batch, without buffering them.
+            query_deferred_artifacts (bool): Whether to look up existing
+                :class:`~pulpcore.plugin.models.Artifact` objects for
+                :class:`~pulpcore.plugin.stages.DeclarativeArtifact` objects with
+                `deferred_download` set. Clearing it saves most of the artifact queries when
+                syncing with a deferred download policy. See
+                :class:`~pulpcore.plugin.stages.QueryExistingArtifacts`. Defaults to True.
+            digest_filter (:class:`~pulpcore.plugin.stages.DigestFilter`): A filter of the digests
+                of existing Artifacts, to skip querying for Artifacts which don't exist, e.g. on
+                initial syncs. Optional.
+            skip_existing_content (bool): Whether content units already in the repository version
+                skip the artifact and content stages, which speeds up resyncs with few changes.
+                See :class:`~pulpcore.plugin.stages.SkipExistingContent`. Defaults to False.
+            upsert (bool): Whether to look up and save Artifacts and Content units with one
+                statement per batch where the database backend supports it, see
+                :func:`~pulpcore.plugin.stages.upsert_supported`. The Content units are not saved
+                with ``save()`` then. Defaults to False.
+            copy (bool): Like `upsert`, and stream the saved objects into the db with ``COPY``,
+                which speeds up initial syncs of large repositories. Other database backends use
+                the default stages. Defaults to False.
+            deduplicate_content (bool): Whether to drop repeated
+                :class:`~pulpcore.plugin.stages.DeclarativeContent` from the stream with
+                :class:`~pulpcore.plugin.stages.DeduplicateContent`, which saves lookups when the
+                upstream metadata lists units several times. Defaults to False.
+            prefetch (bool): Whether :class:`~pulpcore.plugin.stages.QueryExistingArtifacts` and
+                :class:`~pulpcore.plugin.stages.QueryExistingContents` query for the next batch in
+                a thread while the previous one waits for the following stages. The queries then
+                don't see objects saved by an uncommitted transaction of the caller. Defaults to
+                False.
 
         """
         self.first_stage = first_stage
         self.repository = repository
         self.mirror = mirror
         self.remove_duplicates = remove_duplicates or []
+        self.query_deferred_artifacts = query_deferred_artifacts
+        self.digest_filter = digest_filter
+        self.skip_existing_content = skip_existing_content
+        self.skipped_content = set()
+        self.upsert = upsert
+        self.copy = copy
+        self.deduplicate_content = deduplicate_content
+        self.prefetch = prefetch
 
     def pipeline_stages(self, new_version):
         """
@@ -130,6 +195,10 @@ class DeclarativeVersion:
         can be achieved by returning a list with different stages or by extending
         the list returned by this method.
 
+        The stages looking up and saving Artifacts and Content units share a new
+        :class:`~pulpcore.plugin.stages.LookupCache`, kept as `lookup_cache`, e.g. to report its
+        hit and miss counters.
+
         Args:
             new_version (:class:`~pulpcore.plugin.models.RepositoryVersion`): The
                 new repository version that is going to be built.
@@ -138,16 +207,33 @@ class DeclarativeVersion:
             list: List of :class:`~pulpcore.plugin.stages.Stage` instances
 
         """
-        pipeline = [
-            self.first_stage,
-            QueryExistingArtifacts(),
-            ArtifactDownloader(),
-            ArtifactSaver(),
-            QueryExistingContents(),
-            ContentSaver(),
-            RemoteArtifactSaver(),
-            ResolveContentFutures(),
-        ]
+        self.lookup_cache = LookupCache()
+        pipeline = [self.first_stage]
+        if self.deduplicate_content:
+            pipeline.append(DeduplicateContent())
+        if self.skip_existing_content:
+            skip_existing_content = SkipExistingContent(new_version)
+            self.skipped_content = skip_existing_content.skipped_content
+            pipeline.append(skip_existing_content)
+        pipeline.extend([
+            QueryExistingArtifacts(query_deferred=self.query_deferred_artifacts,
+                                   cache=self.lookup_cache, digest_filter=self.digest_filter,
+                                   prefetch=self.prefetch),
+            ArtifactDownloader(lookahead=200),
+        ])
+        if (self.upsert or self.copy) and upsert_supported():
+            pipeline.extend([
+                ArtifactUpserter(cache=self.lookup_cache, digest_filter=self.digest_filter,
+                                 copy=self.copy),
+                ContentUpserter(cache=self.lookup_cache, copy=self.copy),
+            ])
+        else:
+            pipeline.extend([
+                ArtifactSaver(cache=self.lookup_cache, digest_filter=self.digest_filter),
+                QueryExistingContents(cache=self.lookup_cache, prefetch=self.prefetch),
+                ContentSaver(cache=self.lookup_cache),
+            ])
+        pipeline.extend([RemoteArtifactSaver(copy=self.copy), ResolveContentFutures()])
         for dupe_query_dict in self.remove_duplicates:
             pipeline.extend([RemoveDuplicates(new_version, **dupe_query_dict)])
 
@@ -161,7 +247,13 @@ class DeclarativeVersion:
             with RepositoryVersion.create(self.repository) as new_version:
                 loop = asyncio.get_event_loop()
                 stages = self.pipeline_stages(new_version)
-                stages.append(ContentAssociation(new_version))
+                association_kwargs = {}
+                if self.remove_duplicates:
+                    # RemoveDuplicates only sees the units associated before, so none are buffered.
+                    association_kwargs['flush_interval'] = 0
+                stages.append(ContentAssociation(new_version,
+                                                 skipped_content=self.skipped_content,
+                                                 **association_kwargs))
                 if self.mirror:
                     stages.append(ContentUnassociation(new_version))
                 stages.append(EndStage())
@@ -0,0 +1,100 @@
+from gettext import gettext as _
+import logging
+import math
+
+from pulpcore.plugin.models import Artifact
+
+
+log = logging.getLogger(__name__)
+
+
+class DigestFilter:
+    """
+    A Bloom filter of the `sha256` digests of the :class:`~pulpcore.plugin.models.Artifact`
+    objects in Pulp.
+
+    The filter answers whether an Artifact with a digest may exist. If it says no, the Artifact
+    definitely doesn't exist and :class:`~pulpcore.plugin.stages.QueryExistingArtifacts` doesn't
+    need to query for it. This saves most of the artifact queries of an initial sync, where almost
+    none of the Artifacts exist yet.
+
+    The filter is built once, by :meth:`build`, streaming the digests from the db with a
+    server-side cursor. It uses at most `max_bytes` of memory however many Artifacts there are, at
+    the cost of a higher false-positive rate, i.e. more digests which are queried although they
+    don't exist. The expected rate is logged when the filter is built and available as
+    :attr:`expected_false_positive_rate`. The rate observed by the stages using the filter is
+    counted in `positives` and `false_positives`.
+
+    Artifacts saved by other tasks after the filter was built are not in it. Their files are
+    downloaded again, and the saving stage finds the existing Artifact.
+
+    Args:
+        max_bytes (int): The size of the filter in bytes. Defaults to 16 MiB, which keeps the
+            false-positive rate below 1% for up to 14 million Artifacts.
+
+    Attributes:
+        count (int): The number of digests added to the filter.
+        positives (int): The number of digests the filter reported as possibly existing.
+        false_positives (int): The number of those which turned out not to exist.
+    """
+
+    def __init__(self, max_bytes=16 * 2 ** 20):
+        self._bits = bytearray(max_bytes)
+        self._size = max_bytes * 8
+        self._hashes = 1
+        self.built = False
+        self.count = 0
+        self.positives = 0
+        self.false_positives = 0
+
+    def build(self):
+        """
+        Add the `sha256` digests of all Artifacts in the db to the filter.
+        """
+        expected = Artifact.objects.count()
+        # The number of hash functions giving the lowest false-positive rate.
+        self._hashes = max(1, min(16, round(self._size / max(expected, 1) * math.log(2))))
+        for digest in Artifact.objects.values_list('sha256', flat=True).iterator(chunk_size=10000):
+            self.add(digest)
+        self.built = True
+        log.info(_('Built the artifact digest filter with %(count)d digests, expected '
+                   'false-positive rate %(rate).4f.'),
+                 {'count': self.count, 'rate': self.expected_false_positive_rate})
+
+    @property
+    def expected_false_positive_rate(self):
+        """
+        The probability that the filter reports a digest it doesn't contain.
+        """
+        return (1 - math.exp(-self._hashes * self.count / self._size)) ** self._hashes
+
+    @property
+    def observed_false_positive_rate(self):
+        """
+        The share of `positives` which turned out not to exist, or None if there were none.
+        """
+        if not self.positives:
+            return None
+        return self.false_positives / self.positives
+
+    def add(self, digest):
+        """
+        Add a `sha256` digest to the filter.
+
+        Args:
+            digest (str): The hex digest.
+        """
+        for position in self._positions(digest):
+            self._bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, digest):
+        return all(self._bits[position >> 3] & (1 << (position & 7))
+                   for position in self._positions(digest))
+
+    def _positions(self, digest):
+        # The digest is uniformly distributed already, so two 64 bit slices of it serve as the
+        # base of the hash functions (Kirsch-Mitzenmacher double hashing).
+        first, second = int(digest[:16], 16), int(digest[16:32], 16) | 1
+        for i in range(self._hashes):
+            yield (first + i * second) % self._size
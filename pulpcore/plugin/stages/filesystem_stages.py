@@ -0,0 +1,200 @@
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import logging
+import os
+import tempfile
+
+from pulpcore.plugin.download.base import chunk_size
+from pulpcore.plugin.download.file import _link
+from pulpcore.plugin.models import Artifact, ProgressBar
+
+from .api import Stage
+from .models import DeclarativeArtifact
+
+log = logging.getLogger(__name__)
+
+
+def _scan_directory(path):
+    """
+    List the regular files and subdirectories of the directory at `path`.
+
+    Symlinks to files are followed, symlinks to directories are not, which avoids cycles.
+
+    Args:
+        path (str): The directory to list.
+
+    Returns:
+        tuple: A list of file paths and a list of subdirectory paths.
+    """
+    files = []
+    directories = []
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                directories.append(entry.path)
+            elif entry.is_file():
+                files.append(entry.path)
+    return files, directories
+
+
+def _import_file(path, working_directory, hardlink=False):
+    """
+    Place a file at `path` into `working_directory` and compute its Artifact attributes.
+
+    The file is reflinked, or with `hardlink` hardlinked, if possible and copied otherwise. This
+    runs in a worker process.
+
+    Args:
+        path (str): The file to import.
+        working_directory (str): The directory to place the file into.
+        hardlink (bool): Whether to hardlink the file where it can't be reflinked.
+
+    Returns:
+        tuple: The `path`, the path of the placed file, and a dict of
+            :class:`~pulpcore.plugin.models.Artifact` attributes.
+    """
+    fd, destination = tempfile.mkstemp(dir=working_directory)
+    os.close(fd)
+    os.unlink(destination)
+    linked = _link(path, destination, hardlink=hardlink)
+    digests = {n: hashlib.new(n) for n in Artifact.DIGEST_FIELDS}
+    size = 0
+    with open(destination if linked else path, 'rb') as source:
+        target = None if linked else open(destination, 'xb')
+        try:
+            buffer = bytearray(chunk_size(os.fstat(source.fileno()).st_size))
+            view = memoryview(buffer)
+            while True:
+                length = source.readinto(buffer)
+                if not length:
+                    break
+                for digest in digests.values():
+                    digest.update(view[:length])
+                if target:
+                    target.write(view[:length])
+                size += length
+        finally:
+            if target:
+                target.close()
+    attributes = {'size': size}
+    for name, digest in digests.items():
+        attributes[name] = digest.hexdigest()
+    return path, destination, attributes
+
+
+class FileSystemImporter(Stage):
+    """
+    A first stage building :class:`~pulpcore.plugin.stages.DeclarativeContent` from a local
+    directory tree.
+
+    The tree below `path` is walked with `os.scandir`. Each file is placed into the current working
+    directory, as a reflink if it shares a filesystem with it, and its digests are computed in a
+    pool of worker processes, so the import is not bound to one CPU. The resulting
+    :class:`~pulpcore.plugin.models.Artifact` is complete, so the
+    :class:`~pulpcore.plugin.stages.ArtifactDownloader` has nothing left to do for it, and the
+    files in `path` are left untouched.
+
+    With `hardlink`, files which can't be reflinked are hardlinked instead of copied. The
+    Artifacts then share their inodes with the files in `path`, so this is only safe if those files
+    are never modified in place.
+
+    For each file, `content_factory` is called with a
+    :class:`~pulpcore.plugin.stages.DeclarativeArtifact` for the file and returns the
+    :class:`~pulpcore.plugin.stages.DeclarativeContent` to send to `self._out_q`, or None to skip
+    the file. Its `relative_path` is the path of the file relative to `path` and its `url` is the
+    `file://` url of the file.
+
+    Use it instead of a plugin's first stage, e.g. by overriding
+    :meth:`~pulpcore.plugin.stages.DeclarativeVersion.pipeline_stages`::
+
+        >>> def content_factory(d_artifact):
+        >>>     content = MyContent(relative_path=d_artifact.relative_path,
+        >>>                         digest=d_artifact.artifact.sha256)
+        >>>     return DeclarativeContent(content=content, d_artifacts=[d_artifact])
+        >>>
+        >>> FileSystemImporter('/srv/mirror', remote, content_factory)
+
+    This stage creates a ProgressBar named 'Importing Files' that counts the number of files
+    imported.
+
+    Args:
+        path (str): The directory to import the files from.
+        remote (:class:`~pulpcore.plugin.models.Remote`): The remote the
+            :class:`~pulpcore.plugin.stages.DeclarativeArtifact` objects are associated with.
+        content_factory (callable): Called with a
+            :class:`~pulpcore.plugin.stages.DeclarativeArtifact` and returning a
+            :class:`~pulpcore.plugin.stages.DeclarativeContent` or None.
+        processes (int): The number of worker processes. Defaults to the number of CPUs.
+        hardlink (bool): Whether to hardlink the files which can't be reflinked. Defaults to False.
+        args: unused positional arguments passed along to :class:`~pulpcore.plugin.stages.Stage`.
+        kwargs: unused keyword arguments passed along to :class:`~pulpcore.plugin.stages.Stage`.
+    """
+
+    def __init__(self, path, remote, content_factory, processes=None, hardlink=False, *args,
+                 **kwargs):
+        super().__init__(*args, **kwargs)
+        self.path = os.path.abspath(path)
+        self.remote = remote
+        self.content_factory = content_factory
+        self.processes = processes or os.cpu_count() or 1
+        self.hardlink = hardlink
+
+    async def run(self):
+        """
+        The coroutine for this stage.
+
+        Returns:
+            The coroutine for this stage.
+        """
+        loop = asyncio.get_event_loop()
+        working_directory = os.getcwd()
+        # Keep every worker busy while results are handled, without queueing the whole tree.
+        max_pending = 2 * self.processes
+        pending = set()
+        directories = [self.path]
+        with ProgressBar(message='Importing Files') as pb, \
+                ProcessPoolExecutor(max_workers=self.processes) as executor:
+            try:
+                while directories:
+                    files, subdirectories = await loop.run_in_executor(
+                        None, _scan_directory, directories.pop())
+                    directories.extend(subdirectories)
+                    for path in files:
+                        if len(pending) >= max_pending:
+                            done, pending = await asyncio.wait(
+                                pending, return_when=asyncio.FIRST_COMPLETED)
+                            await self._handle_imported(done, pb)
+                        pending.add(loop.run_in_executor(
+                            executor, _import_file, path, working_directory, self.hardlink))
+                if pending:
+                    done, pending = await asyncio.wait(pending)
+                    await self._handle_imported(done, pb)
+            except asyncio.CancelledError:
+                for future in pending:
+                    future.cancel()
+                raise
+
+    async def _handle_imported(self, done, pb):
+        """
+        Send the content for the imported files of the `done` futures to `self._out_q`.
+
+        Args:
+            done (set): Finished futures of :func:`_import_file`.
+            pb (:class:`~pulpcore.plugin.models.ProgressBar`): The progress bar to update.
+        """
+        for future in done:
+            source, path, attributes = future.result()
+            d_artifact = DeclarativeArtifact(
+                artifact=Artifact(file=path, **attributes),
+                url='file://' + source,
+                relative_path=os.path.relpath(source, self.path),
+                remote=self.remote,
+                synced=False,
+            )
+            d_content = self.content_factory(d_artifact)
+            if d_content is not None:
+                await self.put(d_content)
+        # One save per batch of imported files, rather than one per file.
+        pb.done += len(done)
+        pb.save()
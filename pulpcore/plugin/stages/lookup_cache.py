@@ -0,0 +1,157 @@
+from collections import OrderedDict
+
+
+class LookupCache:
+    """
+    A bounded cache of saved :class:`~pulpcore.plugin.models.Artifact` and
+    :class:`~pulpcore.plugin.models.Content` objects shared by the stages of one pipeline.
+
+    Within a sync, the same Artifact or Content unit often shows up in many batches, e.g. files
+    shared by several content units or duplicate entries in the upstream metadata. The stages
+    looking up and saving these objects fill the cache, and consult it before querying the
+    database. Artifacts are found by any of their digests, Content units by their model and
+    natural key. When the cache holds more than `max_size` Artifacts or Content units, the least
+    recently used ones are dropped.
+
+    The cache hands out copies of the cached objects, so stages setting attributes on them don't
+    affect each other.
+
+    Example:
+        >>> cache = LookupCache()
+        >>> pipeline = [
+        >>>     first_stage,
+        >>>     QueryExistingArtifacts(cache=cache),
+        >>>     ArtifactDownloader(),
+        >>>     ArtifactSaver(cache=cache),
+        >>>     QueryExistingContents(cache=cache),
+        >>>     ContentSaver(cache=cache),
+        >>>     ...
+        >>> ]
+
+    Args:
+        max_size (int): The maximum number of Artifacts, and of Content units, to keep. Defaults
+            to 10000.
+
+    Attributes:
+        artifact_hits (int): The number of Artifacts found in the cache.
+        artifact_misses (int): The number of Artifacts looked up but not found in the cache.
+        content_hits (int): The number of Content units found in the cache.
+        content_misses (int): The number of Content units looked up but not found in the cache.
+    """
+
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self._artifacts = OrderedDict()
+        # The pk of the cached Artifact for each digest, so an Artifact counts once.
+        self._artifact_pks = {}
+        self._contents = OrderedDict()
+        self.artifact_hits = 0
+        self.artifact_misses = 0
+        self.content_hits = 0
+        self.content_misses = 0
+
+    def get_artifact(self, artifact):
+        """
+        Return the saved Artifact with a digest of the unsaved `artifact`.
+
+        Args:
+            artifact (:class:`~pulpcore.plugin.models.Artifact`): An unsaved Artifact.
+
+        Returns:
+            :class:`~pulpcore.plugin.models.Artifact`: A copy of the saved Artifact, or None if it
+                is not in the cache.
+        """
+        for key in self._digest_keys(artifact):
+            pk = self._artifact_pks.get(key)
+            cached = self._get(self._artifacts, pk) if pk is not None else None
+            if cached is not None:
+                self.artifact_hits += 1
+                return cached
+        self.artifact_misses += 1
+        return None
+
+    def add_artifact(self, artifact):
+        """
+        Add a saved Artifact to the cache.
+
+        Args:
+            artifact (:class:`~pulpcore.plugin.models.Artifact`): A saved Artifact.
+        """
+        keys = self._digest_keys(artifact)
+        if not keys:
+            return
+        for key in keys:
+            self._artifact_pks[key] = artifact.pk
+        for dropped in self._add(self._artifacts, artifact.pk, artifact):
+            for key in self._digest_keys(dropped):
+                if self._artifact_pks.get(key) == dropped.pk:
+                    del self._artifact_pks[key]
+
+    def get_content(self, content):
+        """
+        Return the saved Content unit with the model and natural key of the unsaved `content`.
+
+        Args:
+            content (:class:`~pulpcore.plugin.models.Content`): An unsaved Content unit.
+
+        Returns:
+            :class:`~pulpcore.plugin.models.Content`: A copy of the saved Content unit, or None if
+                it is not in the cache.
+        """
+        key = self._content_key(content)
+        cached = self._get(self._contents, key) if key else None
+        if cached is None:
+            self.content_misses += 1
+        else:
+            self.content_hits += 1
+        return cached
+
+    def add_content(self, content):
+        """
+        Add a saved Content unit to the cache.
+
+        Args:
+            content (:class:`~pulpcore.plugin.models.Content`): A saved Content unit.
+        """
+        key = self._content_key(content)
+        if key:
+            self._add(self._contents, key, content)
+
+    @staticmethod
+    def _digest_keys(artifact):
+        return [(digest_name, getattr(artifact, digest_name))
+                for digest_name in artifact.DIGEST_FIELDS if getattr(artifact, digest_name)]
+
+    @staticmethod
+    def _content_key(content):
+        key = (type(content), content.natural_key())
+        try:
+            hash(key)
+        except TypeError:
+            # e.g. a natural key containing an unsaved related object
+            return None
+        return key
+
+    def _get(self, entries, key):
+        try:
+            instance = entries[key]
+        except KeyError:
+            return None
+        entries.move_to_end(key)
+        fields = instance._meta.concrete_fields
+        return instance.from_db(instance._state.db, [field.attname for field in fields],
+                                [getattr(instance, field.attname) for field in fields])
+
+    def _add(self, entries, key, instance):
+        """
+        Add the `instance` to the `entries` and drop the least recently used ones over `max_size`.
+
+        Returns:
+            list: The dropped instances.
+        """
+        entries[key] = instance
+        entries.move_to_end(key)
+        dropped = []
+        while len(entries) > self.max_size:
+            dropped.append(entries.popitem(last=False)[1])
+        return dropped
@@ -1,10 +1,79 @@
 from gettext import gettext as _
 
 import asyncio
+import os
+import tempfile
 
+from django.conf import settings
+
+from pulpcore.exceptions import DigestValidationError, SizeValidationError
+from pulpcore.plugin.download.cache import _link_or_copy
 from pulpcore.plugin.models import Artifact
 
 
+class _Flight:
+    """
+    A download shared by all :class:`DeclarativeArtifact` objects waiting for the same file.
+
+    The download runs as its own task, so it goes on as long as anybody waits for it, and is
+    cancelled once all of them are cancelled.
+
+    Args:
+        key (tuple): The key of the flight in `_flights`.
+        downloader (:class:`~pulpcore.plugin.download.BaseDownloader`): The downloader.
+        coro (coroutine): The download, returning a
+            :class:`~pulpcore.plugin.download.DownloadResult`.
+    """
+
+    def __init__(self, key, downloader, coro):
+        self.key = key
+        self.downloader = downloader
+        # Whether the file is downloaded into the Artifact storage, so it can be shared as is.
+        self.in_storage = getattr(downloader, 'artifact_storage', False)
+        # Whether the downloader syncs the file to disk itself.
+        self.synced = not getattr(downloader, 'spool_size', None)
+        self.waiters = 0
+        self.task = asyncio.ensure_future(coro)
+        self.task.add_done_callback(self._land)
+
+    async def wait(self):
+        """
+        Wait for the download and return its result with a file of its own.
+
+        Returns:
+            :class:`~pulpcore.plugin.download.DownloadResult`
+        """
+        self.waiters += 1
+        try:
+            result = await asyncio.shield(self.task)
+        except asyncio.CancelledError:
+            self.waiters -= 1
+            if not self.waiters and not self.task.done():
+                self.task.cancel()
+            raise
+        self.waiters -= 1
+        if self.in_storage or not self.waiters:
+            return result
+        # Saving an Artifact moves its file, so all but the last waiter get a link or, where the
+        # filesystem supports no links, a copy of their own.
+        fd, path = tempfile.mkstemp(dir=os.path.dirname(result.path))
+        os.close(fd)
+        os.unlink(path)
+        await asyncio.get_event_loop().run_in_executor(None, _link_or_copy, result.path, path)
+        return result._replace(path=path)
+
+    def _land(self, task):
+        """
+        Stop other artifacts from joining the flight once the download is done.
+        """
+        if _flights.get(self.key) is self:
+            del _flights[self.key]
+
+
+#: The downloads in progress in this process, keyed by expected digest or by remote and url.
+_flights = {}
+
+
 class DeclarativeArtifact:
     """
     Relates an :class:`~pulpcore.plugin.models.Artifact`, how to download it, and its
@@ -28,15 +97,20 @@ class DeclarativeArtifact:
         extra_data (dict): A dictionary available for additional data to be stored in.
         deferred_download (bool): Whether this artifact should be downloaded and saved
             in the artifact stages. Defaults to `False`. See :ref:`lazy-support`.
+        synced (bool): Whether the file of `artifact` is synced to disk. If not, the
+            :class:`~pulpcore.plugin.stages.ArtifactSaver` syncs it before saving the artifact.
+            :meth:`download` clears it for files of downloaders with ``spool_size``, which don't
+            sync them. Defaults to `True`.
 
     Raises:
         ValueError: If `artifact`, `url`, `relative_path`, or `remote` are not specified.
     """
 
-    __slots__ = ('artifact', 'url', 'relative_path', 'remote', 'extra_data', 'deferred_download')
+    __slots__ = ('artifact', 'url', 'relative_path', 'remote', 'extra_data', 'deferred_download',
+                 'synced')
 
     def __init__(self, artifact=None, url=None, relative_path=None, remote=None, extra_data=None,
-                 deferred_download=False):
+                 deferred_download=False, synced=True):
         if not url:
             raise ValueError(_("DeclarativeArtifact must have a 'url'"))
         if not relative_path:
@@ -51,11 +125,23 @@ class DeclarativeArtifact:
         self.remote = remote
         self.extra_data = extra_data or {}
         self.deferred_download = deferred_download
+        self.synced = synced
 
-    async def download(self):
+    async def download(self, priority=False):
         """
         Download content and update the associated Artifact.
 
+        Concurrent downloads of the same file in this process, e.g. by several content units or
+        pipelines sharing an Artifact, are coalesced into one. The file is identified by the
+        strongest expected digest, or by the remote, url, and expected size if no digest is
+        expected. Every artifact gets a file of its own and is validated against its own
+        expectations.
+
+        Args:
+            priority (bool): Whether the download goes ahead of the downloads of the remote
+                waiting without priority. Joining a download started without priority gives it
+                priority from its next request on. Defaults to False.
+
         Returns:
             Returns the :class:`~pulpcore.plugin.download.DownloadResult` of the Artifact.
         """
@@ -70,18 +156,73 @@ class DeclarativeArtifact:
         if self.artifact.size:
             expected_size = self.artifact.size
             validation_kwargs['expected_size'] = expected_size
-        downloader = self.remote.get_downloader(
-            url=self.url,
-            **validation_kwargs
-        )
-        # Custom downloaders may need extra information to complete the request.
-        download_result = await downloader.run(extra_data=self.extra_data)
+        key = self._flight_key(expected_digests)
+        flight = _flights.get(key)
+        joined = flight is not None
+        if not joined:
+            downloader = self.remote.get_downloader(
+                url=self.url,
+                **validation_kwargs
+            )
+            flight = _flights[key] = _Flight(key, downloader, self._run(downloader))
+        if priority:
+            flight.downloader.priority = True
+        download_result = await flight.wait()
+        # A link or copy of the shared file is not synced.
+        self.synced = flight.synced and download_result.path == flight.task.result().path
+        if joined:
+            self._validate(download_result.artifact_attributes, expected_digests)
+        path = download_result.path
+        if flight.in_storage:
+            # The file is in the Artifact storage already, refer to it by its storage name.
+            path = os.path.relpath(path, settings.MEDIA_ROOT)
         self.artifact = Artifact(
             **download_result.artifact_attributes,
-            file=download_result.path
+            file=path
         )
         return download_result
 
+    def _flight_key(self, expected_digests):
+        """
+        Return the key identifying downloads of the same file.
+
+        Args:
+            expected_digests (dict): The digests expected for the artifact.
+
+        Returns:
+            tuple: The strongest expected digest, or the remote, url, and expected size.
+        """
+        for digest_name in self.artifact.DIGEST_FIELDS:
+            if digest_name in expected_digests:
+                return (digest_name, expected_digests[digest_name])
+        return (self.remote.pk, self.url, self.artifact.size)
+
+    async def _run(self, downloader):
+        """
+        Run the `downloader`, removing its file from the Artifact storage if it fails.
+        """
+        try:
+            # Custom downloaders may need extra information to complete the request.
+            return await downloader.run(extra_data=self.extra_data)
+        except Exception:
+            if getattr(downloader, 'artifact_storage', False):
+                downloader._discard()
+            raise
+
+    def _validate(self, artifact_attributes, expected_digests):
+        """
+        Validate a download shared with other artifacts against the expectations of this one.
+
+        Raises:
+            :class:`~pulpcore.exceptions.DigestValidationError`: When a digest doesn't match.
+            :class:`~pulpcore.exceptions.SizeValidationError`: When the size doesn't match.
+        """
+        for digest_name, digest_value in expected_digests.items():
+            if artifact_attributes[digest_name] != digest_value:
+                raise DigestValidationError()
+        if self.artifact.size and artifact_attributes['size'] != self.artifact.size:
+            raise SizeValidationError()
+
 
 class DeclarativeContent:
     """
@@ -0,0 +1,200 @@
+import datetime
+from decimal import Decimal
+import io
+from uuid import UUID
+
+from django.db import connection, IntegrityError, transaction
+
+try:
+    from psycopg2.extras import Json
+except ImportError:
+    Json = None
+
+
+# The characters escaped in the text format of COPY.
+_COPY_ESCAPES = str.maketrans({'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r'})
+_COPY_TYPES = (str, int, float, Decimal, UUID, datetime.date, datetime.time)
+
+
+def upsert_supported():
+    """
+    Whether the database backend supports :func:`bulk_upsert`.
+
+    Returns:
+        bool: True on PostgreSQL, which supports data-modifying ``WITH`` queries and
+            ``INSERT ... ON CONFLICT DO NOTHING RETURNING``.
+    """
+    return connection.vendor == 'postgresql'
+
+
+def bulk_upsert(model, objs, key_fields, copy=False):
+    """
+    Save the unsaved `objs` and get the existing ones matching them with a single statement.
+
+    The objects are matched with the rows in the db by the fields in `key_fields`, which have to
+    be unique together. A NULL value matches a NULL in the db. Objects which don't exist yet are
+    inserted into the tables of `model` and its concrete parents, e.g. the master and detail tables
+    of a :class:`~pulpcore.plugin.models.Content` model. Like ``bulk_create()``, this calls the
+    ``pre_save()`` of the fields, but not ``save()`` on the objects, and doesn't send signals.
+
+    With `copy`, the objects are streamed with ``COPY ... FROM STDIN`` into a temporary staging
+    table first, which is much faster than passing them as query parameters for large batches,
+    e.g. on initial syncs of large repositories. The staging table is then merged into the tables
+    of `model` with the same statement. Objects with values which can't be written in the text
+    format of ``COPY`` are passed as query parameters instead.
+
+    If another transaction inserts one of the objects concurrently, the statement is rolled back
+    and :class:`~django.db.IntegrityError` is raised, so the caller can fall back to the ORM.
+
+    Args:
+        model (:class:`django.db.models.Model`): The model of the objects.
+        objs (list): The unsaved instances of `model`.
+        key_fields (tuple): The names of the fields identifying an object.
+        copy (bool): Whether to stream the objects into a staging table with ``COPY``. Defaults
+            to False.
+
+    Returns:
+        list: A tuple for each of `objs`, of the saved instance and whether it was inserted.
+
+    Raises:
+        IntegrityError: If some of the objects could not be inserted.
+    """
+    if not objs:
+        return []
+    opts = model._meta
+    tables = [parent._meta for parent in reversed(opts.get_parent_list())] + [opts]
+    key_fields = [opts.get_field(name) for name in key_fields]
+    qn = connection.ops.quote_name
+
+    # Objects with the same key are inserted once.
+    first_by_key = {}
+    indexes = []
+    rows = []
+    row_values = []
+    for obj in objs:
+        for table in tables[1:]:
+            for link in table.parents.values():
+                setattr(obj, link.attname, getattr(obj, link.target_field.attname))
+        values = [field.get_db_prep_save(field.pre_save(obj, True), connection)
+                  for table in tables for field in table.local_concrete_fields]
+        key = tuple(field.get_db_prep_save(getattr(obj, field.attname), connection)
+                    for field in key_fields)
+        if key not in first_by_key:
+            first_by_key[key] = len(rows)
+            rows.append(obj)
+            row_values.append([len(rows) - 1] + values)
+        indexes.append(first_by_key[key])
+
+    row_fields = [field for table in tables for field in table.local_concrete_fields]
+    row_columns = ['idx'] + ['c%d' % i for i in range(len(row_fields))]
+    column_of = {field: 'c%d' % i for i, field in enumerate(row_fields)}
+    row_types = ['integer'] + [field.cast_db_type(connection) for field in row_fields]
+    copy_data = _copy_data(row_values) if copy else None
+    if copy_data is None:
+        source = 'VALUES ' + ', '.join(
+            ['(%s)' % ', '.join('%%s::%s' % row_type for row_type in row_types)] * len(rows))
+        params = [value for values in row_values for value in values]
+    else:
+        staging = qn('pulp_staging_' + opts.db_table)
+        source = 'SELECT * FROM ' + staging
+        params = []
+
+    joins = qn(tables[0].db_table) + ' t0'
+    for i, table in enumerate(tables[1:], 1):
+        link = next(iter(table.parents.values()))
+        joins += ' JOIN {table} t{i} ON t{i}.{column} = t0.{pk}'.format(
+            table=qn(table.db_table), i=i, column=qn(link.column),
+            pk=qn(tables[0].pk.column))
+    alias_of = {table.concrete_model: 't%d' % i for i, table in enumerate(tables)}
+    select_fields = opts.concrete_fields
+
+    def column(field):
+        return '{alias}.{column}'.format(alias=alias_of[field.model._meta.concrete_model],
+                                         column=qn(field.column))
+
+    inserts = []
+    for i, table in enumerate(tables):
+        fields = table.local_concrete_fields
+        inserts.append(
+            'inserted{i} AS (INSERT INTO {table} ({columns}) SELECT {values} FROM batch '
+            'WHERE idx NOT IN (SELECT idx FROM existing){conflict} RETURNING {pk})'.format(
+                i=i, table=qn(table.db_table),
+                columns=', '.join(qn(field.column) for field in fields),
+                values=', '.join(column_of[field] for field in fields),
+                conflict=' ON CONFLICT DO NOTHING' if table is opts else '',
+                pk=qn(table.pk.column)))
+    sql = (
+        'WITH batch ({row_columns}) AS ({source}), '
+        'existing AS (SELECT batch.idx, {select} FROM batch JOIN ({joins}) ON {match}), '
+        '{inserts} '
+        'SELECT idx, {existing_columns} FROM existing '
+        'UNION ALL SELECT NULL, {nulls} FROM inserted{last}'
+    ).format(
+        row_columns=', '.join(row_columns),
+        source=source,
+        select=', '.join('{} AS s{}'.format(column(field), i)
+                         for i, field in enumerate(select_fields)),
+        joins=joins,
+        # NULLs match like in a lookup of the ORM. Only nullable fields use IS NOT DISTINCT FROM,
+        # which can't use an index.
+        match=' AND '.join('{} {} batch.{}'.format(
+            column(field), 'IS NOT DISTINCT FROM' if field.null else '=', column_of[field])
+            for field in key_fields),
+        inserts=', '.join(inserts),
+        existing_columns=', '.join('s%d' % i for i in range(len(select_fields))),
+        nulls=', '.join(['NULL'] * len(select_fields)),
+        last=len(tables) - 1,
+    )
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            if copy_data is not None:
+                cursor.execute(
+                    'CREATE TEMPORARY TABLE IF NOT EXISTS {staging} ({columns}) '
+                    'ON COMMIT DELETE ROWS'.format(staging=staging, columns=', '.join(
+                        '{} {}'.format(*column) for column in zip(row_columns, row_types))))
+                cursor.execute('TRUNCATE ' + staging)
+                cursor.copy_expert('COPY {} FROM STDIN'.format(staging), copy_data)
+            cursor.execute(sql, params)
+            results = cursor.fetchall()
+        existing = {}
+        inserted = 0
+        for result in results:
+            if result[0] is None:
+                inserted += 1
+                continue
+            values = [_from_db(field, value) for field, value in zip(select_fields, result[1:])]
+            existing[result[0]] = model.from_db(
+                connection.alias, [field.attname for field in select_fields], values)
+        if len(existing) + inserted != len(rows):
+            # A concurrent transaction inserted some of the objects.
+            raise IntegrityError('Some of the objects could not be inserted.')
+
+    for obj in rows:
+        obj._state.adding = False
+        obj._state.db = connection.alias
+    return [(existing.get(i, rows[i]), i not in existing) for i in indexes]
+
+
+def _copy_data(row_values):
+    lines = []
+    for values in row_values:
+        columns = []
+        for value in values:
+            if value is None:
+                columns.append('\\N')
+                continue
+            if Json is not None and isinstance(value, Json):
+                value = value.dumps(value.adapted)
+            elif isinstance(value, bool):
+                value = 't' if value else 'f'
+            elif not isinstance(value, _COPY_TYPES):
+                return None
+            columns.append(str(value).translate(_COPY_ESCAPES))
+        lines.append('\t'.join(columns))
+    return io.StringIO('\n'.join(lines) + '\n')
+
+
+def _from_db(field, value):
+    for converter in field.get_db_converters(connection):
+        value = converter(value, field, connection)
+    return value
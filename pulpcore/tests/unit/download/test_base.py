@@ -0,0 +1,137 @@
+import hashlib
+import os
+import tempfile
+from unittest import mock
+
+import asynctest
+from django.test import override_settings
+
+from pulpcore.exceptions import DigestValidationError
+from pulpcore.plugin.download import BaseDownloader
+
+
+class TestSpooledDownload(asynctest.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.cwd = os.getcwd()
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        os.chdir(self.tmp_dir.name)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.tmp_dir.cleanup()
+        super().tearDown()
+
+    async def download(self, downloader, chunks, data=None):
+        for chunk in chunks:
+            await downloader.handle_data(chunk)
+        with mock.patch('os.fsync') as fsync:
+            await downloader.finalize()
+        fsync.assert_not_called()
+        with open(downloader.path, 'rb') as f:
+            self.assertEqual(f.read(), data or b''.join(chunks))
+
+    async def test_kept_in_memory(self):
+        downloader = BaseDownloader('http://example.com/', spool_size=10)
+        await downloader.handle_data(b'abcd')
+        self.assertIsNone(downloader.path)
+        self.assertEqual(os.listdir(), [])
+        await self.download(downloader, [b'efgh'], b'abcdefgh')
+
+    async def test_spilled_to_disk(self):
+        downloader = BaseDownloader('http://example.com/', spool_size=10)
+        await self.download(downloader, [b'abcdef', b'ghijkl', b'mn'])
+
+    async def test_large_expected_size(self):
+        downloader = BaseDownloader('http://example.com/', spool_size=10, expected_size=11)
+        self.assertIsNotNone(downloader.path)
+        await self.download(downloader, [b'abcdefghijk'])
+
+    async def test_invalid_data_not_written(self):
+        downloader = BaseDownloader('http://example.com/', spool_size=10,
+                                    expected_digests={'sha256': hashlib.sha256(b'x').hexdigest()})
+        await downloader.handle_data(b'abcd')
+        with self.assertRaises(DigestValidationError):
+            await downloader.finalize()
+        self.assertEqual(os.listdir(), [])
+
+
+class TestArtifactStorageDownload(asynctest.TestCase):
+
+    data = b'abcdef'
+    sha256 = hashlib.sha256(data).hexdigest()
+
+    def setUp(self):
+        super().setUp()
+        self.media_root = tempfile.TemporaryDirectory()
+        self.settings = override_settings(MEDIA_ROOT=self.media_root.name)
+        self.settings.enable()
+        self.staging = os.path.join(self.media_root.name, 'artifact', '.staging')
+        self.destination = os.path.join(self.media_root.name, 'artifact', self.sha256[:2],
+                                        self.sha256[2:])
+
+    def tearDown(self):
+        self.settings.disable()
+        self.media_root.cleanup()
+        super().tearDown()
+
+    async def test_stored(self):
+        downloader = BaseDownloader('http://example.com/', artifact_storage=True)
+        self.assertEqual(os.path.dirname(downloader.path), self.staging)
+        await downloader.handle_data(self.data)
+        await downloader.finalize()
+        self.assertEqual(downloader.path, self.destination)
+        self.assertEqual(os.listdir(self.staging), [])
+        with open(self.destination, 'rb') as f:
+            self.assertEqual(f.read(), self.data)
+
+    async def test_existing_file_kept(self):
+        os.makedirs(os.path.dirname(self.destination))
+        with open(self.destination, 'wb') as f:
+            f.write(self.data)
+        inode = os.stat(self.destination).st_ino
+        downloader = BaseDownloader('http://example.com/', artifact_storage=True)
+        await downloader.handle_data(self.data)
+        await downloader.finalize()
+        self.assertEqual(os.stat(self.destination).st_ino, inode)
+        self.assertEqual(os.listdir(self.staging), [])
+
+    async def test_invalid_data_discarded(self):
+        downloader = BaseDownloader('http://example.com/', artifact_storage=True,
+                                    expected_digests={'sha256': 'invalid'})
+        await downloader.handle_data(self.data)
+        with self.assertRaises(DigestValidationError):
+            await downloader.finalize()
+        self.assertEqual(os.listdir(self.staging), [])
+        self.assertFalse(os.path.exists(self.destination))
+
+
+class TestPreallocate(asynctest.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.cwd = os.getcwd()
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        os.chdir(self.tmp_dir.name)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.tmp_dir.cleanup()
+        super().tearDown()
+
+    @mock.patch('pulpcore.plugin.download.base._fallocate')
+    def test_large_files_are_preallocated(self, fallocate):
+        downloader = BaseDownloader('http://example.com/', expected_size=2 ** 30)
+        fallocate.assert_called_once_with(downloader._writer.fileno(), 0, 0, 2 ** 30)
+
+    @mock.patch('pulpcore.plugin.download.base._fallocate')
+    def test_small_files_are_not_preallocated(self, fallocate):
+        BaseDownloader('http://example.com/', expected_size=2 ** 20)
+        fallocate.assert_not_called()
+
+    @mock.patch('pulpcore.plugin.download.base._fallocate')
+    def test_unsupported_filesystem(self, fallocate):
+        fallocate.return_value = -1
+        downloader = BaseDownloader('http://example.com/', expected_size=2 ** 30)
+        self.assertEqual(os.path.getsize(downloader.path), 0)
@@ -0,0 +1,121 @@
+import asyncio
+import hashlib
+import os
+import tempfile
+
+import asynctest
+
+from pulpcore.plugin.download import DownloadCache, DownloadResult, HttpDownloader
+
+
+class TestDownloadCache(asynctest.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.cwd = os.getcwd()
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        os.chdir(self.tmp_dir.name)
+        self.cache = DownloadCache('cache', max_size=10, poll_interval=0.01)
+        self.downloads = []
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.tmp_dir.cleanup()
+        super().tearDown()
+
+    async def fetch(self, data, cache=None, delay=0):
+        downloader = HttpDownloader('http://example.com/', session=asynctest.Mock(),
+                                    expected_digests={'sha256': hashlib.sha256(data).hexdigest()})
+
+        async def download():
+            self.downloads.append(data)
+            await asyncio.sleep(delay)
+            await downloader.handle_data(data)
+            await downloader.finalize()
+            return DownloadResult(url=downloader.url, path=downloader.path, headers=None,
+                                  artifact_attributes=downloader.artifact_attributes)
+
+        result = await (cache or self.cache).run(downloader, download)
+        with open(result.path, 'rb') as f:
+            self.assertEqual(f.read(), data)
+        return result
+
+    async def test_hit(self):
+        await self.fetch(b'abc')
+        result = await self.fetch(b'abc')
+        self.assertEqual(self.downloads, [b'abc'])
+        self.assertEqual(result.artifact_attributes['size'], 3)
+
+    async def test_concurrent_downloads_wait(self):
+        other_cache = DownloadCache('cache', max_size=10, poll_interval=0.01)
+        await asyncio.gather(self.fetch(b'abc', delay=0.05),
+                             self.fetch(b'abc', cache=other_cache))
+        self.assertEqual(self.downloads, [b'abc'])
+
+    async def test_corrupted_file_downloaded_again(self):
+        await self.fetch(b'abc')
+        with open(self.cache._path(DownloadCache.key(
+                {'sha256': hashlib.sha256(b'abc').hexdigest()})), 'wb') as f:
+            f.write(b'xyz')
+        await self.fetch(b'abc')
+        self.assertEqual(self.downloads, [b'abc', b'abc'])
+
+    async def test_eviction(self):
+        await self.fetch(b'aaaa')
+        await self.fetch(b'bbbb')
+        # mark 'aaaa' as the most recently used file, so 'bbbb' is evicted for 'cccc'
+        os.utime(self.cache._path(DownloadCache.key(
+            {'sha256': hashlib.sha256(b'aaaa').hexdigest()})), (2 ** 31, 2 ** 31))
+        await self.fetch(b'cccc')
+        await self.fetch(b'aaaa')
+        await self.fetch(b'bbbb')
+        self.assertEqual(self.downloads, [b'aaaa', b'bbbb', b'cccc', b'bbbb'])
+
+    def path(self, data):
+        return self.cache._path(DownloadCache.key({'sha256': hashlib.sha256(data).hexdigest()}))
+
+    async def test_eviction_removes_lock_files(self):
+        await self.fetch(b'aaaa')
+        await self.fetch(b'bbbb')
+        os.utime(self.path(b'aaaa'), (1, 1))
+        await self.fetch(b'cccc')
+        self.assertFalse(os.path.exists(self.path(b'aaaa')))
+        self.assertFalse(os.path.exists(self.path(b'aaaa') + '.lock'))
+        self.assertTrue(os.path.exists(self.path(b'bbbb') + '.lock'))
+        self.assertEqual(self.size(), 8)
+
+    def size(self):
+        with open(os.path.join('cache', '.size')) as f:
+            return int(f.read())
+
+    async def test_size_is_shared(self):
+        other_cache = DownloadCache('cache', max_size=10, poll_interval=0.01)
+        await self.fetch(b'aaaa')
+        await self.fetch(b'bbbb', cache=other_cache)
+        self.assertEqual(self.size(), 8)
+        os.utime(self.path(b'aaaa'), (1, 1))
+        await self.fetch(b'cccc')
+        # The file added by the other cache counts, so 'aaaa' is evicted.
+        self.assertFalse(os.path.exists(self.path(b'aaaa')))
+        self.assertEqual(self.size(), 8)
+
+    async def test_eviction_keeps_locked_files(self):
+        await self.fetch(b'aaaa')
+        await self.fetch(b'bbbb')
+        os.utime(self.path(b'aaaa'), (1, 1))
+        os.utime(self.path(b'bbbb'), (2, 2))
+        async with self.cache._locked(DownloadCache.key(
+                {'sha256': hashlib.sha256(b'aaaa').hexdigest()})):
+            await self.fetch(b'cccc')
+        self.assertTrue(os.path.exists(self.path(b'aaaa')))
+        self.assertFalse(os.path.exists(self.path(b'bbbb')))
+
+    async def test_lock_replaced_while_waiting(self):
+        key = DownloadCache.key({'sha256': hashlib.sha256(b'abc').hexdigest()})
+        async with self.cache._locked(key):
+            waiting = asyncio.ensure_future(self.fetch(b'abc'))
+            await asyncio.sleep(0.02)
+            os.unlink(self.path(b'abc') + '.lock')
+        await waiting
+        self.assertTrue(os.path.exists(self.path(b'abc') + '.lock'))
+        self.assertEqual(self.downloads, [b'abc'])
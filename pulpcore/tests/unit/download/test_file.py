@@ -0,0 +1,89 @@
+import errno
+import hashlib
+import os
+import tempfile
+from unittest import mock
+
+import asynctest
+
+from pulpcore.exceptions import SizeValidationError
+from pulpcore.plugin.download import FileDownloader
+from pulpcore.plugin.download.base import MAX_CHUNK_SIZE, MIN_CHUNK_SIZE, chunk_size
+
+
+class TestChunkSize(asynctest.TestCase):
+
+    def test_chunk_size(self):
+        self.assertEqual(chunk_size(None), MAX_CHUNK_SIZE)
+        self.assertEqual(chunk_size(100), MIN_CHUNK_SIZE)
+        self.assertEqual(chunk_size(MIN_CHUNK_SIZE + 1), 2 * MIN_CHUNK_SIZE)
+        self.assertEqual(chunk_size(100 * MAX_CHUNK_SIZE), MAX_CHUNK_SIZE)
+
+
+class TestFileDownloader(asynctest.TestCase):
+
+    data = os.urandom(2 * MAX_CHUNK_SIZE + 100)
+
+    def setUp(self):
+        super().setUp()
+        self.cwd = os.getcwd()
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        os.chdir(self.tmp_dir.name)
+        self.source = os.path.join(self.tmp_dir.name, 'source')
+        with open(self.source, 'wb') as f:
+            f.write(self.data)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.tmp_dir.cleanup()
+        super().tearDown()
+
+    def assertResult(self, result):
+        self.assertEqual(result.artifact_attributes['size'], len(self.data))
+        self.assertEqual(result.artifact_attributes['sha256'],
+                         hashlib.sha256(self.data).hexdigest())
+
+    async def test_read_in_chunks(self):
+        downloader = FileDownloader('file://' + self.source,
+                                    custom_file_object=tempfile.TemporaryFile())
+        self.assertResult(await downloader.run())
+
+    async def test_link(self):
+        result = await FileDownloader('file://' + self.source).run()
+        self.assertResult(result)
+        self.assertNotEqual(result.path, self.source)
+        self.assertTrue(os.path.exists(self.source))
+        with open(result.path, 'rb') as f:
+            self.assertEqual(f.read(), self.data)
+
+    @mock.patch('pulpcore.plugin.download.file.fcntl.ioctl',
+                side_effect=OSError(errno.EOPNOTSUPP, 'not supported'))
+    async def test_no_hardlink_by_default(self, ioctl):
+        result = await FileDownloader('file://' + self.source).run()
+        self.assertResult(result)
+        self.assertFalse(os.path.samefile(result.path, self.source))
+
+    @mock.patch('pulpcore.plugin.download.file.fcntl.ioctl',
+                side_effect=OSError(errno.EOPNOTSUPP, 'not supported'))
+    async def test_hardlink(self, ioctl):
+        result = await FileDownloader('file://' + self.source, hardlink=True).run()
+        self.assertResult(result)
+        self.assertTrue(os.path.samefile(result.path, self.source))
+
+    async def test_copy_across_filesystems(self):
+        with mock.patch('pulpcore.plugin.download.file._link', return_value=False):
+            result = await FileDownloader('file://' + self.source).run()
+        self.assertResult(result)
+        self.assertFalse(os.path.samefile(result.path, self.source))
+        with open(result.path, 'rb') as f:
+            self.assertEqual(f.read(), self.data)
+
+    async def test_size_mismatch(self):
+        downloader = FileDownloader('file://' + self.source, expected_size=10)
+        with self.assertRaises(SizeValidationError):
+            await downloader.run()
+
+    @mock.patch('pulpcore.plugin.download.base._fallocate')
+    def test_linked_file_is_not_preallocated(self, fallocate):
+        FileDownloader('file://' + self.source, expected_size=2 ** 30)
+        fallocate.assert_not_called()
@@ -0,0 +1,297 @@
+import asyncio
+import hashlib
+import io
+import os
+import re
+import tempfile
+
+import aiohttp
+import asynctest
+from unittest import mock
+
+from pulpcore.exceptions import SizeValidationError
+from pulpcore.plugin.download import DownloadCache, HttpDownloader
+
+
+def response_error(status, headers=None):
+    return aiohttp.ClientResponseError(mock.Mock(), (), status=status, headers=headers or {})
+
+
+class ResponseMock:
+    """Mock for an aiohttp response delivering `chunks`, which may contain exceptions."""
+
+    def __init__(self, status, headers, chunks):
+        self.status = status
+        self.headers = headers
+        self.content = mock.Mock()
+        self.content.readany = asynctest.CoroutineMock(side_effect=chunks)
+
+    def raise_for_status(self):
+        pass
+
+    async def release(self):
+        pass
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+
+class TestHttpDownloaderRetry(asynctest.ClockedTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.semaphore = asyncio.Semaphore(1)
+
+    def make_downloader(self, failures):
+        downloader = HttpDownloader('http://example.com/', session=mock.Mock(),
+                                    custom_file_object=io.BytesIO(), semaphore=self.semaphore)
+        attempts = []
+
+        async def _run(extra_data=None):
+            attempts.append(self.loop.time())
+            if failures:
+                raise failures.pop(0)
+            return 'result'
+
+        downloader._run = _run
+        return downloader, attempts
+
+    async def test_retry_after_is_honoured(self):
+        downloader, attempts = self.make_downloader([response_error(429, {'Retry-After': '30'})])
+        task = self.loop.create_task(downloader.run())
+        await self.advance(29)
+        self.assertEqual(len(attempts), 1)
+        await self.advance(2)
+        self.assertEqual(task.result(), 'result')
+        self.assertEqual(attempts, [0, 30])
+
+    async def test_semaphore_released_while_waiting(self):
+        downloader, attempts = self.make_downloader([response_error(503, {'Retry-After': '60'})])
+        task = self.loop.create_task(downloader.run())
+        await self.advance(1)
+        self.assertFalse(self.semaphore.locked())
+        await self.advance(60)
+        self.assertEqual(task.result(), 'result')
+
+    async def test_connection_errors_are_retried(self):
+        downloader, attempts = self.make_downloader([
+            aiohttp.ServerDisconnectedError(),
+            asyncio.TimeoutError(),
+        ])
+        task = self.loop.create_task(downloader.run())
+        await self.advance(10)
+        self.assertEqual(task.result(), 'result')
+        self.assertEqual(len(attempts), 3)
+
+    async def test_give_up(self):
+        downloader, attempts = self.make_downloader([response_error(404)])
+        task = self.loop.create_task(downloader.run())
+        await self.advance(1)
+        self.assertIsInstance(task.exception(), aiohttp.ClientResponseError)
+        self.assertEqual(len(attempts), 1)
+
+
+class TestHttpDownloaderResume(asynctest.ClockedTestCase):
+
+    def make_downloader(self, responses):
+        session = mock.Mock()
+        session.get.side_effect = responses
+        downloader = HttpDownloader('http://example.com/', session=session,
+                                    custom_file_object=tempfile.TemporaryFile())
+        return downloader, session
+
+    async def run_downloader(self, downloader):
+        task = self.loop.create_task(downloader.run())
+        await self.advance(10)
+        return task.result()
+
+    async def test_resume(self):
+        downloader, session = self.make_downloader([
+            ResponseMock(200, {'Accept-Ranges': 'bytes', 'ETag': '"1"'},
+                         [b'abc', aiohttp.ClientPayloadError()]),
+            ResponseMock(206, {'Content-Range': 'bytes 3-5/6'}, [b'def', b'']),
+        ])
+        result = await self.run_downloader(downloader)
+        self.assertEqual(session.get.call_args[1]['headers'],
+                         {'Range': 'bytes=3-', 'If-Range': '"1"'})
+        self.assertEqual(result.artifact_attributes['size'], 6)
+        self.assertEqual(result.artifact_attributes['sha256'],
+                         hashlib.sha256(b'abcdef').hexdigest())
+        self.assertEqual(result.headers['ETag'], '"1"')
+
+    async def test_changed_file_starts_over(self):
+        downloader, session = self.make_downloader([
+            ResponseMock(200, {'Accept-Ranges': 'bytes', 'ETag': '"1"'},
+                         [b'abc', aiohttp.ClientPayloadError()]),
+            ResponseMock(200, {'Accept-Ranges': 'bytes', 'ETag': '"2"'}, [b'uvwxyz', b'']),
+        ])
+        result = await self.run_downloader(downloader)
+        self.assertEqual(result.artifact_attributes['sha256'],
+                         hashlib.sha256(b'uvwxyz').hexdigest())
+
+    async def test_no_resume_without_validator(self):
+        downloader, session = self.make_downloader([
+            ResponseMock(200, {'Accept-Ranges': 'bytes', 'ETag': 'W/"1"'},
+                         [b'abc', aiohttp.ClientPayloadError()]),
+            ResponseMock(200, {}, [b'abcdef', b'']),
+        ])
+        result = await self.run_downloader(downloader)
+        self.assertEqual(session.get.call_args[1]['headers'], {})
+        self.assertEqual(result.artifact_attributes['sha256'],
+                         hashlib.sha256(b'abcdef').hexdigest())
+
+    async def test_streamed_data_is_not_restarted(self):
+        callback = asynctest.CoroutineMock()
+        downloader, session = self.make_downloader([
+            ResponseMock(200, {'Accept-Ranges': 'bytes', 'ETag': 'W/"1"'},
+                         [b'abc', aiohttp.ClientPayloadError()]),
+            ResponseMock(200, {}, [b'abcdef', b'']),
+        ])
+        downloader.headers_ready_callback = callback
+        task = self.loop.create_task(downloader.run())
+        await self.advance(10)
+        self.assertIsInstance(task.exception(), aiohttp.ClientPayloadError)
+        self.assertEqual(session.get.call_count, 1)
+
+    async def test_changed_streamed_file_is_not_restarted(self):
+        callback = asynctest.CoroutineMock()
+        downloader, session = self.make_downloader([
+            ResponseMock(200, {'Accept-Ranges': 'bytes', 'ETag': '"1"'},
+                         [b'abc', aiohttp.ClientPayloadError()]),
+            ResponseMock(200, {'Accept-Ranges': 'bytes', 'ETag': '"2"'}, [b'uvwxyz', b'']),
+        ])
+        downloader.headers_ready_callback = callback
+        task = self.loop.create_task(downloader.run())
+        await self.advance(10)
+        # The file changed on the server, so the download can't be resumed.
+        self.assertIsInstance(task.exception(), aiohttp.ClientPayloadError)
+        self.assertEqual(callback.call_count, 1)
+
+
+class TestHttpDownloaderSize(asynctest.TestCase):
+
+    def make_downloader(self, response):
+        session = mock.Mock()
+        session.get.return_value = response
+        return HttpDownloader('http://example.com/', session=session, expected_size=6,
+                              custom_file_object=tempfile.TemporaryFile())
+
+    async def test_content_length_mismatch(self):
+        response = ResponseMock(200, {'Content-Length': '4000'}, [b'<html>', b''])
+        with self.assertRaises(SizeValidationError):
+            await self.make_downloader(response).run()
+        response.content.readany.assert_not_called()
+
+    async def test_abort_on_overrun(self):
+        response = ResponseMock(200, {}, [b'abcd', b'efgh', b'ijkl', b''])
+        with self.assertRaises(SizeValidationError):
+            await self.make_downloader(response).run()
+        self.assertEqual(response.content.readany.call_count, 2)
+
+
+class TestHttpDownloaderSegments(asynctest.TestCase):
+
+    data = bytes(range(256)) * 40
+
+    def setUp(self):
+        super().setUp()
+        self.cwd = os.getcwd()
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        os.chdir(self.tmp_dir.name)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.tmp_dir.cleanup()
+        super().tearDown()
+
+    def get(self, url, headers):
+        match = re.match(r'bytes=(\d+)-(\d+)', headers.get('Range', ''))
+        if not match:
+            return ResponseMock(200, {}, [self.data, b''])
+        start, end = int(match.group(1)), int(match.group(2)) + 1
+        content_range = 'bytes {}-{}/{}'.format(start, end - 1, len(self.data))
+        return ResponseMock(206, {'Content-Range': content_range}, [self.data[start:end], b''])
+
+    def make_downloader(self, get):
+        session = mock.Mock()
+        session.get.side_effect = get
+        downloader = HttpDownloader('http://example.com/', session=session,
+                                    expected_size=len(self.data), segment_threshold=1000,
+                                    segment_count=3)
+        return downloader, session
+
+    async def test_segments(self):
+        downloader, session = self.make_downloader(self.get)
+        result = await downloader.run()
+        self.assertEqual(session.get.call_count, 3)
+        self.assertEqual(result.artifact_attributes['sha256'],
+                         hashlib.sha256(self.data).hexdigest())
+        with open(result.path, 'rb') as f:
+            self.assertEqual(f.read(), self.data)
+
+    async def test_fallback_without_range_support(self):
+        downloader, session = self.make_downloader(
+            lambda url, headers: ResponseMock(200, {}, [self.data, b''])
+        )
+        result = await downloader.run()
+        self.assertEqual(session.get.call_count, 4)
+        self.assertEqual(result.artifact_attributes['sha256'],
+                         hashlib.sha256(self.data).hexdigest())
+        with open(result.path, 'rb') as f:
+            self.assertEqual(f.read(), self.data)
+
+
+class TestHttpDownloaderConditional(asynctest.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.cwd = os.getcwd()
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        os.chdir(self.tmp_dir.name)
+        self.cache = DownloadCache('cache', max_size=1000)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.tmp_dir.cleanup()
+        super().tearDown()
+
+    async def download(self, response, scope='remote'):
+        session = mock.Mock()
+        session.get.return_value = response
+        downloader = HttpDownloader('http://example.com/repomd.xml', session=session,
+                                    cache=self.cache, cache_scope=scope)
+        result = await downloader.run()
+        with open(result.path, 'rb') as f:
+            self.assertEqual(f.read(), b'metadata')
+        return result, session.get.call_args[1]['headers']
+
+    async def test_not_modified(self):
+        await self.download(ResponseMock(200, {'ETag': '"1"'}, [b'metadata', b'']))
+        result, headers = await self.download(ResponseMock(304, {}, []))
+        self.assertEqual(headers, {'If-None-Match': '"1"'})
+        self.assertEqual(result.headers['etag'], '"1"')
+        self.assertEqual(result.artifact_attributes['sha256'],
+                         hashlib.sha256(b'metadata').hexdigest())
+
+    async def test_scopes(self):
+        await self.download(ResponseMock(200, {'Last-Modified': 'Mon, 01 Jan 2018 00:00:00 GMT'},
+                                         [b'metadata', b'']))
+        result, headers = await self.download(ResponseMock(200, {}, [b'metadata', b'']),
+                                              scope='other')
+        self.assertEqual(headers, {})
+
+    async def test_lowercase_header_names(self):
+        await self.download(ResponseMock(200, {'etag': '"1"', 'last-modified': 'yesterday'},
+                                         [b'metadata', b'']))
+        result, headers = await self.download(ResponseMock(304, {}, []))
+        self.assertEqual(headers, {'If-None-Match': '"1"', 'If-Modified-Since': 'yesterday'})
+        self.assertEqual(result.headers['ETag'], '"1"')
+
+    async def test_lowercase_no_store_is_honoured(self):
+        await self.download(ResponseMock(200, {'etag': '"1"', 'cache-control': 'no-store'},
+                                         [b'metadata', b'']))
+        result, headers = await self.download(ResponseMock(200, {}, [b'metadata', b'']))
+        self.assertEqual(headers, {})
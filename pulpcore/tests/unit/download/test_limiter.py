@@ -0,0 +1,123 @@
+import asyncio
+
+import asynctest
+
+from pulpcore.plugin.download import AdaptiveConcurrencyLimiter, PrioritySemaphore
+
+
+class TestAdaptiveConcurrencyLimiter(asynctest.ClockedTestCase):
+
+    async def hold(self, limiter, duration, size=100):
+        async with limiter:
+            await asyncio.sleep(duration)
+            limiter.record_success(size)
+
+    async def test_limits_concurrency(self):
+        limiter = AdaptiveConcurrencyLimiter(2)
+        for i in range(3):
+            self.loop.create_task(self.hold(limiter, 10))
+        await self.advance(1)
+        self.assertEqual(limiter.in_flight, 2)
+        await self.advance(10)
+        self.assertEqual(limiter.in_flight, 1)
+        await self.advance(10)
+        self.assertEqual(limiter.in_flight, 0)
+
+    async def test_increase_when_throughput_improves(self):
+        limiter = AdaptiveConcurrencyLimiter(2, max_value=3)
+        for i in range(2):
+            self.loop.create_task(self.hold(limiter, 10))
+        await self.advance(11)
+        self.assertEqual(limiter.limit, 3)
+        for i in range(3):
+            self.loop.create_task(self.hold(limiter, 1))
+        await self.advance(2)
+        # the throughput improved, but the limit is capped by `max_value`
+        self.assertEqual(limiter.limit, 3)
+
+    async def test_no_increase_when_not_saturated(self):
+        limiter = AdaptiveConcurrencyLimiter(2)
+        self.loop.create_task(self.hold(limiter, 1))
+        await self.advance(2)
+        self.loop.create_task(self.hold(limiter, 1))
+        await self.advance(2)
+        self.assertEqual(limiter.limit, 2)
+
+    async def test_congestion_cuts_limit_once(self):
+        limiter = AdaptiveConcurrencyLimiter(8)
+        for i in range(4):
+            await limiter.acquire()
+        limiter.record_congestion()
+        self.assertEqual(limiter.limit, 4)
+        # requests started under the old limit don't cut it again
+        limiter.record_congestion()
+        self.assertEqual(limiter.limit, 4)
+        for i in range(4):
+            limiter.release()
+        limiter.record_congestion()
+        self.assertEqual(limiter.limit, 2)
+
+    async def test_latency_spike_cuts_limit(self):
+        limiter = AdaptiveConcurrencyLimiter(8, min_value=5)
+        limiter.record_latency(1.0)
+        limiter.record_latency(1.5)
+        self.assertEqual(limiter.limit, 8)
+        limiter.record_latency(10.0)
+        self.assertEqual(limiter.limit, 5)
+
+    async def test_decrease_wakes_no_waiters(self):
+        limiter = AdaptiveConcurrencyLimiter(2)
+        for i in range(4):
+            self.loop.create_task(self.hold(limiter, 10))
+        await self.advance(1)
+        limiter.record_congestion()
+        self.assertEqual(limiter.limit, 1)
+        await self.advance(10)
+        self.assertEqual(limiter.in_flight, 1)
+        await self.advance(20)
+        self.assertEqual(limiter.in_flight, 0)
+
+
+class TestPrioritySemaphore(asynctest.ClockedTestCase):
+
+    async def hold(self, semaphore, name, priority=False):
+        await semaphore.acquire(priority=priority)
+        self.order.append(name)
+
+    async def test_priority_waiters_go_first(self):
+        self.order = []
+        semaphore = PrioritySemaphore(1)
+        await semaphore.acquire()
+        for name, priority in (('a', False), ('b', False), ('c', True)):
+            self.loop.create_task(self.hold(semaphore, name, priority))
+        await self.advance(1)
+        for i in range(3):
+            semaphore.release()
+            await self.advance(1)
+        self.assertEqual(self.order, ['c', 'a', 'b'])
+
+    async def test_free_slots_are_passed_on_after_priority_waiters(self):
+        self.order = []
+        semaphore = PrioritySemaphore(2)
+        await semaphore.acquire()
+        await semaphore.acquire()
+        self.loop.create_task(self.hold(semaphore, 'a'))
+        self.loop.create_task(self.hold(semaphore, 'b', priority=True))
+        await self.advance(1)
+        semaphore.release()
+        semaphore.release()
+        await self.advance(1)
+        self.assertEqual(self.order, ['b', 'a'])
+        self.assertEqual(semaphore.in_flight, 2)
+
+    async def test_cancelled_waiter_passes_slot_on(self):
+        self.order = []
+        semaphore = PrioritySemaphore(1)
+        await semaphore.acquire()
+        cancelled = self.loop.create_task(self.hold(semaphore, 'a', priority=True))
+        self.loop.create_task(self.hold(semaphore, 'b'))
+        await self.advance(1)
+        semaphore.release()
+        cancelled.cancel()
+        await self.advance(1)
+        self.assertEqual(self.order, ['b'])
@@ -75,28 +75,30 @@ class TestArtifactDownloader(asynctest.ClockedTestCase):
         await super().advance(delta)
         self.now += delta
 
-    def queue_dc(self, delays=[]):
+    def queue_dc(self, delays=[], size=None, does_batch=True):
         """Put a DeclarativeContent instance into `in_q`
 
         For each `delay` in `delays`, associate a DeclarativeArtifact
         with download duration `delay` to the content unit. `delay ==
         None` means that the artifact is already present (pk is set)
-        and no download is required.
+        and no download is required. Each artifact has the `size`.
         """
         das = []
         for delay in delays:
             artifact = mock.Mock()
             artifact.pk = uuid4()
             artifact._state.adding = delay is not None
+            artifact.file = None
+            artifact.size = size
             artifact.DIGEST_FIELDS = []
             remote = mock.Mock()
             remote.get_downloader = DownloaderMock
             das.append(DeclarativeArtifact(artifact=artifact, url=str(delay),
                                            relative_path='path', remote=remote))
-        dc = DeclarativeContent(content=mock.Mock(), d_artifacts=das)
+        dc = DeclarativeContent(content=mock.Mock(), d_artifacts=das, does_batch=does_batch)
         self.in_q.put_nowait(dc)
 
-    async def download_task(self, max_concurrent_content=3):
+    async def download_task(self, max_concurrent_content=3, **kwargs):
         """
         A coroutine running the downloader stage with a mocked ProgressBar.
 
@@ -105,7 +107,7 @@ class TestArtifactDownloader(asynctest.ClockedTestCase):
         """
         with mock.patch('pulpcore.plugin.stages.artifact_stages.ProgressBar') as pb:
             pb.return_value.__enter__.return_value.done = 0
-            ad = ArtifactDownloader(max_concurrent_content=max_concurrent_content)
+            ad = ArtifactDownloader(max_concurrent_content=max_concurrent_content, **kwargs)
             ad._connect(self.in_q, self.out_q)
             await ad()
         return pb.return_value.__enter__.return_value.done
@@ -339,3 +341,98 @@ class TestArtifactDownloader(asynctest.ClockedTestCase):
         await self.advance_to(2.5)
         self.assertTrue(download_task.done())
         self.assertIsInstance(download_task.exception(), MockException)
+
+    async def test_max_bytes_in_flight(self):
+        download_task = self.loop.create_task(
+            self.download_task(max_concurrent_content=10, max_bytes_in_flight=100))
+        for i in range(4):
+            self.queue_dc(delays=[1], size=40)
+        self.queue_dc(delays=[1], size=200)  # larger than the limit on its own
+        self.in_q.put_nowait(None)
+
+        # At 0.5 seconds, only two downloads fit
+        await self.advance_to(0.5)
+        self.assertEqual(DownloaderMock.running, 2)
+
+        # At 1.5 seconds, the next two downloads are running
+        await self.advance_to(1.5)
+        self.assertEqual(DownloaderMock.running, 2)
+        self.assertHandled(2)
+
+        # At 2.5 seconds, the large download runs alone
+        await self.advance_to(2.5)
+        self.assertEqual(DownloaderMock.running, 1)
+        self.assertHandled(4)
+
+        await self.advance_to(3.5)
+        self.assertEqual(DownloaderMock.downloads, 5)
+        self.assertEqual(download_task.result(), DownloaderMock.downloads)
+        self.assertHandled(6)
+
+    async def test_large_size_interleaving(self):
+        download_task = self.loop.create_task(self.download_task(
+            max_concurrent_content=10, max_bytes_in_flight=1000, large_size=500))
+        for i in range(3):
+            self.queue_dc(delays=[1], size=600)
+        for i in range(3):
+            self.queue_dc(delays=[1], size=10)
+        self.in_q.put_nowait(None)
+
+        # At 0.5 seconds, the small downloads run next to the first large one
+        await self.advance_to(0.5)
+        self.assertEqual(DownloaderMock.running, 4)
+
+        # The other large downloads run one after the other
+        await self.advance_to(1.5)
+        self.assertEqual(DownloaderMock.running, 1)
+        self.assertHandled(4)
+        await self.advance_to(2.5)
+        self.assertEqual(DownloaderMock.running, 1)
+
+        await self.advance_to(3.5)
+        self.assertEqual(DownloaderMock.downloads, 6)
+        self.assertEqual(download_task.result(), DownloaderMock.downloads)
+        self.assertHandled(7)
+
+    async def test_priority_lane(self):
+        download_task = self.loop.create_task(
+            self.download_task(max_concurrent_content=2, lookahead=2))
+        for i in range(3):
+            self.queue_dc(delays=[10])
+        self.queue_dc(delays=[1], does_batch=False)
+        self.in_q.put_nowait(None)
+
+        # At 0.5 seconds, the priority unit runs next to the two slots, the third unit waits
+        await self.advance_to(0.5)
+        self.assertEqual(DownloaderMock.running, 3)
+        self.assertQueued(0)
+
+        # At 1.5 seconds, the priority unit is handled ahead of the others
+        await self.advance_to(1.5)
+        self.assertEqual(DownloaderMock.running, 2)
+        self.assertHandled(1)
+        self.assertIs(self.out_q.get_nowait().does_batch, False)
+
+        await self.advance_to(20.5)
+        self.assertEqual(DownloaderMock.downloads, 4)
+        self.assertEqual(download_task.result(), DownloaderMock.downloads)
+
+    async def test_content_without_downloads_passes_through(self):
+        handle = ArtifactDownloader._handle_content_unit
+        with mock.patch.object(ArtifactDownloader, '_handle_content_unit', autospec=True,
+                               side_effect=handle) as handle_content_unit:
+            download_task = self.loop.create_task(self.download_task(max_concurrent_content=2))
+            self.queue_dc(delays=[10])
+            for i in range(50):
+                self.queue_dc(delays=[None])
+            self.in_q.put_nowait(None)
+
+            # At 0.5 seconds, the units without downloads are passed on without a handler
+            await self.advance_to(0.5)
+            self.assertEqual(DownloaderMock.running, 1)
+            self.assertHandled(50)
+            self.assertEqual(handle_content_unit.call_count, 1)
+
+            await self.advance_to(10.5)
+        self.assertEqual(download_task.result(), 1)
+        self.assertHandled(52)
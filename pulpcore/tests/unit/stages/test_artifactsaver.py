@@ -0,0 +1,80 @@
+import asyncio
+import errno
+import os
+import tempfile
+
+import asynctest
+import mock
+
+from pulpcore.plugin.models import Artifact
+from pulpcore.plugin.stages import ArtifactSaver, DeclarativeArtifact, DeclarativeContent
+from pulpcore.plugin.stages.artifact_stages import _sync_files
+
+
+class TestArtifactSaver(asynctest.TestCase):
+
+    def d_content(self, synced):
+        d_artifact = DeclarativeArtifact(artifact=Artifact(file='path'), url='url',
+                                         relative_path='path', remote=mock.Mock(), synced=synced)
+        return DeclarativeContent(content=mock.Mock(), d_artifacts=[d_artifact])
+
+    async def run_stage(self, d_contents):
+        in_q, out_q = asyncio.Queue(), asyncio.Queue()
+        for d_content in d_contents:
+            in_q.put_nowait(d_content)
+        in_q.put_nowait(None)
+        stage = ArtifactSaver()
+        stage._connect(in_q, out_q)
+        with mock.patch.object(stage, '_save_artifacts', side_effect=lambda artifacts: artifacts):
+            await stage()
+
+    @mock.patch('pulpcore.plugin.stages.artifact_stages._sync_files')
+    async def test_synced_files_are_not_synced_again(self, sync_files):
+        await self.run_stage([self.d_content(synced=True) for i in range(3)])
+        sync_files.assert_not_called()
+
+    @mock.patch('pulpcore.plugin.stages.artifact_stages._sync_files')
+    async def test_unsynced_files_are_synced_once_per_batch(self, sync_files):
+        await self.run_stage([self.d_content(synced=False), self.d_content(synced=True)])
+        sync_files.assert_called_once_with(['path'])
+
+
+class TestSyncFiles(asynctest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.paths = []
+        for name in ('a', 'b'):
+            path = os.path.join(self.tmp_dir.name, name)
+            with open(path, 'wb') as f:
+                f.write(b'data')
+            self.paths.append(path)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    @mock.patch('pulpcore.plugin.stages.artifact_stages.os.fsync')
+    @mock.patch('pulpcore.plugin.stages.artifact_stages._syncfs', return_value=0)
+    def test_one_syncfs_per_filesystem(self, syncfs, fsync):
+        _sync_files(self.paths)
+        self.assertEqual(syncfs.call_count, 1)
+        fsync.assert_not_called()
+
+    @mock.patch('pulpcore.plugin.stages.artifact_stages.os.sync')
+    @mock.patch('pulpcore.plugin.stages.artifact_stages.os.fsync')
+    @mock.patch('pulpcore.plugin.stages.artifact_stages.ctypes.get_errno',
+                return_value=errno.EIO)
+    @mock.patch('pulpcore.plugin.stages.artifact_stages._syncfs', return_value=-1)
+    def test_failed_syncfs_falls_back_to_fsync(self, syncfs, get_errno, fsync, sync):
+        with self.assertLogs('pulpcore.plugin.stages.artifact_stages', 'WARNING'):
+            _sync_files(self.paths)
+        self.assertEqual(fsync.call_count, 2)
+        sync.assert_not_called()
+
+    @mock.patch('pulpcore.plugin.stages.artifact_stages.os.sync')
+    @mock.patch('pulpcore.plugin.stages.artifact_stages.os.fsync')
+    @mock.patch('pulpcore.plugin.stages.artifact_stages._syncfs', None)
+    def test_fsync_without_syncfs(self, fsync, sync):
+        _sync_files(self.paths)
+        self.assertEqual(fsync.call_count, 2)
+        sync.assert_not_called()
@@ -0,0 +1,93 @@
+import asyncio
+
+import asynctest
+import mock
+
+from pulpcore.plugin.stages import ContentAssociation, ContentUnassociation
+
+
+@mock.patch('pulpcore.plugin.stages.association_stages.ProgressBar')
+@mock.patch('pulpcore.plugin.stages.association_stages.Content')
+class TestContentAssociation(asynctest.TestCase):
+
+    async def run_stage(self, stage, pks, ProgressBar):
+        ProgressBar.return_value.__enter__.return_value.done = 0
+        in_q, out_q = asyncio.Queue(), asyncio.Queue()
+        stage._connect(in_q, out_q)
+        task = asyncio.ensure_future(stage())
+        for pk in pks:
+            await in_q.put(mock.Mock(content=mock.Mock(pk=pk), does_batch=False))
+            await asyncio.sleep(0)
+        await in_q.put(None)
+        await task
+        return [out_q.get_nowait() for i in range(out_q.qsize())]
+
+    async def test_additions_are_buffered(self, Content, ProgressBar):
+        new_version = mock.Mock()
+        new_version.content.values_list.return_value = [1]
+        stage = ContentAssociation(new_version, chunk_size=3)
+        await self.run_stage(stage, [1, 2, 3, 4, 5], ProgressBar)
+
+        self.assertEqual(new_version.add_content.call_count, 2)
+        self.assertEqual([call[1]['pk__in'] for call in Content.objects.filter.call_args_list],
+                         [{2, 3, 4}, {5}])
+        progress_bar = ProgressBar.return_value.__enter__.return_value
+        self.assertEqual(progress_bar.done, 4)
+
+    async def test_additions_are_flushed_after_interval(self, Content, ProgressBar):
+        new_version = mock.Mock()
+        new_version.content.values_list.return_value = []
+        stage = ContentAssociation(new_version, flush_interval=0)
+        await self.run_stage(stage, [1, 2], ProgressBar)
+
+        self.assertEqual(new_version.add_content.call_count, 2)
+
+    async def test_removals_are_chunked(self, Content, ProgressBar):
+        new_version = mock.Mock()
+        new_version.content.values_list.return_value = [1, 2, 3, 4]
+        Content.objects.filter.side_effect = lambda **kwargs: mock.Mock()
+        stage = ContentAssociation(new_version, skipped_content={4}, chunk_size=2)
+        out = await self.run_stage(stage, [], ProgressBar)
+
+        new_version.add_content.assert_not_called()
+        self.assertEqual(len(out), 3)
+        removed = [pk for call in Content.objects.filter.call_args_list
+                   for pk in call[1]['pk__in']]
+        self.assertEqual(sorted(removed), [1, 2, 3])
+        self.assertEqual(sorted(queryset.known_count for queryset in out[:2]), [1, 2])
+
+
+class TestContentUnassociation(asynctest.TestCase):
+
+    @mock.patch('pulpcore.plugin.stages.association_stages.ProgressBar')
+    async def test_removed_units_are_counted(self, ProgressBar):
+        ProgressBar.return_value.__enter__.return_value.done = 0
+        queryset = mock.Mock(known_count=None)
+        queryset.count.return_value = 3
+        new_version = mock.Mock()
+        in_q, out_q = asyncio.Queue(), asyncio.Queue()
+        in_q.put_nowait(queryset)
+        in_q.put_nowait(None)
+        stage = ContentUnassociation(new_version)
+        stage._connect(in_q, out_q)
+        await stage()
+
+        new_version.remove_content.assert_called_once_with(queryset)
+        self.assertIs(out_q.get_nowait(), queryset)
+        progress_bar = ProgressBar.return_value.__enter__.return_value
+        self.assertEqual(progress_bar.done, 3)
+
+    @mock.patch('pulpcore.plugin.stages.association_stages.ProgressBar')
+    async def test_known_count_is_used(self, ProgressBar):
+        ProgressBar.return_value.__enter__.return_value.done = 0
+        queryset = mock.Mock(known_count=2)
+        in_q, out_q = asyncio.Queue(), asyncio.Queue()
+        in_q.put_nowait(queryset)
+        in_q.put_nowait(None)
+        stage = ContentUnassociation(mock.Mock())
+        stage._connect(in_q, out_q)
+        await stage()
+
+        queryset.count.assert_not_called()
+        progress_bar = ProgressBar.return_value.__enter__.return_value
+        self.assertEqual(progress_bar.done, 2)
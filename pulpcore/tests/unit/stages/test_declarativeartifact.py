@@ -0,0 +1,121 @@
+import asyncio
+import hashlib
+import os
+import tempfile
+
+import asynctest
+import mock
+
+from pulpcore.exceptions import SizeValidationError
+from pulpcore.plugin.download import FileDownloader
+from pulpcore.plugin.models import Artifact
+from pulpcore.plugin.stages import DeclarativeArtifact
+
+
+class TestDeclarativeArtifactDownload(asynctest.TestCase):
+
+    data = b'a' * 1000
+
+    def setUp(self):
+        super().setUp()
+        self.cwd = os.getcwd()
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        os.chdir(self.tmp_dir.name)
+        with open('source', 'wb') as f:
+            f.write(self.data)
+        self.url = 'file://' + os.path.join(self.tmp_dir.name, 'source')
+        self.downloaders = []
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.tmp_dir.cleanup()
+        super().tearDown()
+
+    def get_downloader(self, url, **kwargs):
+        downloader = FileDownloader(url, **kwargs)
+        self.downloaders.append(downloader)
+        return downloader
+
+    def d_artifact(self, remote=None, **digests):
+        if remote is None:
+            remote = mock.Mock()
+            remote.get_downloader = self.get_downloader
+        return DeclarativeArtifact(artifact=Artifact(**digests), url=self.url,
+                                   relative_path='path', remote=remote)
+
+    async def test_concurrent_downloads_are_coalesced(self):
+        sha256 = hashlib.sha256(self.data).hexdigest()
+        d_artifacts = [self.d_artifact(sha256=sha256) for i in range(3)]
+        d_artifacts.append(self.d_artifact(sha256=sha256, size=len(self.data)))
+        await asyncio.gather(*(d_artifact.download() for d_artifact in d_artifacts))
+        self.assertEqual(len(self.downloaders), 1)
+        paths = {d_artifact.artifact.file.name for d_artifact in d_artifacts}
+        self.assertEqual(len(paths), 4)
+        for path in paths:
+            with open(path, 'rb') as f:
+                self.assertEqual(f.read(), self.data)
+
+    async def test_coalesced_downloads_are_copied_without_links(self):
+        sha256 = hashlib.sha256(self.data).hexdigest()
+        d_artifacts = [self.d_artifact(sha256=sha256) for i in range(2)]
+        with mock.patch('pulpcore.plugin.download.cache._link', return_value=False):
+            await asyncio.gather(*(d_artifact.download() for d_artifact in d_artifacts))
+        self.assertEqual(len(self.downloaders), 1)
+        first, second = (d_artifact.artifact.file.name for d_artifact in d_artifacts)
+        self.assertFalse(os.path.samefile(first, second))
+        for path in (first, second):
+            with open(path, 'rb') as f:
+                self.assertEqual(f.read(), self.data)
+
+    async def test_expectations_are_validated_for_each_artifact(self):
+        sha256 = hashlib.sha256(self.data).hexdigest()
+        results = await asyncio.gather(
+            self.d_artifact(sha256=sha256).download(),
+            self.d_artifact(sha256=sha256, size=1).download(),
+            return_exceptions=True,
+        )
+        self.assertEqual(len(self.downloaders), 1)
+        self.assertEqual(results[0].artifact_attributes['sha256'], sha256)
+        self.assertIsInstance(results[1], SizeValidationError)
+
+    async def test_urls_without_digests_are_coalesced_per_remote(self):
+        remote = mock.Mock()
+        remote.get_downloader = self.get_downloader
+        d_artifacts = [self.d_artifact(remote), self.d_artifact(remote), self.d_artifact()]
+        await asyncio.gather(*(d_artifact.download() for d_artifact in d_artifacts))
+        self.assertEqual(len(self.downloaders), 2)
+
+    async def test_sequential_downloads_are_not_coalesced(self):
+        await self.d_artifact().download()
+        await self.d_artifact().download()
+        self.assertEqual(len(self.downloaders), 2)
+
+    async def test_downloads_without_priority(self):
+        await self.d_artifact().download()
+        self.assertFalse(self.downloaders[0].priority)
+
+    async def test_joined_download_gets_priority(self):
+        sha256 = hashlib.sha256(self.data).hexdigest()
+        d_artifacts = [self.d_artifact(sha256=sha256) for i in range(2)]
+        await asyncio.gather(d_artifacts[0].download(), d_artifacts[1].download(priority=True))
+        self.assertEqual(len(self.downloaders), 1)
+        self.assertTrue(self.downloaders[0].priority)
+
+    async def test_downloaded_files_are_synced(self):
+        d_artifact = self.d_artifact()
+        await d_artifact.download()
+        self.assertTrue(d_artifact.synced)
+
+    async def test_spooled_downloads_are_not_synced(self):
+        remote = mock.Mock()
+        remote.get_downloader = lambda url, **kwargs: mock.Mock(
+            wraps=self.get_downloader(url, **kwargs), spool_size=1024, artifact_storage=False)
+        d_artifact = self.d_artifact(remote=remote)
+        await d_artifact.download()
+        self.assertFalse(d_artifact.synced)
+
+    async def test_files_of_coalesced_downloads_are_not_synced(self):
+        sha256 = hashlib.sha256(self.data).hexdigest()
+        d_artifacts = [self.d_artifact(sha256=sha256) for i in range(2)]
+        await asyncio.gather(*(d_artifact.download() for d_artifact in d_artifacts))
+        self.assertEqual(sorted(d_artifact.synced for d_artifact in d_artifacts), [False, True])
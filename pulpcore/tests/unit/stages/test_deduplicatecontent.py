@@ -0,0 +1,83 @@
+import asyncio
+
+import asynctest
+import mock
+
+from pulpcore.plugin.stages import DeclarativeArtifact, DeclarativeContent, DeduplicateContent
+
+
+class UnitMock:
+
+    def __init__(self, name):
+        self.name = name
+
+    def natural_key(self):
+        return (self.name,)
+
+
+class TestDeduplicateContent(asynctest.TestCase):
+
+    remote = mock.Mock()
+
+    def d_content(self, name, url):
+        d_artifact = DeclarativeArtifact(artifact=mock.Mock(), url=url, relative_path=name,
+                                         remote=self.remote)
+        return DeclarativeContent(content=UnitMock(name), d_artifacts=[d_artifact])
+
+    async def run_stage(self, d_contents, **kwargs):
+        in_q, out_q = asyncio.Queue(), asyncio.Queue()
+        for d_content in d_contents:
+            in_q.put_nowait(d_content)
+        in_q.put_nowait(None)
+        stage = DeduplicateContent(**kwargs)
+        stage._connect(in_q, out_q)
+        await stage()
+        passed = []
+        while True:
+            d_content = out_q.get_nowait()
+            if d_content is None:
+                return passed
+            passed.append(d_content)
+
+    async def test_repeated_content_is_dropped(self):
+        d_contents = [DeclarativeContent(content=UnitMock(name)) for name in 'abab']
+        passed = await self.run_stage(d_contents)
+        self.assertEqual(passed, d_contents[:2])
+
+    async def test_futures_of_dropped_content_are_resolved(self):
+        d_contents = [DeclarativeContent(content=UnitMock('a')) for i in range(2)]
+        first, second = (d_content.get_or_create_future() for d_content in d_contents)
+        passed = await self.run_stage(d_contents)
+        self.assertEqual(passed, d_contents[:1])
+
+        saved = mock.Mock()
+        first.set_result(saved)
+        self.assertIs(await second, saved)
+
+    async def test_content_with_future_is_passed_if_first_has_none(self):
+        d_contents = [DeclarativeContent(content=UnitMock('a')) for i in range(2)]
+        d_contents[1].get_or_create_future()
+        passed = await self.run_stage(d_contents)
+        self.assertEqual(passed, d_contents)
+
+    async def test_content_with_the_same_artifacts_is_dropped(self):
+        d_contents = [self.d_content('a', 'http://a/a') for i in range(2)]
+        passed = await self.run_stage(d_contents)
+        self.assertEqual(passed, d_contents[:1])
+
+    async def test_content_with_other_urls_is_passed(self):
+        d_contents = [self.d_content('a', 'http://a/a'), self.d_content('a', 'http://b/a')]
+        passed = await self.run_stage(d_contents)
+        self.assertEqual(passed, d_contents)
+
+    async def test_least_recently_seen_units_are_forgotten(self):
+        d_contents = [DeclarativeContent(content=UnitMock(name)) for name in 'abcab']
+        passed = await self.run_stage(d_contents, max_size=2)
+        # 'a' is forgotten for 'c', and 'b' for 'a' again
+        self.assertEqual(passed, d_contents)
+
+    async def test_seen_units_are_kept_recent(self):
+        d_contents = [DeclarativeContent(content=UnitMock(name)) for name in 'abaca']
+        passed = await self.run_stage(d_contents, max_size=2)
+        # seeing 'a' again makes 'b' the least recently seen unit, forgotten for 'c'
+        self.assertEqual(passed, [d_contents[0], d_contents[1], d_contents[3]])
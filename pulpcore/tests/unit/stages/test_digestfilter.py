@@ -0,0 +1,39 @@
+import hashlib
+
+from django.test import SimpleTestCase
+import mock
+
+from pulpcore.plugin.stages import DigestFilter
+
+
+def digest(i):
+    return hashlib.sha256(str(i).encode()).hexdigest()
+
+
+class TestDigestFilter(SimpleTestCase):
+
+    def build(self, digests, max_bytes):
+        digest_filter = DigestFilter(max_bytes=max_bytes)
+        with mock.patch('pulpcore.plugin.stages.digest_filter.Artifact') as Artifact:
+            Artifact.objects.count.return_value = len(digests)
+            Artifact.objects.values_list.return_value.iterator.return_value = iter(digests)
+            digest_filter.build()
+        self.assertTrue(digest_filter.built)
+        return digest_filter
+
+    def test_contains_existing_digests(self):
+        digests = [digest(i) for i in range(1000)]
+        digest_filter = self.build(digests, max_bytes=1024)
+        self.assertEqual(digest_filter.count, 1000)
+        for existing in digests:
+            self.assertIn(existing, digest_filter)
+        digest_filter.add(digest('new'))
+        self.assertIn(digest('new'), digest_filter)
+
+    def test_false_positive_rate(self):
+        digest_filter = self.build([digest(i) for i in range(1000)], max_bytes=1024)
+        # 8 bits per digest give a rate of about 2%
+        self.assertAlmostEqual(digest_filter.expected_false_positive_rate, 0.02, delta=0.01)
+        false_positives = sum(digest(-i) in digest_filter for i in range(1, 10001))
+        self.assertAlmostEqual(false_positives / 10000, 0.02, delta=0.01)
+        self.assertIsNone(digest_filter.observed_false_positive_rate)
@@ -0,0 +1,72 @@
+import asyncio
+import hashlib
+import os
+import tempfile
+
+import asynctest
+import mock
+
+from pulpcore.plugin.stages import DeclarativeContent, FileSystemImporter
+
+
+class TestFileSystemImporter(asynctest.TestCase):
+
+    files = {
+        'a': b'a' * 100,
+        'dir/b': b'b' * 200000,
+        'dir/sub/c': b'',
+        'dir/skip': b'skip',
+    }
+
+    def setUp(self):
+        super().setUp()
+        self.cwd = os.getcwd()
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        os.chdir(self.tmp_dir.name)
+        self.source = os.path.join(self.tmp_dir.name, 'source')
+        for relative_path, data in self.files.items():
+            path = os.path.join(self.source, relative_path)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as f:
+                f.write(data)
+        os.mkdir('working')
+        os.chdir('working')
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.tmp_dir.cleanup()
+        super().tearDown()
+
+    def content_factory(self, d_artifact):
+        if d_artifact.relative_path == 'dir/skip':
+            return None
+        return DeclarativeContent(content=mock.Mock(), d_artifacts=[d_artifact])
+
+    async def test_import(self):
+        out_q = asyncio.Queue()
+        stage = FileSystemImporter(self.source, mock.Mock(), self.content_factory, processes=2)
+        stage._connect(None, out_q)
+        with mock.patch('pulpcore.plugin.stages.filesystem_stages.ProgressBar') as progress_bar:
+            pb = progress_bar.return_value.__enter__.return_value
+            pb.done = 0
+            await stage()
+        self.assertEqual(pb.done, len(self.files))
+        self.assertLess(pb.save.call_count, len(self.files))
+        pb.increment.assert_not_called()
+        d_artifacts = {}
+        while True:
+            d_content = out_q.get_nowait()
+            if d_content is None:
+                break
+            d_artifacts[d_content.d_artifacts[0].relative_path] = d_content.d_artifacts[0]
+        self.assertEqual(set(d_artifacts), {'a', 'dir/b', 'dir/sub/c'})
+        for relative_path, d_artifact in d_artifacts.items():
+            data = self.files[relative_path]
+            artifact = d_artifact.artifact
+            self.assertEqual(d_artifact.url, 'file://' + os.path.join(self.source, relative_path))
+            self.assertEqual(artifact.size, len(data))
+            self.assertEqual(artifact.sha256, hashlib.sha256(data).hexdigest())
+            self.assertEqual(os.path.dirname(artifact.file.name), os.getcwd())
+            with open(artifact.file.name, 'rb') as f:
+                self.assertEqual(f.read(), data)
+            self.assertTrue(os.path.exists(os.path.join(self.source, relative_path)))
@@ -0,0 +1,56 @@
+from uuid import uuid4
+
+from django.test import SimpleTestCase
+
+from pulpcore.plugin.models import Artifact
+from pulpcore.plugin.stages import LookupCache
+
+
+class TestLookupCache(SimpleTestCase):
+
+    def saved_artifact(self, **digests):
+        artifact = Artifact(pk=uuid4(), size=1, **digests)
+        artifact._state.adding = False
+        return artifact
+
+    def test_artifact_found_by_any_digest(self):
+        cache = LookupCache()
+        saved = self.saved_artifact(sha256='a', md5='b')
+        cache.add_artifact(saved)
+
+        found = cache.get_artifact(Artifact(md5='b'))
+        self.assertEqual(found.pk, saved.pk)
+        self.assertFalse(found._state.adding)
+        self.assertIsNot(found, saved)
+        self.assertIsNone(cache.get_artifact(Artifact(sha256='c')))
+        self.assertEqual((cache.artifact_hits, cache.artifact_misses), (1, 1))
+
+    def test_least_recently_used_are_dropped(self):
+        cache = LookupCache(max_size=2)
+        first, second, third = (self.saved_artifact(sha256=str(i)) for i in range(3))
+        cache.add_artifact(first)
+        cache.add_artifact(second)
+        cache.get_artifact(Artifact(sha256='0'))
+        cache.add_artifact(third)
+
+        self.assertIsNotNone(cache.get_artifact(Artifact(sha256='0')))
+        self.assertIsNone(cache.get_artifact(Artifact(sha256='1')))
+        self.assertIsNotNone(cache.get_artifact(Artifact(sha256='2')))
+
+    def test_artifacts_count_once_for_all_digests(self):
+        cache = LookupCache(max_size=2)
+        first, second = (self.saved_artifact(sha256=str(i), md5=str(i)) for i in range(2))
+        cache.add_artifact(first)
+        cache.add_artifact(second)
+
+        self.assertIsNotNone(cache.get_artifact(Artifact(md5='0')))
+        self.assertIsNotNone(cache.get_artifact(Artifact(sha256='1')))
+
+    def test_dropped_artifacts_are_not_found_by_any_digest(self):
+        cache = LookupCache(max_size=1)
+        first, second = (self.saved_artifact(sha256=str(i), md5=str(i)) for i in range(2))
+        cache.add_artifact(first)
+        cache.add_artifact(second)
+
+        self.assertIsNone(cache.get_artifact(Artifact(md5='0')))
+        self.assertEqual(len(cache._artifact_pks), 2)
@@ -0,0 +1,93 @@
+import asyncio
+import threading
+
+import asynctest
+import mock
+
+from django.db.models import Q
+
+from pulpcore.plugin.stages import DeclarativeArtifact, DeclarativeContent, QueryExistingArtifacts
+
+
+class TestQueryExistingArtifacts(asynctest.TestCase):
+
+    def d_content(self, sha256, deferred_download=False):
+        artifact = mock.Mock(sha256=sha256, DIGEST_FIELDS=['sha256'])
+        artifact.q.return_value = Q(sha256=sha256)
+        d_artifact = DeclarativeArtifact(artifact=artifact, url='url', relative_path='path',
+                                         remote=mock.Mock(), deferred_download=deferred_download)
+        return DeclarativeContent(content=mock.Mock(), d_artifacts=[d_artifact])
+
+    async def run_stage(self, stage, d_contents, existing=()):
+        in_q, out_q = asyncio.Queue(), asyncio.Queue()
+        for d_content in d_contents:
+            in_q.put_nowait(d_content)
+        in_q.put_nowait(None)
+        stage._connect(in_q, out_q)
+        with mock.patch('pulpcore.plugin.stages.artifact_stages.Artifact') as Artifact:
+            Artifact.objects.filter.return_value = existing
+            await stage()
+        self.assertEqual(out_q.qsize(), len(d_contents) + 1)
+        return Artifact.objects.filter
+
+    async def test_deferred_artifacts_are_queried(self):
+        existing = mock.Mock(sha256='b', DIGEST_FIELDS=['sha256'])
+        d_contents = [self.d_content('a'), self.d_content('b', deferred_download=True)]
+        query = await self.run_stage(QueryExistingArtifacts(), d_contents, [existing])
+        self.assertEqual(query.call_count, 1)
+        self.assertIs(d_contents[1].d_artifacts[0].artifact, existing)
+
+    async def test_deferred_artifacts_are_skipped(self):
+        existing = mock.Mock(sha256='b', DIGEST_FIELDS=['sha256'])
+        d_contents = [self.d_content('a'), self.d_content('b', deferred_download=True)]
+        query = await self.run_stage(QueryExistingArtifacts(query_deferred=False), d_contents,
+                                     [existing])
+        self.assertEqual(query.call_count, 1)
+        self.assertNotIn("'b'", str(query.call_args))
+        self.assertIsNot(d_contents[1].d_artifacts[0].artifact, existing)
+
+    async def test_no_query_without_artifacts_to_look_up(self):
+        d_contents = [self.d_content('b', deferred_download=True) for i in range(3)]
+        query = await self.run_stage(QueryExistingArtifacts(query_deferred=False), d_contents)
+        query.assert_not_called()
+
+    async def test_cached_artifacts_are_not_queried(self):
+        existing = mock.Mock(sha256='a', DIGEST_FIELDS=['sha256'])
+        cache = mock.Mock()
+        cache.get_artifact.side_effect = [None, existing]
+        d_contents = [self.d_content('a'), self.d_content('a')]
+        query = await self.run_stage(QueryExistingArtifacts(cache=cache), d_contents, [existing])
+        self.assertEqual(query.call_count, 1)
+        cache.add_artifact.assert_called_once_with(existing)
+        for d_content in d_contents:
+            self.assertIs(d_content.d_artifacts[0].artifact, existing)
+
+    async def test_artifacts_not_in_digest_filter_are_not_queried(self):
+        digest_filter = mock.MagicMock(built=True, positives=0, false_positives=0)
+        digest_filter.__contains__.side_effect = lambda sha256: sha256 == 'b'
+        d_contents = [self.d_content('a'), self.d_content('b')]
+        query = await self.run_stage(QueryExistingArtifacts(digest_filter=digest_filter),
+                                     d_contents)
+        self.assertEqual(query.call_count, 1)
+        self.assertNotIn("'a'", str(query.call_args))
+        self.assertEqual((digest_filter.positives, digest_filter.false_positives), (1, 1))
+
+    async def test_digest_filter_is_built_in_a_thread(self):
+        threads = []
+        digest_filter = mock.MagicMock(built=False, positives=0, false_positives=0)
+        digest_filter.__contains__.return_value = False
+        digest_filter.build.side_effect = lambda: threads.append(threading.get_ident())
+        with mock.patch('pulpcore.plugin.stages.artifact_stages.connection') as connection:
+            await self.run_stage(QueryExistingArtifacts(digest_filter=digest_filter),
+                                 [self.d_content('a')])
+        self.assertEqual(len(threads), 1)
+        self.assertNotEqual(threads[0], threading.get_ident())
+        connection.close.assert_called_once_with()
+
+    async def test_prefetch(self):
+        existing = mock.Mock(sha256='b', DIGEST_FIELDS=['sha256'])
+        d_contents = [self.d_content('a'), self.d_content('b')]
+        query = await self.run_stage(QueryExistingArtifacts(prefetch=True), d_contents,
+                                     [existing])
+        self.assertEqual(query.call_count, 1)
+        self.assertIs(d_contents[1].d_artifacts[0].artifact, existing)
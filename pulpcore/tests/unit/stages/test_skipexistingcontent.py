@@ -0,0 +1,72 @@
+import asyncio
+import uuid
+
+import asynctest
+import mock
+
+from django.db import models
+
+from pulpcore.plugin.stages import DeclarativeContent, SkipExistingContent
+
+
+class UnitMock:
+    """A content model with the natural key `name`."""
+
+    _meta = mock.Mock()
+    _meta.get_field.side_effect = lambda name: mock.Mock(
+        attname=name, get_db_prep_value=lambda value, connection: value)
+    objects = mock.Mock()
+
+    def __init__(self, name):
+        self.name = name
+        self._state = mock.Mock(adding=True)
+
+    @classmethod
+    def natural_key_fields(cls):
+        return ('name',)
+
+
+class TestSkipExistingContent(asynctest.TestCase):
+
+    async def run_stage(self, d_contents, existing):
+        UnitMock.objects.filter.return_value.values_list.return_value.iterator.return_value = \
+            iter(existing)
+        in_q, out_q = asyncio.Queue(), asyncio.Queue()
+        for d_content in d_contents:
+            in_q.put_nowait(d_content)
+        in_q.put_nowait(None)
+        stage = SkipExistingContent(mock.Mock())
+        stage._connect(in_q, out_q)
+        await stage()
+        return stage, out_q
+
+    async def test_units_in_version_are_skipped(self):
+        UnitMock.objects.filter.reset_mock()
+        d_contents = [DeclarativeContent(content=UnitMock(name)) for name in ('a', 'b', 'c')]
+        d_contents[1].get_or_create_future()
+        stage, out_q = await self.run_stage(d_contents, [(1, 'a'), (2, 'b')])
+
+        # 'b' is passed on because of its future
+        self.assertIs(out_q.get_nowait(), d_contents[1])
+        self.assertIs(out_q.get_nowait(), d_contents[2])
+        self.assertIsNone(out_q.get_nowait())
+        self.assertEqual(stage.skipped_content, {1})
+        self.assertEqual(UnitMock.objects.filter.call_count, 1)
+
+    async def test_keys_are_compared_as_written_to_the_db(self):
+        d_contents = [DeclarativeContent(content=UnitMock(name))
+                      for name in ({'b': 2, 'a': 1}, ['x'], {'a': 2})]
+        stage, out_q = await self.run_stage(d_contents, [(1, {'a': 1, 'b': 2}), (2, ['x'])])
+        self.assertIs(out_q.get_nowait(), d_contents[2])
+        self.assertIsNone(out_q.get_nowait())
+        self.assertEqual(stage.skipped_content, {1, 2})
+
+    async def test_uuid_strings_match_loaded_uuids(self):
+        field = models.UUIDField()
+        field.set_attributes_from_name('name')
+        value = uuid.uuid4()
+        d_content = DeclarativeContent(content=UnitMock(str(value)))
+        with mock.patch.object(UnitMock._meta, 'get_field', side_effect=lambda name: field):
+            stage, out_q = await self.run_stage([d_content], [(1, value)])
+        self.assertIsNone(out_q.get_nowait())
+        self.assertEqual(stage.skipped_content, {1})
@@ -1,4 +1,5 @@
 import asyncio
+import collections
 
 import asynctest
 import mock
@@ -122,3 +123,73 @@ class TestMultipleStages(asynctest.TestCase):
                         first_stage(),
                         end_stage(),
                     )
+
+
+class TestHandleBatches(asynctest.TestCase):
+
+    class PrefetchingStage(Stage):
+        def __init__(self, prefetch):
+            super().__init__()
+            self.prefetch = prefetch
+            self.handled = 0
+            self.handling = 0
+            self.max_handling = 0
+            self.started = collections.defaultdict(asyncio.Event)
+            self.release = collections.defaultdict(asyncio.Event)
+
+        async def run(self):
+            await self._handle_batches(self.handle, self.prefetch, minsize=1)
+
+        async def handle(self, batch, previous):
+            index = self.handled
+            self.handled += 1
+            self.handling += 1
+            self.max_handling = max(self.max_handling, self.handling)
+            self.started[index].set()
+            await self._evaluate([])
+            await self.release[index].wait()
+            if previous is not None:
+                await previous
+            for d_content in batch:
+                await self.put(d_content)
+            self.handling -= 1
+
+    def setUp(self):
+        self.in_q, self.out_q = asyncio.Queue(), asyncio.Queue()
+        self.d_contents = [mock.Mock(does_batch=True) for i in range(2)]
+
+    def start_stage(self, prefetch):
+        stage = self.PrefetchingStage(prefetch)
+        stage._connect(self.in_q, self.out_q)
+        return stage, asyncio.ensure_future(stage())
+
+    async def finish_stage(self, task):
+        self.in_q.put_nowait(None)
+        await asyncio.wait_for(task, 1)
+        received = [self.out_q.get_nowait() for i in range(self.out_q.qsize())]
+        self.assertEqual(received, self.d_contents + [None])
+
+    async def test_sequential(self):
+        stage, task = self.start_stage(prefetch=False)
+        self.in_q.put_nowait(self.d_contents[0])
+        await asyncio.wait_for(stage.started[0].wait(), 1)
+        self.in_q.put_nowait(self.d_contents[1])
+        stage.release[0].set()
+        await asyncio.wait_for(stage.started[1].wait(), 1)
+        stage.release[1].set()
+        await self.finish_stage(task)
+        self.assertEqual(stage.max_handling, 1)
+
+    async def test_prefetch_keeps_order(self):
+        stage, task = self.start_stage(prefetch=True)
+        self.in_q.put_nowait(self.d_contents[0])
+        await asyncio.wait_for(stage.started[0].wait(), 1)
+        self.in_q.put_nowait(self.d_contents[1])
+        # the second batch is handled while the first one is still held up
+        await asyncio.wait_for(stage.started[1].wait(), 1)
+        self.assertEqual(stage.handling, 2)
+        stage.release[1].set()
+        stage.release[0].set()
+        await self.finish_stage(task)
+        self.assertEqual(stage.max_handling, 2)
+        self.assertIsNone(stage._executor)
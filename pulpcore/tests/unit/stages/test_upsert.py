@@ -0,0 +1,189 @@
+from unittest import SkipTest, skipUnless
+from uuid import uuid4
+
+from django.db import connection, IntegrityError, models, OperationalError
+from django.test import SimpleTestCase, TestCase
+import mock
+
+from pulpcore.plugin.models import (
+    Content,
+    ContentArtifact,
+    Repository,
+    RepositoryContent,
+    RepositoryVersion,
+)
+from pulpcore.plugin.stages import bulk_upsert
+
+
+class UpsertContent(Content):
+    """
+    A content type with master and detail tables, created by the tests using it.
+    """
+    TYPE = 'upsert'
+
+    name = models.TextField()
+    version = models.TextField()
+    digest = models.TextField(unique=True)
+
+    class Meta:
+        app_label = Content._meta.app_label
+        unique_together = ('name', 'version')
+
+
+@mock.patch('pulpcore.plugin.stages.upsert.transaction')
+@mock.patch('pulpcore.plugin.stages.upsert.connection')
+class TestBulkUpsert(SimpleTestCase):
+
+    def upsert(self, connection, objs, results, copy=False):
+        connection.ops.quote_name = lambda name: '"{}"'.format(name)
+        connection.ops.adapt_datetimefield_value = lambda value: value
+        cursor = connection.cursor.return_value.__enter__.return_value
+        cursor.fetchall.return_value = results
+        upserted = bulk_upsert(ContentArtifact, objs, ('content', 'relative_path'), copy=copy)
+        return cursor.execute.call_args[0], upserted
+
+    def test_existing_and_new_objects(self, connection, transaction):
+        content_id = uuid4()
+        objs = [ContentArtifact(content_id=content_id, relative_path=path)
+                for path in ('a', 'b', 'a')]
+        existing_id = uuid4()
+        existing = (0, existing_id, None, None, None, content_id, 'a')
+        (sql, params), upserted = self.upsert(connection, objs, [existing, (None,) * 7])
+
+        self.assertEqual(sql.count('INSERT INTO'), 1)
+        self.assertIn('ON CONFLICT DO NOTHING', sql)
+        self.assertNotIn('IS NOT DISTINCT FROM', sql)
+        # The duplicate object is sent once.
+        self.assertEqual(len(params), 2 * 7)
+        self.assertEqual([created for obj, created in upserted], [False, True, False])
+        self.assertEqual(upserted[0][0].pk, existing_id)
+        self.assertIs(upserted[2][0], upserted[0][0])
+        self.assertIs(upserted[1][0], objs[1])
+        self.assertFalse(objs[1]._state.adding)
+
+    def test_concurrent_insert(self, connection, transaction):
+        objs = [ContentArtifact(content_id=uuid4(), relative_path='a')]
+        with self.assertRaises(IntegrityError):
+            self.upsert(connection, objs, [])
+        self.assertTrue(objs[0]._state.adding)
+
+    def test_copy(self, connection, transaction):
+        objs = [ContentArtifact(content_id=uuid4(), relative_path='a\tb')]
+        (sql, params), upserted = self.upsert(connection, objs, [(None,) * 7], copy=True)
+
+        cursor = connection.cursor.return_value.__enter__.return_value
+        copy_sql, data = cursor.copy_expert.call_args[0]
+        self.assertIn('COPY', copy_sql)
+        lines = data.getvalue().splitlines()
+        self.assertEqual(len(lines), 1)
+        self.assertEqual(lines[0].split('\t')[0], '0')
+        self.assertIn('a\\tb', lines[0])
+        self.assertEqual(params, [])
+        self.assertIn('SELECT * FROM', sql)
+        self.assertTrue(upserted[0][1])
+
+
+@skipUnless(connection.vendor == 'postgresql', 'bulk_upsert() needs PostgreSQL.')
+class TestBulkUpsertDatabase(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        try:
+            connection.ensure_connection()
+        except OperationalError:
+            raise SkipTest('The database is not available.')
+        super().setUpClass()
+
+    def setUp(self):
+        self.repository = Repository.objects.create(name='upsert')
+        self.version = RepositoryVersion.objects.create(repository=self.repository, number=1)
+        self.content = [Content.objects.create() for i in range(2)]
+
+    def memberships(self, copy=False):
+        objs = [RepositoryContent(repository=self.repository, content=content,
+                                  version_added=self.version)
+                for content in self.content]
+        return bulk_upsert(RepositoryContent, objs, ('repository', 'content', 'version_removed'),
+                           copy=copy)
+
+    def test_insert_and_match(self):
+        inserted = self.memberships()
+        self.assertEqual([created for obj, created in inserted], [True, True])
+        upserted = self.memberships(copy=True)
+        self.assertEqual([created for obj, created in upserted], [False, False])
+        self.assertEqual([obj.pk for obj, created in upserted],
+                         [obj.pk for obj, created in inserted])
+        self.assertEqual(RepositoryContent.objects.count(), 2)
+
+    def test_null_keys_match(self):
+        existing = RepositoryContent.objects.create(
+            repository=self.repository, content=self.content[0], version_added=self.version)
+        upserted = self.memberships()
+        self.assertEqual(upserted[0], (existing, False))
+        self.assertIsNone(upserted[0][0].version_removed_id)
+        self.assertTrue(upserted[1][1])
+        self.assertEqual(RepositoryContent.objects.filter(version_removed=None).count(), 2)
+
+
+@skipUnless(connection.vendor == 'postgresql', 'bulk_upsert() needs PostgreSQL.')
+class TestBulkUpsertDetailDatabase(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        try:
+            connection.ensure_connection()
+        except OperationalError:
+            raise SkipTest('The database is not available.')
+        with connection.schema_editor() as editor:
+            editor.create_model(UpsertContent)
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        with connection.schema_editor() as editor:
+            editor.delete_model(UpsertContent)
+
+    def units(self, *names):
+        units = [UpsertContent(name=name, version='1', digest=name) for name in names]
+        for unit in units:
+            unit._type = '{}.{}'.format(UpsertContent._meta.app_label, UpsertContent.TYPE)
+        return units
+
+    def check_insert_and_match(self, copy):
+        existing, = self.units('a')
+        existing.save()
+        units = self.units('a', 'b', 'b', 'c')
+        upserted = bulk_upsert(UpsertContent, units, ('name', 'version'), copy=copy)
+
+        self.assertEqual([created for obj, created in upserted], [False, True, False, True])
+        # The existing unit is loaded with the fields of both tables.
+        self.assertEqual(upserted[0][0].pk, existing.pk)
+        self.assertEqual(upserted[0][0].digest, 'a')
+        self.assertEqual(upserted[0][0]._type, existing._type)
+        # The duplicate unit is inserted once.
+        self.assertIs(upserted[2][0], upserted[1][0])
+        self.assertEqual(Content.objects.count(), 3)
+        # The detail rows are linked to their master rows.
+        for unit, created in upserted:
+            self.assertEqual(unit.content_ptr_id, unit.pk)
+            self.assertEqual(UpsertContent.objects.get(pk=unit.pk).name, unit.name)
+            self.assertEqual(Content.objects.get(pk=unit.pk)._type, existing._type)
+
+    def test_insert_and_match(self):
+        self.check_insert_and_match(copy=False)
+
+    def test_insert_and_match_with_copy(self):
+        self.check_insert_and_match(copy=True)
+
+    def test_conflict_is_rolled_back(self):
+        self.units('a')[0].save()
+        # A unit with a new key, whose detail row conflicts like a concurrent insert would.
+        unit, = self.units('b')
+        unit.digest = 'a'
+        for copy in (False, True):
+            with self.assertRaises(IntegrityError):
+                bulk_upsert(UpsertContent, [unit], ('name', 'version'), copy=copy)
+            self.assertTrue(unit._state.adding)
+            # The master row inserted by the same statement is rolled back too.
+            self.assertEqual(Content.objects.count(), 1)